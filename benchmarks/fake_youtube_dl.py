@@ -0,0 +1,66 @@
+"""
+Stand-in for the youtube-dl executable used by the benchmarks.
+
+Accepts the arguments lib/downloader.py passes and writes a synthetic video instead of downloading one.
+It is configured through environment variables so the pipeline runs unchanged:
+
+    FAKE_YOUTUBE_DL_SIZE          bytes of every synthetic video (default 1 MB)
+    FAKE_YOUTUBE_DL_LATENCY       seconds every download takes (default 0)
+    FAKE_YOUTUBE_DL_SOURCE        clip copied instead of writing random bytes, e.g. a generated test clip
+    FAKE_YOUTUBE_DL_MKV_RATIO     share of videos delivered as mkv unless the format selection prefers streams
+                                  of matching containers
+    FAKE_YOUTUBE_DL_UNAVAILABLE   share of videos failing as unavailable
+"""
+import hashlib
+import os
+import shutil
+import sys
+import time
+
+
+def fraction(video_id, salt):
+    # the same video always gets the same outcome
+    digest = hashlib.md5((salt + video_id).encode("ascii")).digest()
+    return int.from_bytes(digest[:4], "big") / 2 ** 32
+
+
+def main(args):
+    video_id = args[0].rsplit("=", 1)[-1]
+    time.sleep(float(os.environ.get("FAKE_YOUTUBE_DL_LATENCY", 0)))
+
+    if fraction(video_id, "unavailable") < float(os.environ.get("FAKE_YOUTUBE_DL_UNAVAILABLE", 0)):
+        sys.stderr.write("ERROR: Video unavailable\n")
+        return 1
+
+    if "-g" in args:
+        # clip mode resolves media urls, the local clip serves as the stream
+        print(os.environ.get("FAKE_YOUTUBE_DL_SOURCE", "/dev/null"))
+        return 0
+
+    output = args[args.index("--output") + 1]
+    if output == "-":
+        # streaming mode, the video goes to stdout
+        source = os.environ.get("FAKE_YOUTUBE_DL_SOURCE")
+        if source:
+            with open(source, "rb") as f:
+                shutil.copyfileobj(f, sys.stdout.buffer)
+        else:
+            sys.stdout.buffer.write(os.urandom(int(os.environ.get("FAKE_YOUTUBE_DL_SIZE", 1 << 20))))
+        return 0
+
+    if "+bestaudio[ext=" not in args[args.index("-f") + 1] and \
+            fraction(video_id, "mkv") < float(os.environ.get("FAKE_YOUTUBE_DL_MKV_RATIO", 0)):
+        output = os.path.splitext(output)[0] + ".mkv"
+
+    source = os.environ.get("FAKE_YOUTUBE_DL_SOURCE")
+    if source:
+        shutil.copyfile(source, output)
+    else:
+        size = int(os.environ.get("FAKE_YOUTUBE_DL_SIZE", 1 << 20))
+        with open(output, "wb") as f:
+            f.write(os.urandom(size))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,205 @@
+"""
+Throughput of the whole download pipeline (Pool, process_video, storage) against stand-ins:
+the fake youtube-dl of benchmarks/fake_youtube_dl.py, generated test clips for ffmpeg and the local storage backend.
+
+Runs the pipeline (Pool, or AsyncPool with --engine async) once per number of download workers and reports videos
+per second, p50/p99 latency of every stage, peak RSS of the driver and of the workers and the queue occupancy.
+Results are written to JSON, so two versions can be compared run by run.
+
+    python -m benchmarks.pipeline --videos 200 --workers 1 2 4 8 --latency 0.2 --output results.json
+
+Transcoding stages need ffmpeg on the PATH; without --clip the videos are random bytes and nothing is transcoded
+(keep --mkv-ratio at 0 then).
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import types
+
+ID_ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_"
+
+
+def install_config(root):
+    """
+    Point the pipeline at a scratch directory by providing lib.config before lib.downloader reads it.
+    The workers are forked and inherit it.
+    :param root:    Scratch directory.
+    :return:        Config module.
+    """
+
+    config = types.ModuleType("lib.config")
+    config.OUTPUT_ROOT = os.path.join(root, "sports", "OUTPUT")
+    config.STORAGE_BACKEND = "local"
+    config.LOCAL_STORAGE_ROOT = os.path.join(root, "blobs")
+    config.INVENTORY_PATH = os.path.join(root, "inventory.db")
+    config.YOUTUBE_DL_PATH = fake_youtube_dl(root)
+    sys.modules["lib.config"] = config
+    return config
+
+
+def fake_youtube_dl(root):
+    path = os.path.join(root, "youtube-dl")
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_youtube_dl.py")
+    with open(path, "w") as f:
+        f.write("#!/bin/sh\nexec '{}' '{}' \"$@\"\n".format(sys.executable, script))
+    os.chmod(path, 0o755)
+    return path
+
+
+def make_clip(path, seconds=2, size="320x240"):
+    """
+    Generate a small test clip with audio.
+    :return:    Path to the clip.
+    """
+
+    subprocess.run(["ffmpeg", "-y", "-loglevel", "fatal",
+                    "-f", "lavfi", "-i", "testsrc=duration={}:size={}:rate=25".format(seconds, size),
+                    "-f", "lavfi", "-i", "sine=duration={}".format(seconds),
+                    "-c:v", "libx264", "-g", "25", "-c:a", "aac", "-shortest", path], check=True)
+    return path
+
+
+def make_videos(count, seed=0):
+    generator = random.Random(seed)
+    return ["".join(generator.choice(ID_ALPHABET) for _ in range(11)) for _ in range(count)]
+
+
+def peak_rss_mb(who):
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run(config, videos, num_workers, args):
+    """
+    Download, transcode and upload all videos once.
+    :return:    Result dictionary of the run.
+    """
+
+    import lib.parallel_download as parallel
+
+    for directory in (config.OUTPUT_ROOT, config.LOCAL_STORAGE_ROOT):
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+    run_directory = tempfile.mkdtemp(dir=os.path.dirname(config.INVENTORY_PATH))
+    metrics_file = os.path.join(run_directory, "metrics.json")
+
+    options = dict(upload_workers=args.upload_workers, ledger_file=os.path.join(run_directory, "ledger.db"),
+                   metrics_file=metrics_file, metrics_interval=args.sample_interval, max_retries=0,
+                   transcode_workers=args.transcode_workers, match_container=args.match_container)
+    if args.engine == "async":
+        from lib.async_download import AsyncPool
+        pool = AsyncPool(None, videos, config.OUTPUT_ROOT, num_workers, os.path.join(run_directory, "failed.txt"),
+                         False, False, False, **options)
+    else:
+        pool = parallel.Pool(None, videos, config.OUTPUT_ROOT, num_workers, os.path.join(run_directory, "failed.txt"),
+                             False, False, False, stream=args.stream, **options)
+    started = time.time()
+    pool.start_workers()
+    pool.feed_videos()
+    pool.stop_workers()
+    elapsed = time.time() - started
+
+    with open(metrics_file) as f:
+        metrics = json.load(f)
+    return {
+        "workers": num_workers,
+        "seconds": elapsed,
+        "videos": metrics["videos"],
+        "videos_per_second": metrics["videos"].get("done", 0) / elapsed,
+        "mb_per_second": metrics["bytes"] / (1024 * 1024) / elapsed,
+        "stages": {stage: {"p50": summary["p50"], "p99": summary["p99"], "mean": summary["mean"]}
+                   for stage, summary in metrics["stages"].items() if summary["count"]},
+        "video_seconds": metrics["video_seconds"],
+        "max_queue_depths": metrics["max_queue_depths"],
+        "remux_avoided": metrics.get("remux_avoided"),
+        # every run has a process of its own (see run_isolated), so these are the peaks of this run:
+        # the driver, and the largest of its finished worker processes
+        "peak_rss_driver_mb": peak_rss_mb(resource.RUSAGE_SELF),
+        "peak_rss_workers_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+
+
+def run_isolated(config, videos, num_workers, args):
+    """
+    run() in a forked process of its own. RUSAGE_CHILDREN covers every child process ever waited for
+    and the driver's peak RSS never goes down, so runs sharing a process would report the peaks of the
+    runs before them.
+    :return:    Result dictionary of the run.
+    """
+
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_child, args=(results, config, videos, num_workers, args))
+    process.start()
+    result = results.get()
+    process.join()
+    if isinstance(result, str):
+        raise RuntimeError("run with {} workers failed:\n{}".format(num_workers, result))
+    return result
+
+
+def run_child(results, config, videos, num_workers, args):
+    try:
+        results.put(run(config, videos, num_workers, args))
+    except BaseException:
+        results.put(traceback.format_exc())
+        raise
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Benchmark the download pipeline against a fake youtube-dl and local storage.")
+    parser.add_argument("--videos", type=int, default=100, help="number of videos per run")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8], help="download workers of each run")
+    parser.add_argument("--size", type=int, default=1 << 20, help="bytes of every synthetic video")
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds every fake download takes")
+    parser.add_argument("--clip", default=False, action="store_true", help="download a generated test clip (needs ffmpeg)")
+    parser.add_argument("--mkv-ratio", type=float, default=0.0, help="share of videos delivered as mkv (needs --clip)")
+    parser.add_argument("--unavailable", type=float, default=0.0, help="share of unavailable videos")
+    parser.add_argument("--match-container", default=False, action="store_true", help="negotiate mp4 downloads")
+    parser.add_argument("--engine", default="process", choices=["process", "async"], help="Pool or AsyncPool")
+    parser.add_argument("--stream", choices=["single", "muxed"], help="stream videos straight into storage")
+    parser.add_argument("--upload-workers", type=int, default=0, help="parallel uploads of a separate upload stage")
+    parser.add_argument("--transcode-workers", type=int, help="processes of a separate ffmpeg stage")
+    parser.add_argument("--sample-interval", type=float, default=0.5, help="seconds between queue depth samples")
+    parser.add_argument("--output", default="benchmark_pipeline.json", help="where to write the results")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="sports1m-benchmark-")
+    try:
+        config = install_config(root)
+        os.environ["FAKE_YOUTUBE_DL_LATENCY"] = str(args.latency)
+        os.environ["FAKE_YOUTUBE_DL_SIZE"] = str(args.size)
+        os.environ["FAKE_YOUTUBE_DL_MKV_RATIO"] = str(args.mkv_ratio)
+        os.environ["FAKE_YOUTUBE_DL_UNAVAILABLE"] = str(args.unavailable)
+        if args.clip:
+            os.environ["FAKE_YOUTUBE_DL_SOURCE"] = make_clip(os.path.join(root, "clip.mp4"))
+
+        videos = make_videos(args.videos)
+        runs = []
+        for num_workers in args.workers:
+            result = run_isolated(config, videos, num_workers, args)
+            print("{:3d} workers: {:7.2f} videos/s".format(num_workers, result["videos_per_second"]))
+            runs.append(result)
+
+        results = {"revision": git_revision(), "created_at": time.time(), "parameters": vars(args), "runs": runs}
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
@@ -0,0 +1,63 @@
+"""
+Per-video upload overhead of upload2blob, before and after reusing one storage client per process.
+
+Uploads small synthetic files to the configured storage backend (see lib/storage.get_storage) so the
+cost is dominated by client setup, connection handshake and the completion wait rather than bytes.
+
+    python -m benchmarks.upload_overhead --videos 20 --size 65536
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import lib.downloader as downloader
+from lib.storage import get_storage
+
+
+def make_video(directory, index, size):
+    path = os.path.join(directory, "bench{:07d}.mp4".format(index))
+    with open(path, "wb") as f:
+        f.write(os.urandom(size))
+    return path
+
+
+def legacy_upload(video_file):
+    # the previous upload2blob: a new client per video and a fixed wait before deleting the file
+    blob_video = get_storage("sports-1m")
+    blob_video.upload_file(video_file, downloader.blob_name(video_file))
+    time.sleep(1)
+    os.remove(video_file)
+
+
+def measure(upload, videos, size):
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = os.path.join(tmp, "benchmark", "upload_overhead")
+        os.makedirs(directory)
+        paths = [make_video(directory, index, size) for index in range(videos)]
+
+        started = time.time()
+        for path in paths:
+            upload(path)
+        elapsed = time.time() - started
+
+        storage = get_storage("sports-1m")
+        for path in paths:
+            storage.delete(downloader.blob_name(path))
+            downloader.get_inventory().remove(downloader.blob_name(path))
+
+    return {"videos": videos, "seconds": elapsed, "seconds_per_video": elapsed / videos}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Measure per-video upload overhead.")
+    parser.add_argument("--videos", type=int, default=20, help="number of videos to upload per mode")
+    parser.add_argument("--size", type=int, default=64 * 1024, help="size of every video in bytes")
+    args = parser.parse_args()
+
+    results = {
+        "before": measure(legacy_upload, args.videos, args.size),
+        "after": measure(downloader.upload2blob, args.videos, args.size),
+    }
+    print(json.dumps(results, indent=2))
@@ -1,57 +1,264 @@
 import argparse, json, os
 import lib.config as config
+import lib.downloader as downloader
 import lib.parallel_download as parallel
-from lib.cloud_storage import CloudStorage
+from lib.async_download import AsyncPool
+from lib.frames import FrameSampler
+from lib.inventory import BlobInventory
+from lib.ledger import unfinished_ids
+from lib.partition import CROSS_VALIDATION_DIR, Partition, cross_validation_paths
+from lib.probe import METADATA_CACHE_PATH, MetadataCache, MetadataProbe, youtube_dl_probe
+from lib.scheduler import LABELS_PATH, MIDS_PATH, ClassScheduler, load_labels, load_mids
+from lib.sharding import in_shard, merge_shards, parse_shard, shard_path
+from lib.storage import get_storage
+from lib.transcode import UPLOAD_VARIANTS, TranscodeProfile
 
-def download_set(num_workers, failed_log, compress, verbose, skip, log_file, usage="all"):
+def load_videos(usage="all", fold=None, classes=None, per_class=None, interleave=False):
+    """
+    Videos of a run in download order.
+    :param usage:                 Which partition to download: train, test or all.
+    :param fold:                  Use the given cross-validation fold instead of the original partitions.
+    :param classes:               Only these classes (label indices, names or topic ids).
+    :param per_class:             At most this many videos per class.
+    :param interleave:            Take the classes round-robin.
+    :return:                      Partition or generator of video ids.
+    """
+
+    if fold is None:
+        train_path, test_path = config.TRAIN_METADATA_PATH, config.TEST_METADATA_PATH
+    else:
+        train_path, test_path = cross_validation_paths(getattr(config, "CROSS_VALIDATION_DIR", CROSS_VALIDATION_DIR),
+                                                       fold)
+
+    metadata_paths = []
+    if usage=="train" or usage=="all":
+        metadata_paths.append(train_path)
+    if usage=="test" or usage=="all":
+        metadata_paths.append(test_path)
+    video_list = Partition.load(*metadata_paths)
+    print(f"Total video number {len(video_list)}")
+
+    if classes is not None or per_class is not None or interleave:
+        scheduler = ClassScheduler(video_list, labels=load_labels(getattr(config, "LABELS_PATH", LABELS_PATH)),
+                                   mids=load_mids(getattr(config, "MIDS_PATH", MIDS_PATH)))
+        return scheduler.schedule(classes, per_class=per_class, interleave=interleave)
+    return video_list
+
+def stored_video_ids(inventory_max_age=None):
+    """
+    Refresh the blob inventory and read the ids of all stored videos.
+    :param inventory_max_age:     List again inventory shards older than this many seconds (None: only unlisted shards).
+    :return:                      Set of video ids.
+    """
+
+    blob_video = get_storage("sports-1m")
+    inventory = BlobInventory(downloader.INVENTORY_PATH)
+    inventory.refresh(blob_video, prefix=downloader.blob_prefix(config.OUTPUT_ROOT), max_age=inventory_max_age)
+    video_stored = inventory.video_ids()
+    inventory.close()
+    return video_stored
+
+def default_ledger_path(failed_log):
+    # next to the failed log, in the output directory without one
+    return os.path.join(os.path.dirname(failed_log) if failed_log else config.OUTPUT_ROOT, "ledger.db")
+
+def download_set(num_workers, failed_log, compress, verbose, skip, log_file, usage="all", fold=None,
+                 inventory_max_age=None, upload_workers=0, min_free_disk=0,
+                 in_process=False, ledger_file=None, metrics_file=None, progress=False, max_workers=None,
+                 rate_limit=None, transcode_workers=None, match_container=False, classes=None, per_class=None,
+                 interleave=False, shard=None, frames=None, keep_videos=True, stream=None, shared_work=False,
+                 engine="process", metadata_probe=None, probe_window=1000, section=None, clip_mode=False):
     """
     Download the test set.
-    :param num_workers:           Number of downloads in parallel.
+    :param num_workers:           Number of downloads in parallel (initial number when autoscaling).
     :param failed_log:            Where to save failed video ids.
-    :param compress:              Decides if the videos should be compressed.
+    :param compress:              TranscodeProfile of a compact training resolution version of the videos, False for none.
     :param verbose:               Print status.
     :param skip:                  Skip classes that already have folders (i.e. at least one video was downloaded).
     :param log_file:              Path to log file for youtube-dl.
+    :param usage:                 Which partition to download: train, test or all.
+    :param fold:                  Use the given cross-validation fold instead of the original partitions.
+    :param inventory_max_age:     List again blob inventory shards older than this many seconds (None: only unlisted shards).
+    :param upload_workers:        Parallel uploads of a separate upload stage (0 uploads inside the download workers).
+    :param min_free_disk:         Pause downloads while the output disk has less free bytes.
+    :param in_process:            Use one youtube-dl instance per worker instead of a process per video.
+    :param ledger_file:           Job ledger used to resume, defaults to ledger.db next to the failed log.
+    :param metrics_file:          Where to periodically dump pipeline metrics as JSON and Prometheus text.
+    :param progress:              Show a live progress bar.
+    :param max_workers:           Autoscale the download workers between 1 and max_workers.
+    :param rate_limit:            Downloads started per second across all workers.
+    :param transcode_workers:     Size of a separate ffmpeg process pool, e.g. os.cpu_count().
+    :param match_container:       Prefer mp4/m4a streams merged straight into mp4 to skip the mkv remux.
+    :param classes:               Only download these classes (label indices, names or topic ids).
+    :param per_class:             Download at most this many videos per class.
+    :param interleave:            Take the classes round-robin so a partial run is balanced.
+    :param shard:                 Tuple (i, N): only download the i-th of N disjoint slices of the videos;
+                                  the failed log, ledger and metrics file get a per-shard name.
+    :param frames:                FrameSampler: also pack sampled frames of every video into frame shards.
+    :param keep_videos:           Store the videos besides their frames.
+    :param stream:                Stream videos needing no post-processing straight into storage: single or muxed.
+    :param shared_work:           Let the workers claim the videos from a shared-memory table instead of a queue.
+    :param engine:                process: a Python process per download worker (parallel_download.Pool),
+                                  async: all downloads as asyncio tasks of this process (AsyncPool).
+    :param metadata_probe:        MetadataProbe run ahead of the downloads to skip dead videos (recorded as
+                                  unavailable in the ledger) and start large videos first, None to download the
+                                  videos in order; not supported with shared_work.
+    :param probe_window:          Videos ordered by size together.
+    :param section:               Tuple (start, end) in seconds: only keep this section of every video.
+    :param clip_mode:             Cut the section from the remote streams instead of downloading whole videos.
     :return:
     """
 
-    video_list = []
-    if usage=="train" or usage=="all":
-        with open(config.TRAIN_METADATA_PATH, 'r') as fread:
-            for line in fread.readlines():
-                video_id, _ = line.split(" ")
-                video_list.append(video_id[32:])
-    if usage=="test" or usage=="all":
-        with open(config.TEST_METADATA_PATH, 'r') as fread:
-            for line in fread.readlines():
-                video_id, _ = line.split(" ")
-                video_list.append(video_id[32:])
-    print(f"Total video number {len(video_list)}")
+    video_list = load_videos(usage, fold, classes, per_class, interleave)
+    video_stored = stored_video_ids(inventory_max_age)
+    data_to_process = (each for each in video_list if each not in video_stored and in_shard(each, shard))
+
+    if ledger_file is None:
+        ledger_file = default_ledger_path(failed_log)
+    failed_log, ledger_file, metrics_file = (shard_path(path, shard) for path in (failed_log, ledger_file, metrics_file))
 
-    blob_video = CloudStorage(config.STORAGE_ACCOUNT_NAME, "sports-1m", config.CONNECTION_STRING, config.SAS_TOKEN)
-    video_stored = set([os.path.basename(file_name)[:-4] for file_name in blob_video.list_blob_names()])
-    data_to_process = [each for each in video_list if each not in video_stored]
+    if metadata_probe is not None and shared_work:
+        # the work table is filled with every video before the downloads start, the probe could not run ahead
+        raise ValueError("the metadata probe does not support shared work tables")
 
+    if engine == "async":
+        if (frames is not None or stream or shared_work or in_process or max_workers or min_free_disk
+                or section is not None):
+            raise ValueError("the async engine does not support frames, streaming, shared work tables, "
+                             "in-process downloads, autoscaling, disk space limits or sections")
+        pool = AsyncPool(None, data_to_process, config.OUTPUT_ROOT, num_workers, failed_log, compress, verbose, skip,
+                         log_file=log_file, upload_workers=upload_workers, transcode_workers=transcode_workers,
+                         ledger_file=ledger_file, metrics_file=metrics_file, progress=progress,
+                         rate_limit=rate_limit, match_container=match_container)
+    else:
+        pool = parallel.Pool(None, data_to_process, config.OUTPUT_ROOT, num_workers, failed_log, compress, verbose,
+                             skip, log_file=log_file, upload_workers=upload_workers, min_free_disk=min_free_disk,
+                             in_process=in_process, ledger_file=ledger_file, metrics_file=metrics_file,
+                             progress=progress, max_workers=max_workers, rate_limit=rate_limit,
+                             transcode_workers=transcode_workers, match_container=match_container, frames=frames,
+                             keep_videos=keep_videos, stream=stream, shared_work=shared_work, clip_mode=clip_mode,
+                             section=section)
 
-    pool = parallel.Pool(None, data_to_process, config.OUTPUT_ROOT, num_workers, failed_log, compress, verbose, skip,
-                        log_file=log_file)
+    if metadata_probe is not None:
+        # videos the ledger has as finished are not probed either, the ones found dead are recorded in the ledger
+        pool.videos_list = metadata_probe.videos(unfinished_ids(data_to_process, ledger_file), window=probe_window,
+                                                 events_queue=pool.events_queue)
     pool.start_workers()
     pool.feed_videos()
     pool.stop_workers()
 
+    if metadata_probe is not None and verbose:
+        print("probe: {}".format(metadata_probe.stats))
+
+def merge_report(num_shards, failed_log, report_file, usage="all", fold=None, ledger_file=None, classes=None,
+                 per_class=None, interleave=False):
+    """
+    Reconcile the per-shard ledgers (copied next to the failed log) and the blob inventory
+    into one completion report.
+    :param num_shards:            Number of shards of the run.
+    :param failed_log:            Failed log path of the run, receives the ids of all failed videos.
+    :param report_file:           Where to write the JSON report.
+    :param usage:                 Which partition was downloaded: train, test or all.
+    :param fold:                  Cross-validation fold of the run, None for the original partitions.
+    :param ledger_file:           Ledger path of the run, defaults to ledger.db next to the failed log.
+    :param classes:               Classes of the run.
+    :param per_class:             Per-class cap of the run.
+    :param interleave:            Whether the run took the classes round-robin.
+    :return:                      Report dictionary.
+    """
+
+    if ledger_file is None:
+        ledger_file = default_ledger_path(failed_log)
+    video_list = load_videos(usage, fold, classes, per_class, interleave)
+    # other nodes uploaded since the last listing, list everything again
+    video_stored = stored_video_ids(inventory_max_age=0)
+    return merge_shards(video_list, num_shards, ledger_file, video_stored, report_file=report_file,
+                        failed_file=failed_log)
+
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser("Download Kinetics videos in the mp4 format.")
+    parser = argparse.ArgumentParser("Download Sports-1M videos in the mp4 format.")
+
+    parser.add_argument("--classes", nargs="+", help="classes to download (label indices, names or topic ids)")
+    parser.add_argument("--per-class", type=int, help="download at most this many videos per class")
+    parser.add_argument("--interleave", default=False, action="store_true", help="take the classes round-robin")
+    parser.add_argument("--usage", default="all", choices=["train", "test", "all"], help="partition to download")
+    parser.add_argument("--fold", type=int, help="download a cross-validation fold instead of the original partitions")
+    parser.add_argument("--shard", type=parse_shard, help="only download shard i of N, given as i/N")
+    parser.add_argument("--merge", type=int, metavar="N", help="merge the results of N shards into --report instead of downloading")
+    parser.add_argument("--report", default="OUTPUT/report.json", help="where to save the merged completion report")
+
+    parser.add_argument("--engine", default="process", choices=["process", "async"], help="a process per download worker or asyncio tasks in one process")
+    parser.add_argument("--num-workers", type=int, default=10, help="number of downloader processes (concurrent downloads of the async engine)")
+    parser.add_argument("--max-workers", type=int, help="autoscale the downloader processes up to this number")
+    parser.add_argument("--rate-limit", type=float, help="downloads started per second")
+    parser.add_argument("--upload-workers", type=int, default=0, help="parallel uploads of a separate upload stage")
+    parser.add_argument("--transcode-workers", type=int, help="processes of a separate ffmpeg stage")
+    parser.add_argument("--shared-work", default=False, action="store_true", help="workers claim videos from a shared-memory table")
+    parser.add_argument("--min-free-disk", type=int, default=0, help="pause downloads below this many free bytes")
+    parser.add_argument("--in-process", default=False, action="store_true", help="use the youtube-dl library in each worker")
+    parser.add_argument("--match-container", default=False, action="store_true", help="prefer streams merging straight into mp4")
+    parser.add_argument("--section", type=float, nargs=2, metavar=("START", "END"), help="only keep this section of every video, in seconds")
+    parser.add_argument("--clip-mode", default=False, action="store_true", help="cut the section from the remote streams instead of downloading whole videos")
+    parser.add_argument("--stream", choices=downloader.STREAM_MODES, help="upload videos needing no post-processing while downloading, without local files")
+    parser.add_argument("--probe", default=False, action="store_true", help="probe metadata ahead of the downloads, skip dead videos and start large ones first (not with --shared-work)")
+    parser.add_argument("--probe-cache", default=METADATA_CACHE_PATH, help="SQLite cache of the probed metadata")
+    parser.add_argument("--probe-max-age", type=float, help="probe videos again whose metadata is older than this many seconds")
+    parser.add_argument("--probe-batch", type=int, default=50, help="videos per youtube-dl probe")
+    parser.add_argument("--probe-window", type=int, default=1000, help="videos ordered by size together")
+    parser.add_argument("--inventory-max-age", type=float, help="list blob inventory shards older than this many seconds again")
+    parser.add_argument("--frame-fps", type=float, help="sample frames at this rate into packed frame shards")
+    parser.add_argument("--frame-size", type=int, default=256, help="short side of the sampled frames in pixels")
+    parser.add_argument("--frame-quality", type=int, default=3, help="JPEG quality of the sampled frames (2-31)")
+    parser.add_argument("--frames-only", default=False, action="store_true", help="store the frame shards but not the videos")
+    parser.add_argument("--failed-log", default="OUTPUT/failed.txt", help="where to save list of failed videos")
+    parser.add_argument("--ledger", help="job ledger, defaults to ledger.db next to the failed log")
+    parser.add_argument("--metrics-file", help="where to dump pipeline metrics")
+    parser.add_argument("--progress", default=False, action="store_true", help="show a progress bar")
+    parser.add_argument("--compress", default=False, action="store_true", help="transcode videos to a compact training resolution")
+    parser.add_argument("--compress-short-side", type=int, default=256, help="short side of compressed videos in pixels")
+    parser.add_argument("--compress-fps", type=float, help="frame rate of compressed videos (default: keep)")
+    parser.add_argument("--compress-crf", type=int, default=28, help="x264 CRF of compressed videos")
+    parser.add_argument("--compress-preset", default="veryfast", help="x264 preset of compressed videos")
+    parser.add_argument("--compress-gop", type=int, help="keyframe interval of compressed videos in frames")
+    parser.add_argument("--compress-threads", type=int, help="ffmpeg threads per compressing encode (default: the cores shared by the encodes running at once)")
+    parser.add_argument("--upload-variant", default="compact", choices=UPLOAD_VARIANTS, help="which version of compressed videos to store")
+    parser.add_argument("-v", "--verbose", default=False, action="store_true", help="print additional info")
+    parser.add_argument("-s", "--skip", default=False, action="store_true", help="skip classes that already have folders")
+    parser.add_argument("-l", "--log-file", help="log file for youtube-dl (the library used to download YouTube videos)")
 
-    # parser.add_argument("--categories", nargs="+", help="categories to download")
-    # parser.add_argument("--classes", nargs="+", help="classes to download")
-    # parser.add_argument("--all", action="store_true", help="download the whole dataset")
-    # parser.add_argument("--test", action="store_true", help="download the test set")
+    args = parser.parse_args()
+    compress = False
+    if args.compress:
+        compress = TranscodeProfile(args.compress_short_side, fps=args.compress_fps, crf=args.compress_crf,
+                                    preset=args.compress_preset, gop=args.compress_gop, threads=args.compress_threads,
+                                    upload=args.upload_variant)
+    frames = None
+    if args.frame_fps is not None:
+        frames = FrameSampler(args.frame_fps, short_side=args.frame_size, quality=args.frame_quality)
 
-    # parser.add_argument("--num-workers", type=int, default=1, help="number of downloader processes")
-    # parser.add_argument("--failed-log", default="dataset/failed.txt", help="where to save list of failed videos")
-    # parser.add_argument("--compress", default=False, action="store_true", help="compress videos using gzip (not recommended)")
-    # parser.add_argument("-v", "--verbose", default=False, action="store_true", help="print additional info")
-    # parser.add_argument("-s", "--skip", default=False, action="store_true", help="skip classes that already have folders")
-    # parser.add_argument("-l", "--log-file", help="log file for youtube-dl (the library used to download YouTube videos)")
+    metadata_probe = None
+    if args.probe:
+        metadata_probe = MetadataProbe(MetadataCache(args.probe_cache),
+                                       youtube_dl_probe(match_container=args.match_container, log_file=args.log_file),
+                                       batch_size=args.probe_batch, max_age=args.probe_max_age)
 
-    download_set(10, "OUTPUT/failed.txt", False, False, False, None)
\ No newline at end of file
+    try:
+        if args.merge is not None:
+            report = merge_report(args.merge, args.failed_log, args.report, usage=args.usage, fold=args.fold,
+                                  ledger_file=args.ledger, classes=args.classes, per_class=args.per_class,
+                                  interleave=args.interleave)
+            print(json.dumps({key: report[key] for key in ("videos", "states", "completed", "done_not_stored")}))
+        else:
+            download_set(args.num_workers, args.failed_log, compress, args.verbose, args.skip, args.log_file,
+                         usage=args.usage, fold=args.fold, inventory_max_age=args.inventory_max_age,
+                         upload_workers=args.upload_workers, min_free_disk=args.min_free_disk,
+                         in_process=args.in_process, ledger_file=args.ledger, metrics_file=args.metrics_file,
+                         progress=args.progress, max_workers=args.max_workers, rate_limit=args.rate_limit,
+                         transcode_workers=args.transcode_workers, match_container=args.match_container,
+                         classes=args.classes, per_class=args.per_class, interleave=args.interleave, shard=args.shard,
+                         frames=frames, keep_videos=not args.frames_only, stream=args.stream, shared_work=args.shared_work,
+                         engine=args.engine, metadata_probe=metadata_probe, probe_window=args.probe_window,
+                         section=args.section, clip_mode=args.clip_mode)
+    finally:
+        if metadata_probe is not None:
+            metadata_probe.cache.close()
@@ -0,0 +1,373 @@
+import asyncio
+import contextlib
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import lib.autoscale as autoscale
+import lib.downloader as downloader
+import lib.ledger as ledger
+import lib.metrics as metrics
+from lib.transcode import TranscodeProfile
+
+
+async def run_command(cmd):
+    """
+    Run a command as an asyncio subprocess.
+    :param cmd:     List of arguments.
+    :return:        Tuple: return code, stdout as bytes and stderr as str.
+    """
+
+    process = await asyncio.create_subprocess_exec(*cmd, stdin=asyncio.subprocess.DEVNULL,
+                                                   stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    output, error = await process.communicate()
+    return process.returncode, output, error.decode("utf-8", "replace")
+
+
+def stored_bytes(video_path):
+    return sum(os.path.getsize(path) for path in downloader.as_paths(video_path))
+
+
+def replace_output(video_path, new_path):
+    """
+    Remove a video replaced by a remuxed version and index the new file.
+    :return:    Bool indicating whether the new file exists.
+    """
+
+    os.remove(video_path)
+    downloader.index_output(video_path, present=False)
+    if not os.path.isfile(new_path):
+        return False
+    downloader.index_output(new_path)
+    return True
+
+
+def keep_compressed(video_path, compact_path, upload):
+    downloader.index_output(compact_path)
+    return downloader.keep_variants(video_path, compact_path, upload)
+
+
+def remove_stored(path, name):
+    # the upload is recorded before the local copy goes
+    downloader.get_inventory().add(name)
+    os.remove(path)
+    downloader.index_output(path, present=False)
+
+
+class AsyncPool:
+    """
+    Download engine running every video as an asyncio task of one process, with the interface of
+    parallel_download.Pool (start_workers, feed_videos, stop_workers).
+
+    youtube-dl and ffmpeg run as asyncio subprocesses and uploads go through the async blob client, so a
+    download waiting on the network costs a task instead of a Python process, and concurrency can go into
+    the hundreds on a small machine. Downloads, transcodes and uploads are each bounded by a semaphore.
+    Local bookkeeping (output files, the output index and the blob inventory) runs in a thread of its own,
+    off the event loop and apart from the executor of the blob client.
+
+    Whole videos are downloaded, remuxed and compressed; cutting sections, clips, frames and streaming need Pool.
+    """
+
+    def __init__(self, classes, videos_list, directory, num_workers, failed_save_file, compress, verbose, skip,
+                 log_file=None, upload_workers=0, transcode_workers=None, ledger_file=None, max_retries=2,
+                 retry_backoff=30, metrics_file=None, metrics_interval=30, progress=False, rate_limit=None,
+                 match_container=False):
+        """
+        :param classes:               Must be None, videos are saved to directory.
+        :param videos_list:           Iterable of video ids.
+        :param directory:             Where to download to videos.
+        :param num_workers:           How many videos are downloaded at the same time.
+        :param failed_save_file:      Where to save the failed videos ids.
+        :param compress:              TranscodeProfile of a compact version of every video (True for the default
+                                      profile), False to store the downloads as they are.
+        :param upload_workers:        How many uploads run at the same time, 0 for as many as downloads.
+        :param transcode_workers:     How many ffmpeg processes run at the same time, defaults to the number of cores.
+        :param ledger_file:           Job ledger recording the state of every video; videos done or unavailable
+                                      according to it are skipped.
+        :param max_retries:           How often a transient failure is retried.
+        :param retry_backoff:         Seconds before the first retry, doubled for every further retry.
+        :param metrics_file:          Where to dump per-stage timings, bytes and stage occupancy as JSON.
+        :param metrics_interval:      Seconds between two metrics dumps.
+        :param progress:              Show a live progress bar.
+        :param rate_limit:            Downloads started per second, None for no limit.
+        :param match_container:       Prefer mp4/m4a streams and merge straight into mp4 so videos need no remux.
+        """
+
+        if classes is not None:
+            raise ValueError("AsyncPool only supports downloading without classes")
+
+        self.videos_list = videos_list
+        self.directory = directory
+        self.failed_save_file = failed_save_file
+        self.compress = compress
+        self.verbose = verbose
+        self.log_file = log_file
+        self.ledger_file = ledger_file
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+        self.progress = progress
+        self.match_container = match_container
+        self.rate_limiter = autoscale.TokenBucket(rate_limit) if rate_limit else None
+        self.limits = {"download": num_workers, "transcode": transcode_workers or os.cpu_count() or 1,
+                       "upload": upload_workers or num_workers}
+        if compress:
+            # encodes running at the same time share the cores instead of each using all of them
+            profile = compress if isinstance(compress, TranscodeProfile) else TranscodeProfile()
+            self.compress = profile.for_concurrency(self.limits["transcode"])
+
+        # the ledger writer is a thread of this process as well
+        self.events_queue = queue.Queue()
+        self.ledger_worker = None
+        self.loop = None
+        self.loop_thread = None
+        self.local_executor = None
+        # created in the event loop
+        self.slots = None
+        self.admission = None
+        self.waiting = {stage: 0 for stage in self.limits}
+        self.tasks = set()
+        self.sampler = None
+
+    def call(self, coroutine):
+        # run a coroutine in the event loop thread and wait for its result
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def run_local(self, function, *args):
+        # one thread touches the output index and the inventory, which are not thread safe
+        return await self.loop.run_in_executor(self.local_executor, function, *args)
+
+    def start_workers(self):
+        """
+        Start the ledger writer and the event loop.
+        :return:    None.
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        downloader.get_output_index(self.directory)
+
+        self.ledger_worker = threading.Thread(target=ledger.ledger_worker,
+                                              args=(self.events_queue, self.ledger_file, self.failed_save_file),
+                                              kwargs={"metrics_file": self.metrics_file,
+                                                      "metrics_interval": self.metrics_interval,
+                                                      "progress": self.progress})
+        self.ledger_worker.start()
+
+        self.local_executor = ThreadPoolExecutor(max_workers=1)
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.loop_thread.start()
+        self.call(self.setup())
+
+        if self.verbose:
+            print("concurrency: {}".format(self.limits))
+
+    async def setup(self):
+        self.slots = {stage: asyncio.Semaphore(limit) for stage, limit in self.limits.items()}
+        # every stage can be busy while the next videos wait for a download slot
+        self.admission = asyncio.Semaphore(2 * sum(self.limits.values()))
+        if self.metrics_file is not None or self.progress:
+            self.sampler = asyncio.ensure_future(self.sample_stages())
+
+    def feed_videos(self):
+        """
+        Start a task for every video, waiting while enough videos are in flight.
+        :return:    None.
+        """
+
+        # the videos are iterated here, a slow iterable must not block the event loop
+        for video_id in ledger.unfinished_ids(self.videos_list, self.ledger_file):
+            self.call(self.admit(video_id))
+
+    async def admit(self, video_id):
+        await self.admission.acquire()
+        task = asyncio.ensure_future(self.run_video(video_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.finished)
+
+    def finished(self, task):
+        self.tasks.discard(task)
+        self.admission.release()
+
+    def stop_workers(self):
+        """
+        Wait for the videos in flight, then stop the event loop and the ledger writer.
+        :return:    None.
+        """
+
+        self.call(self.drain())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+        self.local_executor.shutdown()
+
+        self.events_queue.put(None)
+        self.ledger_worker.join()
+
+    async def drain(self):
+        while self.tasks:
+            await asyncio.wait(list(self.tasks))
+        if self.sampler is not None:
+            self.sampler.cancel()
+        # the async client belongs to this loop
+        await downloader.get_storage_client().close_async()
+
+    async def sample_stages(self):
+        """
+        Periodically send how many videos wait for each stage to the metrics.
+        """
+
+        while True:
+            await asyncio.sleep(min(self.metrics_interval, 5))
+            self.events_queue.put(metrics.queue_event(dict(self.waiting)))
+
+    @contextlib.asynccontextmanager
+    async def slot(self, stage):
+        self.waiting[stage] += 1
+        try:
+            await self.slots[stage].acquire()
+        finally:
+            self.waiting[stage] -= 1
+        try:
+            yield
+        finally:
+            self.slots[stage].release()
+
+    async def run_video(self, video_id):
+        """
+        Process one video with retries and report its state to the ledger, like parallel_download.video_worker.
+        """
+
+        for attempt in range(self.max_retries + 1):
+            self.events_queue.put(ledger.job_event(video_id, ledger.IN_PROGRESS))
+            report = {}
+            start_time = time.time()
+            try:
+                success = await self.process_video(video_id, report)
+            except Exception as e:
+                success = downloader.fail(report, report.get("error_class", ledger.ERROR_DOWNLOAD), str(e))
+            duration = time.time() - start_time
+
+            if success:
+                self.events_queue.put(ledger.job_event(video_id, ledger.DONE, num_bytes=report.get("bytes"),
+                                                       duration=duration, stages=report.get("stages"),
+                                                       container=report.get("container"),
+                                                       compression=report.get("compression")))
+                return
+
+            error_class = report.get("error_class", ledger.ERROR_DOWNLOAD)
+            if ledger.is_permanent(error_class):
+                self.events_queue.put(ledger.job_event(video_id, ledger.UNAVAILABLE, error_class, report.get("error"),
+                                                       duration=duration, stages=report.get("stages")))
+                return
+
+            if attempt == self.max_retries:
+                self.events_queue.put(ledger.job_event(video_id, ledger.FAILED, error_class, report.get("error"),
+                                                       duration=duration, stages=report.get("stages")))
+            else:
+                await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+
+    async def process_video(self, video_id, report):
+        """
+        Fetch, transcode if needed and upload one video, each stage holding a slot of its semaphore.
+        :return:    Bool indicating success.
+        """
+
+        if self.rate_limiter is not None:
+            # waiting for a token in an executor thread would hold one the uploads need
+            wait = self.rate_limiter.try_acquire()
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = self.rate_limiter.try_acquire()
+
+        async with self.slot("download"):
+            success, video_path = await self.fetch_video(video_id, report)
+        if not success:
+            return False
+        if video_path is None:
+            return True
+
+        if downloader.needs_transcode(video_path, compress=self.compress):
+            async with self.slot("transcode"):
+                success, video_path = await self.transcode_video(video_path, report)
+            if not success:
+                return False
+
+        report["bytes"] = await self.run_local(stored_bytes, video_path)
+        async with self.slot("upload"):
+            return await self.store_video(video_path, report)
+
+    async def fetch_video(self, video_id, report):
+        """
+        Download stage, see downloader.fetch_video.
+        :return:    Tuple: bool indicating success and the path to the fetched video (None when already processed).
+        """
+
+        download_path = await self.run_local(downloader.prepare_output, video_id, self.directory)
+        if download_path is None:
+            return True, None
+
+        cmd = downloader.download_command(video_id, download_path, match_container=self.match_container)
+        with metrics.stage_timer(report, "download"):
+            returncode, _, error = await run_command(cmd)
+        downloader.append_log(self.log_file, error)
+        if returncode != 0:
+            return downloader.fail(report, ledger.classify_error(error), error.strip()[-1000:]), None
+        return await self.run_local(downloader.find_download, download_path, report)
+
+    async def transcode_video(self, video_path, report):
+        """
+        Transcoding stage: remux mkv to mp4 and compress, see downloader.transcode_video.
+        :return:    Tuple: bool indicating success and the path (or list of paths) of the stored variants.
+        """
+
+        if video_path.endswith(".mkv"):
+            mp4_path = "{}.mp4".format(os.path.splitext(video_path)[0])
+            with metrics.stage_timer(report, "remux"):
+                await run_command(downloader.remux_command(video_path, mp4_path))
+            if not await self.run_local(replace_output, video_path, mp4_path):
+                return downloader.fail(report, ledger.ERROR_FFMPEG, "could not remux {}".format(video_path)), None
+            video_path = mp4_path
+
+        if not self.compress:
+            return True, video_path
+
+        profile = self.compress if isinstance(self.compress, TranscodeProfile) else TranscodeProfile()
+        compact_path = "{}.compact{}".format(*os.path.splitext(video_path))
+        start = time.time()
+        with metrics.stage_timer(report, "compress"):
+            returncode, output, _ = await run_command(profile.command(video_path, compact_path))
+        compression = None
+        if returncode == 0:
+            compression = profile.summarize(video_path, compact_path, output, time.time() - start)
+        if compression is None:
+            return downloader.fail(report, ledger.ERROR_FFMPEG, "could not compress {}".format(video_path)), None
+        report["compression"] = compression
+
+        outputs = await self.run_local(keep_compressed, video_path, compact_path, profile.upload)
+        return True, outputs[0] if len(outputs) == 1 else outputs
+
+    async def store_video(self, video_path, report):
+        """
+        Upload stage, see downloader.upload2blob.
+        :return:    Bool indicating success.
+        """
+
+        storage = downloader.get_storage_client()
+        for path in downloader.as_paths(video_path):
+            name = downloader.blob_name(path)
+            try:
+                with metrics.stage_timer(report, "upload"):
+                    await storage.upload_file_async(path, name)
+                    # the local copy is only removed once the stored blob has the full size
+                    if await storage.get_size_async(name) != os.path.getsize(path):
+                        raise IOError("incomplete upload of {}".format(name))
+            except Exception as e:
+                return downloader.fail(report, ledger.ERROR_UPLOAD, "could not upload {}: {}".format(path, e))
+            with metrics.stage_timer(report, "delete"):
+                await self.run_local(remove_stored, path, name)
+        return True
+
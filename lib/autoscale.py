@@ -0,0 +1,172 @@
+import os
+import shutil
+import threading
+import time
+from multiprocessing import Lock, Value
+
+
+class TokenBucket:
+    """
+    Rate limit shared by all worker processes: every download takes one token, tokens refill at rate per second.
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        :param rate:        Tokens per second.
+        :param capacity:    Burst size, defaults to one second worth of tokens.
+        """
+
+        capacity = max(1.0, rate if capacity is None else capacity)
+        self.rate = Value("d", rate, lock=False)
+        self.capacity = Value("d", capacity, lock=False)
+        self.tokens = Value("d", capacity, lock=False)
+        self.updated = Value("d", time.time(), lock=False)
+        self.lock = Lock()
+
+    def acquire(self):
+        """
+        Take one token, waiting until one is available.
+        :return:    None.
+        """
+
+        wait = self.try_acquire()
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.try_acquire()
+
+    def try_acquire(self):
+        """
+        Take one token if one is available, without waiting.
+        :return:    0 when a token was taken, else the seconds until the next one.
+        """
+
+        with self.lock:
+            now = time.time()
+            self.tokens.value = min(self.capacity.value,
+                                    self.tokens.value + (now - self.updated.value) * self.rate.value)
+            self.updated.value = now
+            if self.tokens.value >= 1:
+                self.tokens.value -= 1
+                return 0
+            return (1 - self.tokens.value) / self.rate.value
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate.value = rate
+            self.capacity.value = max(1.0, rate)
+
+
+class WorkerStats:
+    """
+    Counters shared by the worker processes, read by the autoscaler.
+    """
+
+    def __init__(self):
+        self.attempts = Value("l", 0)
+        self.completed = Value("l", 0)
+        self.throttled = Value("l", 0)
+
+    def increment(self, counter):
+        with counter.get_lock():
+            counter.value += 1
+
+    def read(self):
+        return self.attempts.value, self.completed.value, self.throttled.value
+
+
+class AutoScaler:
+    """
+    Grows and shrinks the download workers of a Pool at runtime.
+
+    Additive increase while throughput keeps improving, multiplicative decrease on throttling
+    (HTTP 429), and a step down under CPU or disk pressure; always within [min_workers, max_workers].
+    """
+
+    def __init__(self, pool, min_workers, max_workers, interval=60, max_load=1.5, min_free_disk=0,
+                 rate_limiter=None, step=2):
+        """
+        :param pool:            Pool providing resize(num_workers), num_active_workers and stats.
+        :param min_workers:     Lower bound of the number of workers.
+        :param max_workers:     Upper bound of the number of workers.
+        :param interval:        Seconds between two decisions.
+        :param max_load:        Shrink while the 1 minute load average per core is above this.
+        :param min_free_disk:   Shrink while the download directory has less free bytes.
+        :param rate_limiter:    TokenBucket whose rate is halved on throttling and slowly restored.
+        :param step:            Workers added at once.
+        """
+
+        self.pool = pool
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.interval = interval
+        self.max_load = max_load
+        self.min_free_disk = min_free_disk
+        self.rate_limiter = rate_limiter
+        self.max_rate = rate_limiter.rate.value if rate_limiter is not None else None
+        self.step = step
+
+        self.best_throughput = 0.0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def under_pressure(self):
+        load_per_core = os.getloadavg()[0] / (os.cpu_count() or 1)
+        if load_per_core > self.max_load:
+            return True
+        if self.min_free_disk and shutil.disk_usage(self.pool.directory).free < self.min_free_disk:
+            return True
+        return False
+
+    def decide(self, workers, throughput, throttled):
+        """
+        Target number of workers for the next interval.
+        :param workers:         Current number of workers.
+        :param throughput:      Videos per second during the last interval.
+        :param throttled:       Throttled attempts during the last interval.
+        :return:                Number of workers.
+        """
+
+        if throttled:
+            target = workers * 3 // 4
+            if self.rate_limiter is not None:
+                self.rate_limiter.set_rate(max(0.01, self.rate_limiter.rate.value / 2))
+        elif self.under_pressure():
+            target = workers - 1
+        elif throughput > 0 and throughput >= self.best_throughput * 1.05:
+            # adding workers still pays off; nothing completing says nothing about more workers
+            self.best_throughput = throughput
+            target = workers + self.step
+        elif throughput < self.best_throughput * 0.8:
+            # the last increase did not help, the bottleneck is elsewhere
+            target = workers - 1
+            self.best_throughput = throughput
+        else:
+            target = workers
+
+        if not throttled and self.rate_limiter is not None and self.rate_limiter.rate.value < self.max_rate:
+            self.rate_limiter.set_rate(min(self.max_rate, self.rate_limiter.rate.value * 1.25))
+
+        return max(self.min_workers, min(self.max_workers, target))
+
+    def run(self):
+        _, last_completed, last_throttled = self.pool.stats.read()
+        last_time = time.time()
+
+        while not self.stopped.wait(self.interval):
+            _, completed, throttled = self.pool.stats.read()
+            now = time.time()
+            throughput = (completed - last_completed) / (now - last_time)
+            workers = self.pool.num_active_workers()
+            target = self.decide(workers, throughput, throttled - last_throttled)
+            if target != workers:
+                self.pool.resize(target)
+            last_completed, last_throttled, last_time = completed, throttled, now
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,130 @@
+import json
+import os
+import os.path as op
+import subprocess as sp
+import tempfile
+import time
+
+import lib.config as config
+from lib.storage import transfer_stats
+
+# environment of the child processes, copied from os.environ once instead of for every command
+base_environment = None
+
+
+def get_azcopy():
+    """
+    Path of the azcopy executable, config.AZCOPY_PATH or azcopy on the PATH.
+    """
+
+    return op.expanduser(getattr(config, "AZCOPY_PATH", "azcopy"))
+
+
+def command_environment(env=None):
+    """
+    Environment for a child process: the environment of this process without SSH_AUTH_SOCK,
+    updated with env. The base is copied once; later changes of os.environ are not seen.
+    :param env:     Dictionary of variables to set, None for none.
+    :return:        Dictionary.
+    """
+
+    global base_environment
+
+    if base_environment is None:
+        base_environment = {k: v for k, v in os.environ.items() if k != 'SSH_AUTH_SOCK'}
+    if not env:
+        return base_environment
+    e = dict(base_environment)
+    e.update(env)
+    return e
+
+
+def parse_job_output(output):
+    """
+    Parse the output of an azcopy job run with --output-type=json: one JSON message per line,
+    whose MessageContent is itself JSON; the EndOfJob message holds the summary of the job.
+    :param output:  stdout of azcopy as str.
+    :return:        Summary of the EndOfJob message as a dictionary, None if the job did not end.
+    """
+
+    summary = None
+    for line in output.splitlines():
+        line = line.strip()
+        if not line.startswith('{'):
+            continue
+        try:
+            message = json.loads(line)
+        except ValueError:
+            continue
+        if message.get('MessageType') == 'EndOfJob':
+            content = message.get('MessageContent')
+            summary = json.loads(content) if isinstance(content, str) else content
+    return summary
+
+
+def relative_path(path, root):
+    # azcopy reports absolute local paths or full urls, the batch is keyed by the listed relative paths
+    path = path.split('?', 1)[0].replace('\\', '/')
+    root = root.split('?', 1)[0].replace('\\', '/').rstrip('/') + '/'
+    index = path.find(root)
+    return path[index + len(root):] if index >= 0 else path
+
+
+def copy_batch(source, destination, relative_paths, concurrency=None, block_size_mb=None, overwrite='true',
+               extra_args=None):
+    """
+    Copy many files with a single azcopy job: the paths go into a --list-of-files file instead of
+    one azcopy process (and job setup) per file.
+    :param source:          Local directory or container url (with SAS token) the paths are relative to.
+    :param destination:     Container url (with SAS token) or local directory the paths are copied below.
+    :param relative_paths:  Iterable of '/' separated paths relative to source; duplicates are copied once.
+    :param concurrency:     Parallel transfers of azcopy (AZCOPY_CONCURRENCY_VALUE), None for its default.
+    :param block_size_mb:   Block size of uploads in MB, None for the azcopy default.
+    :param overwrite:       azcopy --overwrite: true, false, prompt or ifSourceNewer.
+    :param extra_args:      Further azcopy arguments.
+    :return:                Dictionary: counts of transferred, skipped and failed files, errors per failed path,
+                            the status of every path and the overall transfer_stats.
+    """
+
+    relative_paths = sorted(set(relative_paths))
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+        f.writelines(path + '\n' for path in relative_paths)
+        list_file = f.name
+
+    cmd = [get_azcopy(), 'copy', source, destination, '--list-of-files={}'.format(list_file),
+           '--output-type=json', '--as-subdir=false', '--overwrite={}'.format(overwrite)]
+    if block_size_mb is not None:
+        cmd.append('--block-size-mb={}'.format(block_size_mb))
+    cmd += extra_args or []
+    env = {'AZCOPY_CONCURRENCY_VALUE': str(concurrency)} if concurrency else None
+
+    start = time.time()
+    try:
+        # azcopy exits with an error when any transfer failed, the summary still tells which
+        result = sp.run(cmd, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, env=command_environment(env))
+    finally:
+        os.remove(list_file)
+    seconds = time.time() - start
+
+    job = parse_job_output(result.stdout.decode('utf-8', 'replace'))
+    if job is None:
+        raise ValueError('azcopy did not finish the job: {}'.format(result.stderr.decode('utf-8', 'replace')))
+
+    status = {path: 'transferred' for path in relative_paths}
+    errors = {}
+    for transfer in job.get('SkippedTransfers') or []:
+        status[relative_path(transfer.get('Src', ''), source)] = 'skipped'
+    for transfer in job.get('FailedTransfers') or []:
+        path = relative_path(transfer.get('Src', ''), source)
+        status[path] = 'failed'
+        errors[path] = transfer.get('ErrorCode')
+
+    num_bytes = int(job.get('TotalBytesTransferred') or 0)
+    summary = transfer_stats(num_bytes, num_bytes, seconds)
+    summary['files'] = len(status)
+    for state in ('transferred', 'skipped', 'failed'):
+        summary[state] = sum(1 for s in status.values() if s == state)
+    summary['errors'] = errors
+    summary['status'] = status
+    summary['job_status'] = job.get('JobStatus')
+    return summary
@@ -1,9 +1,25 @@
+import asyncio
 import os
 import os.path as op
+import base64
+import hashlib
 import logging
-# from ete3 import Tree
-from azure.storage.blob import BlobClient, BlobServiceClient
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from azure.core.exceptions import AzureError, ResourceExistsError, ResourceNotFoundError
+from azure.core.pipeline.transport import RequestsTransport
+from azure.storage.blob import BlobBlock, BlobClient, BlobServiceClient, ContentSettings
+import requests
 import subprocess as sp
+from lib.azcopy import command_environment, copy_batch, get_azcopy
+from lib.storage import StorageBackend, file_md5, read_block, transfer_stats
+
+# files up to this size go up in a single put, larger ones as staged blocks
+SINGLE_UPLOAD_THRESHOLD = 64 * 1024 * 1024
+DEFAULT_BLOCK_SIZE = 8 * 1024 * 1024
+DEFAULT_MAX_CONCURRENCY = 4
 
 
 def ensure_directory(path):
@@ -38,14 +54,9 @@ def cmd_run(list_cmd, return_output=False, env=None,
     # if we dont' set stdin as sp.PIPE, it will complain the stdin is not a tty
     # device. Maybe, the reson is it is inside another process.
     # if stdout=sp.PIPE, it will not print the result in the screen
-    e = os.environ.copy()
-    if 'SSH_AUTH_SOCK' in e:
-        del e['SSH_AUTH_SOCK']
+    e = command_environment(env)
     if working_dir:
         ensure_directory(working_dir)
-    if env:
-        for k in env:
-            e[k] = env[k]
     if dry_run:
         # we need the log result. Thus, we do not return at teh very beginning
         return
@@ -80,68 +91,291 @@ def cmd_run(list_cmd, return_output=False, env=None,
         logging.info('finished the cmd run')
         return message.decode('utf-8')
 
-# def get_leaf_names(all_fname):
-#     # build the tree first
-#     root = Tree()
-#     for fname in all_fname:
-#         components = fname.split('/')
-#         curr = root
-#         for com in components:
-#             currs = [c for c in curr.children if c.name == com]
-#             if len(currs) == 0:
-#                 curr = curr.add_child(name=com)
-#             else:
-#                 assert len(currs) == 1
-#                 curr = currs[0]
-#     result = []
-#     for node in root.iter_leaves():
-#         ans = [s.name for s in node.get_ancestors()[:-1]]
-#         ans.insert(0, node.name)
-#         result.append('/'.join([a for a in ans[::-1]]))
-#     return result
-
-
-
-class CloudStorage(object):
-    def __init__(self, account_name, container_name, connection_string, sas_token):
+class CloudStorage(StorageBackend):
+    def __init__(self, account_name, container_name, connection_string, sas_token, max_connections=None,
+            block_size=DEFAULT_BLOCK_SIZE, max_concurrency=DEFAULT_MAX_CONCURRENCY, validate_content=False,
+            upload_retries=3):
         self.account_name = account_name
         self.container_name = container_name
+        # large uploads: size of a staged block, blocks staged in parallel per blob,
+        # whether to send MD5 checksums, and how often to resume a failed upload
+        self.block_size = block_size
+        self.max_concurrency = max_concurrency
+        self.validate_content = validate_content
+        self.upload_retries = upload_retries
         # blob_service_client is for azure.storage.blob service
-        self.blob_service_client = BlobServiceClient.from_connection_string(connection_string)
+        # it keeps its http session, so one instance should be reused for many requests
+        if max_connections:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self.blob_service_client = BlobServiceClient.from_connection_string(
+                connection_string, transport=RequestsTransport(session=session, session_owner=False))
+        else:
+            self.blob_service_client = BlobServiceClient.from_connection_string(connection_string)
         # sas_token and account_name are used in azcopy
         self.sas_token = sas_token
-        
+        # the async client of upload_file_async is created in the event loop it is used in
+        self.connection_string = connection_string
+        self.async_service_client = None
+
+    @classmethod
+    def from_azurite(cls, container_name, connection_string):
+        """Connect to an Azurite emulator and create the container if needed.
+
+        azcopy based methods are not available in this mode since there is no sas token.
+        """
+        storage = cls('devstoreaccount1', container_name, connection_string, None)
+        try:
+            storage.blob_service_client.create_container(container_name)
+        except ResourceExistsError:
+            pass
+        return storage
 
     def list_blob_names(self, name_starts_with=None):
         container_client = self.blob_service_client.get_container_client(self.container_name)
         blob_list = container_client.list_blobs(name_starts_with=name_starts_with)
         return [blob.name for blob in blob_list]
 
-    def upload_folder(self, folder, target_prefix):
-        def remove_tailing(x):
-            if x.endswith('/') or x.endswith('\\'):
-                x = x[:-1]
-            return x
-        folder = remove_tailing(folder)
-        target_prefix = remove_tailing(target_prefix)
-        for root, dirs, files in os.walk(folder):
-            for f in files:
-                src_file = op.join(root, f)
-                assert src_file.startswith(folder)
-                target_file = src_file.replace(folder, target_prefix)
-                self.upload_file(src_file, target_file)
-            for d in dirs:
-                self.upload_folder(op.join(root, d),
-                        op.join(target_prefix, d))
-
-    def upload_file(self, src_file, target_file):
+    def upload_file(self, src_file, target_file, overwrite=False):
+        """Upload a local file.
+
+        Files larger than SINGLE_UPLOAD_THRESHOLD are staged block by block in parallel and
+        committed at the end, so a retry only sends the blocks that are not staged yet.
+
+        Args:
+            src_file (str): path of the local file.
+            target_file (str): blob name.
+            overwrite (bool): replace an existing blob instead of failing.
+
+        Returns:
+            dict: bytes, sent bytes, seconds and MB/s of the upload.
+        """
         logging.info('uploading {} to {}'.format(src_file, target_file))
         if target_file.startswith('/'):
             logging.info('remove strarting slash for {}'.format(target_file))
             target_file = target_file[1:]
         blob_client = self.blob_service_client.get_blob_client(self.container_name, target_file)
-        with open(src_file, "rb") as data:
-            blob_client.upload_blob(data)
+        size = op.getsize(src_file)
+        start = time.time()
+        if size <= SINGLE_UPLOAD_THRESHOLD:
+            content_settings = None
+            if self.validate_content:
+                content_settings = ContentSettings(content_md5=file_md5(src_file))
+            with open(src_file, "rb") as data:
+                blob_client.upload_blob(data, overwrite=overwrite, content_settings=content_settings,
+                        validate_content=self.validate_content)
+            sent = size
+        else:
+            if not overwrite and blob_client.exists():
+                raise ResourceExistsError('{} already exists'.format(target_file))
+            sent = self.upload_blocks(blob_client, src_file)
+        stats = transfer_stats(size, sent, time.time() - start)
+        logging.info('uploaded {} in {:.1f}s ({:.1f} MB/s)'.format(target_file, stats['seconds'], stats['mb_per_s']))
+        return stats
+
+    def upload_blocks(self, blob_client, src_file):
+        """Stage a file as blocks in parallel and commit the block list.
+
+        Blocks left uncommitted by an earlier failed attempt are kept by the service for
+        a week; the ones matching this file are not sent again.
+
+        Returns:
+            int: number of bytes sent.
+        """
+        size = op.getsize(src_file)
+        # ids depend on the file, so blocks staged for another version of it are never reused
+        stamp = '{:016x}{:016x}{:08x}'.format(size, int(op.getmtime(src_file)), self.block_size)
+        block_ids = [base64.b64encode('{}{:08x}'.format(stamp, i).encode()).decode()
+                for i in range((size + self.block_size - 1) // self.block_size)]
+
+        def stage(index, staged):
+            offset = index * self.block_size
+            length = min(self.block_size, size - offset)
+            if staged.get(block_ids[index]) == length:
+                return 0
+            with open(src_file, 'rb') as f:
+                f.seek(offset)
+                data = f.read(length)
+            blob_client.stage_block(block_ids[index], data, validate_content=self.validate_content)
+            return length
+
+        # unlike a single put, a committed block list gets no Content-MD5 from the service; without it
+        # is_identical could never skip a large blob
+        content_settings = ContentSettings(content_md5=file_md5(src_file))
+
+        sent = 0
+        for attempt in range(self.upload_retries + 1):
+            try:
+                try:
+                    _, uncommitted = blob_client.get_block_list('uncommitted')
+                    staged = {block.id: block.size for block in uncommitted}
+                except ResourceNotFoundError:
+                    staged = {}
+                with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                    sent += sum(executor.map(lambda index: stage(index, staged), range(len(block_ids))))
+                blob_client.commit_block_list([BlobBlock(block_id=block_id) for block_id in block_ids],
+                        content_settings=content_settings)
+                return sent
+            except AzureError as e:
+                if attempt == self.upload_retries:
+                    raise
+                logging.info('resuming upload of {} after: {}'.format(src_file, e))
+
+    def get_async_service_client(self):
+        if self.async_service_client is None:
+            # needs aiohttp, only imported by async callers
+            from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+            self.async_service_client = AsyncBlobServiceClient.from_connection_string(
+                self.connection_string, max_block_size=self.block_size, max_single_put_size=SINGLE_UPLOAD_THRESHOLD)
+        return self.async_service_client
+
+    async def upload_file_async(self, src_file, target_file, overwrite=False):
+        """Upload a local file through the async blob client, without blocking the event loop on the network.
+
+        Args:
+            src_file (str): path of the local file.
+            target_file (str): blob name.
+            overwrite (bool): replace an existing blob instead of failing.
+
+        Returns:
+            dict: bytes, sent bytes, seconds and MB/s of the upload.
+        """
+        if target_file.startswith('/'):
+            target_file = target_file[1:]
+        blob_client = self.get_async_service_client().get_blob_client(self.container_name, target_file)
+        size = op.getsize(src_file)
+        start = time.time()
+        content_settings = None
+        if size > SINGLE_UPLOAD_THRESHOLD:
+            # larger files are committed as a block list, which gets no Content-MD5 from the service
+            md5 = await asyncio.get_running_loop().run_in_executor(None, file_md5, src_file)
+            content_settings = ContentSettings(content_md5=md5)
+        with open(src_file, 'rb') as data:
+            await blob_client.upload_blob(data, length=size, overwrite=overwrite, max_concurrency=self.max_concurrency,
+                                          content_settings=content_settings, validate_content=self.validate_content)
+        return transfer_stats(size, size, time.time() - start)
+
+    async def get_size_async(self, blob_name):
+        blob_client = self.get_async_service_client().get_blob_client(self.container_name, blob_name)
+        properties = await blob_client.get_blob_properties()
+        return properties.size
+
+    async def close_async(self):
+        if self.async_service_client is not None:
+            await self.async_service_client.close()
+            self.async_service_client = None
+
+    def upload_stream(self, stream, target_file, overwrite=False, complete=None):
+        """Upload a binary stream as staged blocks while it is being read.
+
+        At most max_concurrency blocks are staged at the same time, so memory stays bounded by
+        (max_concurrency + 1) * block_size whatever the length of the stream. The block list is
+        committed with the MD5 of the whole stream once the stream ends and complete() agrees.
+
+        Args:
+            stream (file): binary file object, e.g. the stdout of a downloader.
+            target_file (str): blob name.
+            overwrite (bool): replace an existing blob instead of failing.
+            complete (callable): checked at the end of the stream; nothing is committed when it returns False.
+
+        Returns:
+            dict: bytes, sent bytes, seconds and MB/s of the upload.
+        """
+        if target_file.startswith('/'):
+            target_file = target_file[1:]
+        blob_client = self.blob_service_client.get_blob_client(self.container_name, target_file)
+        if not overwrite and blob_client.exists():
+            raise ResourceExistsError('{} already exists'.format(target_file))
+
+        def stage(block_id, data):
+            try:
+                for attempt in range(self.upload_retries + 1):
+                    try:
+                        blob_client.stage_block(block_id, data, validate_content=self.validate_content)
+                        return
+                    except AzureError as e:
+                        if attempt == self.upload_retries:
+                            raise
+                        logging.info('restaging block of {} after: {}'.format(target_file, e))
+            finally:
+                slots.release()
+
+        # a random prefix keeps the blocks of concurrent or earlier attempts apart
+        prefix = uuid.uuid4().hex
+        slots = threading.BoundedSemaphore(self.max_concurrency)
+        md5 = hashlib.md5()
+        block_ids = []
+        futures = []
+        size = 0
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            while True:
+                slots.acquire()
+                data = read_block(stream, self.block_size)
+                if not data:
+                    slots.release()
+                    break
+                md5.update(data)
+                size += len(data)
+                block_ids.append(base64.b64encode('{}{:08x}'.format(prefix, len(block_ids)).encode()).decode())
+                futures.append(executor.submit(stage, block_ids[-1], data))
+                # fail early instead of reading the rest of the stream
+                if any(future.done() and future.exception() for future in futures[-self.max_concurrency:]):
+                    break
+        for future in futures:
+            future.result()
+        if complete is not None and not complete():
+            raise IOError('incomplete stream for {}'.format(target_file))
+        if size == 0:
+            raise IOError('empty stream for {}'.format(target_file))
+
+        blob_client.commit_block_list([BlobBlock(block_id=block_id) for block_id in block_ids],
+                content_settings=ContentSettings(content_md5=md5.digest()))
+        stats = transfer_stats(size, size, time.time() - start)
+        logging.info('streamed {} in {:.1f}s ({:.1f} MB/s)'.format(target_file, stats['seconds'], stats['mb_per_s']))
+        return stats
+
+    def download_file(self, blob_name, local_path):
+        ensure_directory(op.dirname(local_path))
+        blob_client = self.blob_service_client.get_blob_client(self.container_name, blob_name)
+        with open(local_path, "wb") as download_file:
+            blob_client.download_blob().readinto(download_file)
+
+    def exists(self, blob_name):
+        blob_client = self.blob_service_client.get_blob_client(self.container_name, blob_name)
+        return blob_client.exists()
+
+    def get_size(self, blob_name):
+        blob_client = self.blob_service_client.get_blob_client(self.container_name, blob_name)
+        return blob_client.get_blob_properties().size
+
+    def delete(self, blob_name):
+        blob_client = self.blob_service_client.get_blob_client(self.container_name, blob_name)
+        blob_client.delete_blob()
+
+    def get_md5(self, blob_name):
+        """Content-MD5 of a blob.
+
+        The service sets it for single put uploads; blobs committed from blocks only have it
+        when they were uploaded with validate_content.
+        """
+        blob_client = self.blob_service_client.get_blob_client(self.container_name, blob_name)
+        md5 = blob_client.get_blob_properties().content_settings.content_md5
+        return bytes(md5) if md5 else None
+
+    def is_identical(self, local_path, blob_name):
+        """Compare size and MD5 with a local file using a single properties request."""
+        blob_client = self.blob_service_client.get_blob_client(self.container_name, blob_name)
+        try:
+            properties = blob_client.get_blob_properties()
+        except ResourceNotFoundError:
+            return False
+        if properties.size != op.getsize(local_path):
+            return False
+        md5 = properties.content_settings.content_md5
+        return bool(md5) and bytes(md5) == file_md5(local_path)
 
     def az_sync(self, src_dir, dest_dir):
         assert self.sas_token
@@ -184,14 +418,13 @@ class CloudStorage(object):
         cmd_run(cmd)
         return data_url, url
 
-    def az_download_all(self, local_dir):
-        all_blob_name = list(self.list_blob_names())
-        all_blob_name = get_leaf_names(all_blob_name)
-        for blob_name in all_blob_name:
-            target_file = os.path.join(local_dir, blob_name)
-            if not op.isfile(target_file):
-                self.az_download(blob_name, target_file,
-                        sync=False)
+    def az_download_all(self, local_dir, num_threads=8):
+        """Download the whole container in one parallel pass, skipping files that are already identical.
+
+        Returns:
+            dict: transfer summary, see lib.storage.transfer_summary.
+        """
+        return self.download_prefix('', local_dir, num_threads=num_threads)
 
     def az_download(self, remote_path, local_path, sync=True, is_folder=False):
         ensure_directory(op.dirname(local_path))
@@ -200,7 +433,7 @@ class CloudStorage(object):
         ensure_directory(op.dirname(local_path))
         assert self.sas_token
         cmd = []
-        cmd.append(op.expanduser(config.AZCOPY_PATH))
+        cmd.append(get_azcopy())
         if sync:
             cmd.append('sync')
         else:
@@ -223,6 +456,46 @@ class CloudStorage(object):
         os.rename(local_path, origin_local_path)
         return data_url, url
 
+    def container_url(self, path=''):
+        """Url of a path in the container, with the SAS token for azcopy."""
+        assert self.sas_token and self.sas_token.startswith('?')
+        url = 'https://{}.blob.core.windows.net/{}'.format(self.account_name, self.container_name)
+        if path.strip('/'):
+            url = '/'.join([url, path.strip('/')])
+        return url + self.sas_token
+
+    def az_upload_files(self, local_dir, relative_paths, dest_dir='', concurrency=None, block_size_mb=None):
+        """Upload many files below a local directory with a single azcopy job.
+
+        Args:
+            local_dir (str): local directory the paths are relative to.
+            relative_paths (list): '/' separated paths of the files below local_dir.
+            dest_dir (str): blob name prefix the paths are uploaded below.
+            concurrency (int): parallel transfers of azcopy, None for its default.
+            block_size_mb (float): block size of the uploads, None for the azcopy default.
+
+        Returns:
+            dict: per-file status and transfer summary, see lib.azcopy.copy_batch.
+        """
+        return copy_batch(op.realpath(local_dir), self.container_url(dest_dir), relative_paths,
+                concurrency=concurrency, block_size_mb=block_size_mb)
+
+    def az_download_files(self, remote_dir, relative_paths, local_dir, concurrency=None):
+        """Download many blobs below a prefix with a single azcopy job.
+
+        Args:
+            remote_dir (str): blob name prefix the paths are relative to.
+            relative_paths (list): '/' separated blob names below remote_dir.
+            local_dir (str): local directory the blobs are downloaded to.
+            concurrency (int): parallel transfers of azcopy, None for its default.
+
+        Returns:
+            dict: per-file status and transfer summary, see lib.azcopy.copy_batch.
+        """
+        ensure_directory(local_dir)
+        return copy_batch(self.container_url(remote_dir), op.realpath(local_dir), relative_paths,
+                concurrency=concurrency)
+
     # def download_to_path(self, blob_name, local_path):
     #     dir_path = op.dirname(local_path)
         
@@ -1,33 +1,144 @@
 import subprocess
+import json
 import os
-from lib.cloud_storage import CloudStorage
+import tempfile
+from lib.extractor import InProcessDownloader
+from lib.storage import get_storage
+from lib.inventory import BlobInventory
+from lib.ledger import ERROR_DOWNLOAD, ERROR_FFMPEG, ERROR_UPLOAD, classify_error
+from lib.metrics import stage_timer
+from lib.output_index import OutputIndex
+from lib.frames import FrameShardWriter
+from lib.transcode import TranscodeProfile
 import lib.config as config
-import time
 
+INVENTORY_PATH = getattr(config, "INVENTORY_PATH", os.path.join(config.OUTPUT_ROOT, "inventory.db"))
+YOUTUBE_DL_PATH = getattr(config, "YOUTUBE_DL_PATH", "youtube-dl")
+# save videos in subdirectories named by this many leading characters of the id, 0 for a flat directory
+OUTPUT_FAN_OUT = getattr(config, "OUTPUT_FAN_OUT", 0)
+# local directory of frame shards before upload, and their size
+FRAMES_ROOT = getattr(config, "FRAMES_ROOT", os.path.join(config.OUTPUT_ROOT, "frames"))
+FRAME_SHARD_BYTES = getattr(config, "FRAME_SHARD_BYTES", 1 << 30)
 
-def download_video(video_id, download_path, video_format="mp4", log_file=None):
+# a keyframe this close to the requested start of a clip is treated as the start
+KEYFRAME_TOLERANCE = 0.05
+
+# how streamed videos are produced: one progressive stream from youtube-dl, or separate video and audio
+# streams muxed by ffmpeg into a fragmented mp4 (which needs no seekable output)
+STREAM_MODES = ("single", "muxed")
+
+# opened lazily, once per worker process
+inventory = None
+storage = None
+extractor = None
+# output directory to OutputIndex, built before the workers fork so they inherit it
+output_indexes = {}
+frame_writer = None
+
+
+def video_url(video_id):
+    return "https://youtube.com/watch?v={}".format(video_id)
+
+
+# audio streams that can be muxed into each container without re-encoding
+COMPATIBLE_AUDIO = {"mp4": "m4a", "webm": "webm"}
+
+
+def format_selector(video_format, match_container=False):
+    """
+    youtube-dl format selection.
+    :param video_format:        Container of the processed video.
+    :param match_container:     Prefer video and audio streams that both fit the container, so youtube-dl can merge
+                                them straight into it and no remux pass is needed afterwards.
+    :return:                    Format selection string.
+    """
+
+    if match_container and video_format in COMPATIBLE_AUDIO:
+        return "bestvideo[ext={0}]+bestaudio[ext={1}]/best[ext={0}]/bestvideo+bestaudio/best".format(
+            video_format, COMPATIBLE_AUDIO[video_format])
+    return "bestvideo[ext={}]+bestaudio/best".format(video_format)
+
+
+def get_extractor(video_format="mp4", log_file=None, youtube_dl_class=None, match_container=False):
+    """
+    In-process youtube-dl of the current process, created on first use.
+    :param video_format:        Format to download.
+    :param log_file:            Path to a log file for youtube-dl.
+    :param youtube_dl_class:    YoutubeDL replacement, e.g. a fake extractor writing local files.
+    :param match_container:     Select streams that merge straight into video_format.
+    :return:                    InProcessDownloader or None if no youtube-dl library is installed.
+    """
+
+    global extractor
+
+    if extractor is None:
+        try:
+            extractor = InProcessDownloader(format_selector(video_format, match_container),
+                                            youtube_dl_class=youtube_dl_class, log_file=log_file)
+        except ImportError as e:
+            print(f"Falling back to the youtube-dl command: {str(e)}")
+    return extractor
+
+
+def append_log(log_file, message):
+    if log_file is not None and message:
+        with open(log_file, "a") as f:
+            f.write(message)
+
+
+def fail(report, error_class, error=None):
+    """
+    Record why a video failed in the report of process_video.
+    :return:    False.
+    """
+
+    if report is not None:
+        report["error_class"] = error_class
+        report["error"] = error
+    return False
+
+
+def download_video(video_id, download_path, video_format="mp4", log_file=None, extractor=None, report=None,
+                   match_container=False):
     """
     Download video from YouTube.
     :param video_id:        YouTube ID of the video.
     :param download_path:   Where to save the video.
     :param video_format:    Format to download.
     :param log_file:        Path to a log file for youtube-dl.
+    :param extractor:       InProcessDownloader to use instead of running the youtube-dl command.
+    :param report:          Dictionary receiving the error class and message on failure.
+    :param match_container: Select streams that merge straight into video_format.
     :return:                Tuple: path to the downloaded video and a bool indicating success.
     """
 
-    if log_file is None:
-        stderr = subprocess.DEVNULL
-    else:
-        stderr = open(log_file, "a")
+    if extractor is not None:
+        if extractor.download(video_url(video_id), download_path):
+            return True
+        return fail(report, classify_error(extractor.last_error), extractor.last_error)
 
-    return_code = subprocess.call(
-        ["youtube-dl", "https://youtube.com/watch?v={}".format(video_id), "--quiet", "-f",
-        "bestvideo[ext={}]+bestaudio/best".format(video_format), "--output", download_path, "--no-continue"], stderr=stderr)
-    success = return_code == 0
-    if log_file is not None:
-        stderr.close()
+    # stderr is kept to tell unavailable videos from transient errors
+    result = subprocess.run(download_command(video_id, download_path, video_format, match_container),
+                            stderr=subprocess.PIPE)
+    error = result.stderr.decode("utf-8", "replace")
+    append_log(log_file, error)
+
+    if result.returncode == 0:
+        return True
+    return fail(report, classify_error(error), error.strip()[-1000:])
 
-    return success
+
+def download_command(video_id, download_path, video_format="mp4", match_container=False):
+    cmd = [YOUTUBE_DL_PATH, video_url(video_id), "--quiet", "-f",
+        format_selector(video_format, match_container), "--output", download_path, "--no-continue"]
+    # no --merge-output-format: when the selection falls back to streams that do not fit video_format
+    # (e.g. vp9 and opus), youtube-dl merges them into mkv, which is remuxed, instead of failing the merge
+    return cmd
+
+
+def remux_command(mkv_path, mp4_path):
+    return ["ffmpeg", "-y", "-i", mkv_path, "-map", "0", "-c", "copy", "-c:a", "aac", mp4_path, "-strict", "-2",
+            "-loglevel", "fatal"]
 
 
 def cut_video(raw_video_path, slice_path, start, end):
@@ -46,87 +157,601 @@ def cut_video(raw_video_path, slice_path, start, end):
 
     return success
 
-  
 
-def upload2blob(video_file):
-    blob_video = CloudStorage(config.STORAGE_ACCOUNT_NAME, "sports-1m", config.CONNECTION_STRING, config.SAS_TOKEN)
+def resolve_media_urls(video_id, video_format="mp4", log_file=None, match_container=False):
+    """
+    Resolve the direct media urls of a video without downloading it.
+    :param video_id:        YouTube ID of the video.
+    :param video_format:    Format to download.
+    :param log_file:        Path to a log file for youtube-dl.
+    :param match_container: Select streams that can be stream copied into video_format.
+    :return:                List of urls (video and audio for split formats, one url otherwise), empty on failure.
+    """
+
+    if log_file is None:
+        stderr = subprocess.DEVNULL
+    else:
+        stderr = open(log_file, "a")
+
+    result = subprocess.run([YOUTUBE_DL_PATH, video_url(video_id), "--quiet", "-f", format_selector(video_format, match_container), "-g"],
+                            stdout=subprocess.PIPE, stderr=stderr)
+    if log_file is not None:
+        stderr.close()
+
+    if result.returncode != 0:
+        return []
+    return result.stdout.decode("utf-8").split()
+
+
+def probe_keyframe(media_url, start, window=10):
+    """
+    Find the first video keyframe at or after a timestamp. Only the probed interval is fetched.
+    :param media_url:       Url (or path) of the video stream.
+    :param start:           Timestamp in seconds.
+    :param window:          How many seconds after start to search.
+    :return:                Keyframe timestamp, None if there is none in the window.
+    """
+
+    result = subprocess.run(["ffprobe", "-v", "error", "-select_streams", "v:0", "-skip_frame", "nokey",
+                             "-read_intervals", "{}%+{}".format(start, window),
+                             "-show_entries", "frame=best_effort_timestamp_time", "-of", "json", media_url],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if result.returncode != 0:
+        return None
+
+    probe = json.loads(result.stdout.decode("utf-8") or "{}")
+    times = [float(frame["best_effort_timestamp_time"]) for frame in probe.get("frames", [])
+             if "best_effort_timestamp_time" in frame]
+    keyframes = [t for t in times if t >= start - KEYFRAME_TOLERANCE]
+    return min(keyframes) if keyframes else None
+
+
+def clip_command(media_urls, clip_path, start, end, copy):
+    """
+    ffmpeg command cutting [start, end) out of remote streams. Seeking on the input makes ffmpeg
+    jump with http range requests instead of reading the video from the beginning.
+    """
+
+    cmd = ["ffmpeg", "-y", "-loglevel", "fatal"]
+    for media_url in media_urls:
+        cmd += ["-ss", str(start), "-i", media_url]
+    if len(media_urls) > 1:
+        cmd += ["-map", "0:v:0", "-map", "1:a:0"]
+    cmd += ["-t", str(end - start)]
+    if copy:
+        cmd += ["-c", "copy", "-avoid_negative_ts", "make_zero"]
+    else:
+        cmd += ["-c:v", "libx264", "-preset", "veryfast", "-c:a", "aac"]
+    return cmd + ["-strict", "-2", clip_path]
+
+
+def cut_clip_stream(media_urls, slice_path, start, end):
+    """
+    Cut a clip straight from the remote streams, so a clip costs about its own length in data.
+    A clip starting on a keyframe is stream copied, every other clip is re-encoded accurately
+    (a stream copy would start at the keyframe before start).
+    :param media_urls:    Urls returned by resolve_media_urls.
+    :param slice_path:    Where to save the clip.
+    :param start:         Start of the section.
+    :param end:           End of the section.
+    :return:              Bool indicating success.
+    """
+
+    start, end = float(start), float(end)
+    keyframe = probe_keyframe(media_urls[0], start, window=end - start)
+    copy = keyframe is not None and keyframe - start <= KEYFRAME_TOLERANCE
+
+    return_code = subprocess.call(clip_command(media_urls, slice_path, start, end, copy=copy))
+    return return_code == 0 and os.path.isfile(slice_path) and os.path.getsize(slice_path) > 0
+
+
+def blob_name(video_file):
+    """
+    Name of the blob a local video is uploaded to.
+    :param video_file:      Path to the local video.
+    :return:                Blob name made of the last three path components
+                            (not counting a fan-out subdirectory, blobs are never fanned out).
+    """
+
+    parts = video_file.split("/")
+    if OUTPUT_FAN_OUT and len(parts) > 1 and parts[-2] == parts[-1][:OUTPUT_FAN_OUT]:
+        del parts[-2]
+    return "/".join(parts[-3:])
+
+
+def blob_prefix(directory):
+    """
+    Blob name prefix of the videos saved in a local directory.
+    :param directory:       Local directory.
+    :return:                Blob name prefix ending with a slash.
+    """
+
+    prefix = os.path.dirname(blob_name(os.path.join(directory, "video_id.mp4")))
+    return prefix + "/" if prefix else ""
+
+
+def get_inventory():
+    global inventory
+
+    if inventory is None:
+        inventory = BlobInventory(INVENTORY_PATH)
+    return inventory
+
+
+def get_output_index(directory):
+    """
+    Index of a local output directory, scanned on first use.
+    :param directory:       Output directory.
+    :return:                OutputIndex.
+    """
+
+    if directory not in output_indexes:
+        output_indexes[directory] = OutputIndex(directory, fan_out=OUTPUT_FAN_OUT)
+    return output_indexes[directory]
+
+
+def index_output(path, present=True):
+    """
+    Record a created (or removed) output file in the index of its output directory, if there is one.
+    """
+
+    directory = os.path.dirname(path)
+    if OUTPUT_FAN_OUT:
+        parent = os.path.dirname(directory)
+        if parent in output_indexes:
+            directory = parent
+    if directory in output_indexes:
+        if present:
+            output_indexes[directory].add(path)
+        else:
+            output_indexes[directory].discard(path)
+
+
+def get_frame_writer():
+    """
+    Frame shard writer of the current process, created on first use. Shards are uploaded to the frames/
+    prefix of the container, apart from the videos.
+    :return:    FrameShardWriter.
+    """
+
+    global frame_writer
+
+    if frame_writer is None:
+        frame_writer = FrameShardWriter(FRAMES_ROOT, storage=get_storage_client(), max_bytes=FRAME_SHARD_BYTES)
+    return frame_writer
+
+
+def close_frame_writer():
+    """
+    Finish and upload the open frame shard of the current process, called when a worker exits.
+    :return:    Videos of the frames-only mode whose shard was finished, see stored_frame_videos.
+    """
+
+    global frame_writer
+
+    finished = []
+    if frame_writer is not None:
+        frame_writer.close()
+        finished = frame_writer.take_finished()
+        frame_writer = None
+    return finished
+
+
+def stored_frame_videos():
+    """
+    Videos of the frames-only mode whose frame shard was finished since the last call. They are only
+    done once their shard is stored, their frames are lost with a partly filled shard.
+    :return:    List of (video id, bool indicating the shard was stored) tuples.
+    """
+
+    if frame_writer is None:
+        return []
+    return frame_writer.take_finished()
+
+
+def get_storage_client():
+    """
+    Storage client of the current process, created on first use and reused for every upload
+    so its connection pool survives across videos.
+    :return:    StorageBackend.
+    """
+
+    global storage
+
+    if storage is None:
+        storage = get_storage("sports-1m")
+    return storage
+
+
+def upload2blob(video_file, report=None):
+    """
+    Upload a video and delete the local copy once the blob is complete.
+    :param video_file:      Path to the local video.
+    :param report:          Dictionary receiving the time spent uploading and deleting.
+    :return:                Bool indicating success.
+    """
+
+    name = blob_name(video_file)
     try:
-        blob_video.upload_file(video_file, "/".join(video_file.split("/")[-3:]))
-        time.sleep(1)
-        os.remove(video_file)
+        blob_video = get_storage_client()
+        with stage_timer(report, "upload"):
+            try:
+                blob_video.upload_file(video_file, name)
+            except Exception:
+                # an earlier attempt may have stored the blob before it failed, e.g. on a lost response
+                if not blob_video.exists(name) or blob_video.get_size(name) != os.path.getsize(video_file):
+                    raise
+            # the local copy is only removed once the stored blob has the full size
+            if blob_video.get_size(name) != os.path.getsize(video_file):
+                raise IOError("incomplete upload of {}".format(name))
+        get_inventory().add(name)
+        with stage_timer(report, "delete"):
+            os.remove(video_file)
+        index_output(video_file, present=False)
     except Exception as e:
-        print(f"Failed to remove {video_file}: {str(e)}")
-        pass
+        print(f"Failed to upload {video_file}: {str(e)}")
+        return False
+
+    return True
+
+
+def fetched(report, video_path):
+    index_output(video_path)
+    if report is not None:
+        report["container"] = os.path.splitext(video_path)[1][1:]
+    return video_path
 
 
-def process_video(video_id, directory, start=None, end=None, video_format="mp4", compress=False, overwrite=False, log_file=None):
+def fetch_video(video_id, directory, start=None, end=None, video_format="mp4", overwrite=False, log_file=None,
+                extractor=None, clip_mode=False, report=None, match_container=False):
     """
-    Process one video for the kinetics dataset.
-    :param video_id:        YouTube ID of the video.
-    :param directory:       Directory where to save the video.
-    :param start:           Start of the section of interest.
-    :param end:             End of the section of interest.
-    :param video_format:    Format of the processed video.
-    :param compress:        Decides if the video slice should be compressed by gzip.
-    :param overwrite:       Overwrite processed videos.
-    :param log_file:        Path to a log file for youtube-dl.
-    :return:                Bool indicating success.
+    Download stage of process_video: network bound, no local transcoding except clips cut in clip mode.
+    :return:                Tuple: bool indicating success and the path to the fetched video
+                            (None when the video was already processed). report["container"] receives
+                            the container the video was fetched in.
     """
 
+    download_path = prepare_output(video_id, directory, video_format, overwrite)
+    if download_path is None:
+        return True, None
+    index = get_output_index(directory)
+
+    if clip_mode and has_section(start, end):
+        with stage_timer(report, "download"):
+            media_urls = resolve_media_urls(video_id, video_format, log_file=log_file, match_container=match_container)
+        if not media_urls:
+            return fail(report, ERROR_DOWNLOAD, "could not resolve media urls"), None
+        with stage_timer(report, "cut"):
+            success = cut_clip_stream(media_urls, download_path, start, end)
+        if not success:
+            return fail(report, ERROR_FFMPEG, "could not cut the clip"), None
+        return True, fetched(report, download_path)
+
+    # sometimes videos are downloaded as mkv
+    if not index.has(video_id, "mkv"):
+        # download video and cut out the section of interest
+        with stage_timer(report, "download"):
+            success = download_video(video_id, download_path, video_format=video_format, log_file=log_file,
+                                     extractor=extractor, report=report, match_container=match_container)
+
+        if not success:
+            return False, None
+
+    return find_download(download_path, report)
+
+
+def prepare_output(video_id, directory, video_format="mp4", overwrite=False):
+    """
+    Make way for fetching a video: residual downloads are removed, an existing output is removed or kept.
+    :return:                Path to download the video to, None when the video was already processed.
+    """
+
+    # existing outputs are looked up in the index instead of listing the directory for every video
+    index = get_output_index(directory)
+    directory = index.directory_of(video_id)
+    if OUTPUT_FAN_OUT:
+        os.makedirs(directory, exist_ok=True)
+
     download_path = "{}.{}".format(os.path.join(directory, video_id), video_format)
-    mkv_download_path = "{}.mkv".format(os.path.join(directory, video_id))
-    slice_path = "{}.{}".format(os.path.join(directory, video_id), video_format)
 
     # simply delete residual downloaded videos
-    if os.path.isfile(download_path):
-        os.remove(download_path)
+    for residual_path in index.paths(video_id, video_format):
+        os.remove(residual_path)
+        index.discard(residual_path)
 
     # if sliced video already exists, decide what to do next
-    img_files = [f_name for f_name in os.listdir(os.path.dirname(slice_path)) if f_name.endswith(".jpg") and f_name.startswith(video_id)]
-    if img_files:
-        return True
-    if os.path.isfile(slice_path):
+    if index.has(video_id, "jpg"):
+        return None
+    if index.has(video_id, video_format):
         if overwrite:
-            os.remove(slice_path)
+            os.remove(download_path)
+            index.discard(download_path)
         else:
-            return True
+            return None
+    return download_path
 
-    # sometimes videos are downloaded as mkv
-    if not os.path.isfile(mkv_download_path):
-        # download video and cut out the section of interest
-        success = download_video(video_id, download_path, log_file=log_file)
 
-        if not success:
-            return False
+def find_download(download_path, report=None):
+    """
+    Locate a finished download, which youtube-dl may have saved as mkv instead.
+    :return:                Tuple: bool indicating success and the path to the video.
+    """
+
+    mkv_download_path = "{}.mkv".format(os.path.splitext(download_path)[0])
 
     # video was downloaded as mkv instead of mp4
     if not os.path.isfile(download_path) and os.path.isfile(mkv_download_path):
-        download_path = mkv_download_path
+        return True, fetched(report, mkv_download_path)
+
+    if not os.path.isfile(download_path):
+        return fail(report, ERROR_DOWNLOAD, "no video at {}".format(download_path)), None
+    return True, fetched(report, download_path)
+
+
+def has_section(start, end):
+    # a section may start at 0
+    return start is not None and end is not None
+
+
+def needs_transcode(video_path, start=None, end=None, compress=False, clip_mode=False, frames=None):
+    """
+    Whether a fetched video still needs CPU bound ffmpeg work before it can be stored.
+    """
+
+    return (video_path.endswith(".mkv") or (has_section(start, end) and not clip_mode) or bool(compress)
+            or frames is not None)
+
+
+def transcode_video(video_id, video_path, start=None, end=None, compress=False, clip_mode=False, report=None,
+                    frames=None, keep_videos=True):
+    """
+    Transcoding stage of process_video: remux mkv to mp4, cut the section of interest, compress and sample frames.
+    :param compress:        TranscodeProfile (True for the default profile) of a compact version of the video;
+                            report["compression"] receives its size reduction and encode throughput.
+    :param frames:          FrameSampler whose frames are appended to the frame shards of this process, None to skip.
+    :param keep_videos:     Store the video besides its frames; otherwise it is deleted once its frames are written.
+    :return:                Tuple: bool indicating success and the path to the transcoded video, a list of paths
+                            when both the original and the compact version are stored (None when only frames are kept).
+    """
+
+    # video was downloaded as mkv instead of mp4
+    if video_path.endswith(".mkv"):
+        mkv_download_path = video_path
         mp4file = mkv_download_path.replace("mkv", "mp4")
-        convert_mkv2mp4 = ["ffmpeg", "-y", "-i", mkv_download_path, "-map", "0", "-c", "copy", "-c:a", "aac", mp4file, "-strict", "-2", "-loglevel", "fatal"]
-        subprocess.run(convert_mkv2mp4)
-        download_path = mp4file
+        with stage_timer(report, "remux"):
+            subprocess.run(remux_command(mkv_download_path, mp4file))
         os.remove(mkv_download_path)
-    
-    upload2blob(download_path)
-
-    if start and end:
-        success = cut_video(download_path, slice_path, start, end)
+        index_output(mkv_download_path, present=False)
+        if not os.path.isfile(mp4file):
+            return fail(report, ERROR_FFMPEG, "could not remux {}".format(mkv_download_path)), None
+        video_path = mp4file
+        index_output(video_path)
+
+    if has_section(start, end) and not clip_mode:
+        # the slice replaces the whole video
+        cut_path = "{}.cut{}".format(*os.path.splitext(video_path))
+        with stage_timer(report, "cut"):
+            success = cut_video(video_path, cut_path, start, end)
 
         if not success:
-            return False
+            return fail(report, ERROR_FFMPEG, "could not cut the video"), None
+        os.replace(cut_path, video_path)
 
-    # remove the downloaded video
-    # os.remove(mp4file)
+    outputs = [video_path]
+    if compress:
+        profile = compress if isinstance(compress, TranscodeProfile) else TranscodeProfile()
+        compact_path = "{}.compact{}".format(*os.path.splitext(video_path))
+        with stage_timer(report, "compress"):
+            compression = profile.encode(video_path, compact_path)
+        if compression is None:
+            return fail(report, ERROR_FFMPEG, "could not compress {}".format(video_path)), None
+        index_output(compact_path)
+        if report is not None:
+            report["compression"] = compression
+        outputs = keep_variants(video_path, compact_path, profile.upload)
+
+    if frames is not None:
+        with stage_timer(report, "frames"):
+            video_frames = frames.extract(outputs[0])
+            if video_frames is None:
+                return fail(report, ERROR_FFMPEG, "could not extract frames of {}".format(video_path)), None
+            get_frame_writer().add_video(video_id, video_frames, track=not keep_videos)
+        if report is not None:
+            report["frames"] = len(video_frames)
+            # without the video, nothing is stored until the frame shard is
+            report["queued_frames"] = not keep_videos
+        if not keep_videos:
+            for path in outputs:
+                os.remove(path)
+                index_output(path, present=False)
+            return True, None
+
+    return True, outputs[0] if len(outputs) == 1 else outputs
+
+
+def keep_variants(video_path, compact_path, upload):
+    """
+    Remove the variants of a compressed video that are not stored.
+    :param upload:          Stored variant: original, compact or both.
+    :return:                List of paths of the stored variants; a compact version stored alone
+                            takes the place (and path) of the original.
+    """
 
+    if upload == "both":
+        return [video_path, compact_path]
+    if upload == "compact":
+        os.replace(compact_path, video_path)
+    else:
+        os.remove(compact_path)
+    index_output(compact_path, present=False)
+    return [video_path]
 
-    if compress:
-        # compress the video slice
-        pass
+
+def store_video(video_id, video_path, upload_queue=None, report=None):
+    """
+    Upload stage of process_video.
+    :param video_path:      Path to the video, or list of paths of all its stored variants.
+    :param report:          Dictionary receiving the bytes and the paths to store, which a retry uploads
+                            again without fetching the video.
+    :return:                Bool indicating success.
+    """
+
+    if report is not None:
+        report["bytes"] = sum(os.path.getsize(path) for path in as_paths(video_path))
+        # kept for a retry of a failed upload
+        report["video_path"] = video_path
+
+    if upload_queue is not None:
+        # blocks while the upload stage is behind
+        upload_queue.put((video_id, video_path))
+        if report is not None:
+            report["queued_upload"] = True
+    elif not all([upload2blob(path, report=report) for path in as_paths(video_path)]):
+        return fail(report, ERROR_UPLOAD)
 
     return True
 
 
+def as_paths(video_path):
+    return [video_path] if isinstance(video_path, str) else video_path
+
+
+def can_stream(start=None, end=None, compress=False, frames=None):
+    """
+    Whether a video needs no post-processing and can be streamed straight to storage.
+    """
+
+    return not has_section(start, end) and not compress and frames is None
+
+
+def stream_command(video_id, video_format="mp4", log_file=None, mode="single", report=None):
+    """
+    Command writing a video to stdout.
+    :return:                List of arguments, None if the media urls of muxed mode could not be resolved.
+    """
+
+    if mode == "single":
+        # youtube-dl cannot merge separate streams into stdout, so take the best progressive stream; there is
+        # no fallback to other containers, the blob is named and reported as video_format
+        return [YOUTUBE_DL_PATH, video_url(video_id), "--quiet", "-f",
+                "best[ext={}]".format(video_format), "--output", "-"]
+
+    with stage_timer(report, "download"):
+        media_urls = resolve_media_urls(video_id, video_format, log_file=log_file, match_container=True)
+    if not media_urls:
+        return None
+    cmd = ["ffmpeg", "-loglevel", "error"]
+    for media_url in media_urls:
+        cmd += ["-i", media_url]
+    for index in range(len(media_urls)):
+        cmd += ["-map", str(index)]
+    return cmd + ["-c", "copy", "-movflags", "frag_keyframe+empty_moov+default_base_moof", "-f", "mp4", "pipe:1"]
+
+
+def stream_video(video_id, directory, video_format="mp4", overwrite=False, log_file=None, mode="single", report=None):
+    """
+    Download a video into its blob without touching the local disk: the output of the downloader is uploaded
+    while it is produced, holding only a few blocks in memory. Only for videos that need no post-processing.
+    :param video_id:        YouTube ID of the video.
+    :param directory:       Directory the video would be saved to, determines the blob name.
+    :param video_format:    Format of the video, mp4 in muxed mode.
+    :param overwrite:       Overwrite stored videos.
+    :param log_file:        Path to a log file for youtube-dl and ffmpeg.
+    :param mode:            single or muxed, see STREAM_MODES.
+    :param report:          Dictionary receiving the error class and message on failure and the number of
+                            bytes of the stored video.
+    :return:                Bool indicating success.
+    """
+
+    if mode not in STREAM_MODES:
+        raise ValueError("mode must be one of {}, got {}".format(", ".join(STREAM_MODES), mode))
+    if mode == "muxed":
+        video_format = "mp4"
+    if not overwrite and video_id in get_inventory():
+        return True
+
+    cmd = stream_command(video_id, video_format, log_file=log_file, mode=mode, report=report)
+    if cmd is None:
+        return fail(report, ERROR_DOWNLOAD, "could not resolve media urls")
+
+    name = blob_name("{}.{}".format(os.path.join(directory, video_id), video_format))
+    storage = get_storage_client()
+    # stderr is small and read only once the stream ended, a pipe could fill up and block the downloader
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+        try:
+            with stage_timer(report, "stream"):
+                # nothing is committed unless the downloader exits cleanly
+                stats = storage.upload_stream(process.stdout, name, overwrite=overwrite,
+                                              complete=lambda: process.wait() == 0)
+        except Exception as e:
+            failed_download = process.poll() not in (None, 0)
+            process.kill()
+            process.wait()
+            stderr.seek(0)
+            error = stderr.read().decode("utf-8", "replace")
+            append_log(log_file, error)
+            if failed_download:
+                return fail(report, classify_error(error), error.strip()[-1000:])
+            # the blob was stored by an earlier run but is missing from the inventory snapshot
+            if overwrite or not storage.exists(name):
+                return fail(report, ERROR_UPLOAD, str(e))
+            stats = {"bytes": storage.get_size(name)}
+        finally:
+            process.stdout.close()
+
+    get_inventory().add(name)
+    if report is not None:
+        report["bytes"] = stats["bytes"]
+        report["container"] = video_format
+    return True
+
+
+def process_video(video_id, directory, start=None, end=None, video_format="mp4", compress=False, overwrite=False, log_file=None,
+                  upload_queue=None, extractor=None, clip_mode=False, report=None, match_container=False, frames=None,
+                  keep_videos=True):
+    """
+    Process one video for the kinetics dataset.
+    :param video_id:        YouTube ID of the video.
+    :param directory:       Directory where to save the video.
+    :param start:           Start of the section of interest.
+    :param end:             End of the section of interest.
+    :param video_format:    Format of the processed video.
+    :param compress:        TranscodeProfile (True for the default profile) of a compact version of the video.
+    :param overwrite:       Overwrite processed videos.
+    :param log_file:        Path to a log file for youtube-dl.
+    :param upload_queue:    Hand the video to this upload stage queue instead of uploading it here.
+    :param extractor:       InProcessDownloader to use instead of running the youtube-dl command.
+    :param clip_mode:       When start and end are given, cut the section from the remote streams
+                            instead of downloading the whole video.
+    :param report:          Dictionary receiving the error class and message on failure, the number of bytes
+                            of the stored video and whether it was handed to the upload stage.
+    :param match_container: Select streams youtube-dl can merge straight into video_format, avoiding the
+                            mkv to mp4 remux.
+    :param frames:          FrameSampler to pack sampled frames into shards, None to skip.
+    :param keep_videos:     Store the videos besides their frames.
+    :return:                Bool indicating success.
+    """
+
+    success, video_path = fetch_video(video_id, directory, start, end, video_format=video_format, overwrite=overwrite,
+                                      log_file=log_file, extractor=extractor, clip_mode=clip_mode, report=report,
+                                      match_container=match_container)
+    if not success:
+        return False
+    if video_path is None:
+        return True
+
+    if needs_transcode(video_path, start, end, compress, clip_mode, frames):
+        success, video_path = transcode_video(video_id, video_path, start, end, compress=compress, clip_mode=clip_mode,
+                                              report=report, frames=frames, keep_videos=keep_videos)
+        if not success:
+            return False
+        if video_path is None:
+            return True
+
+    return store_video(video_id, video_path, upload_queue=upload_queue, report=report)
+
+
 def video_worker(videos_queue, failed_queue, compress, log_file):
     """
     Downloads videos pass in the videos queue.
@@ -239,16 +864,19 @@ class Pool:
       self.failed_queue.put(None)
       self.failed_save_worker.join()
 
-def download_class_parallel(class_name, videos_list, directory, videos_queue):
+def download_class_parallel(class_name, videos_list, directory, videos_queue, section=None):
   """
   Download all videos of the given class in parallel.
   :param class_name:        Name of the class.
   :param videos_list:       List of all videos.
   :param directory:         Where to save the videos.
   :param videos_queue:      Videos queue for parallel download.
+  :param section:           Tuple (start, end) in seconds: only keep this section of every video, None for whole videos.
   :return:                  None.
   """
 
+  start, end = section or (None, None)
+
   if class_name is None:
     class_dir = directory
   else:
@@ -263,4 +891,4 @@ def download_class_parallel(class_name, videos_list, directory, videos_queue):
 
   for video in videos_list:
 
-      videos_queue.put((video, class_dir, None, None))
\ No newline at end of file
+      videos_queue.put((video, class_dir, start, end))
\ No newline at end of file
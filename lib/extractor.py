@@ -0,0 +1,109 @@
+import importlib
+
+
+def load_youtube_dl():
+    """
+    Find the YoutubeDL class of an installed downloader library.
+    :return:    yt_dlp.YoutubeDL or youtube_dl.YoutubeDL, None if neither is installed.
+    """
+
+    for module_name in ("yt_dlp", "youtube_dl"):
+        try:
+            return importlib.import_module(module_name).YoutubeDL
+        except ImportError:
+            pass
+    return None
+
+
+class FileLogger:
+    """
+    youtube-dl logger appending messages to a log file, like the stderr of the command line tool.
+    """
+
+    def __init__(self, log_file):
+        self.log_file = log_file
+
+    def write(self, message):
+        with open(self.log_file, "a") as f:
+            f.write(message + "\n")
+
+    def debug(self, message):
+        pass
+
+    def warning(self, message):
+        self.write(message)
+
+    def error(self, message):
+        self.write(message)
+
+
+class QuietLogger:
+
+    def debug(self, message):
+        pass
+
+    def warning(self, message):
+        pass
+
+    def error(self, message):
+        pass
+
+
+class InProcessDownloader:
+    """
+    Downloads videos through the youtube-dl Python API.
+
+    One YoutubeDL instance is kept for the lifetime of a worker, so the interpreter start-up,
+    extractor imports and the HTTP session are paid once instead of once per video.
+    """
+
+    def __init__(self, format_selector, youtube_dl_class=None, log_file=None, merge_output_format=None):
+        """
+        :param format_selector:     youtube-dl format selection.
+        :param youtube_dl_class:    Class (or factory) called with the options dict, defaults to load_youtube_dl().
+                                    Has to provide a params dict and a download(urls) method.
+        :param log_file:            Path to a log file for youtube-dl.
+        :param merge_output_format: Container separate video and audio streams are merged into, None to let
+                                    youtube-dl pick one (mkv when they do not fit together).
+        """
+
+        if youtube_dl_class is None:
+            youtube_dl_class = load_youtube_dl()
+        if youtube_dl_class is None:
+            raise ImportError("neither yt_dlp nor youtube_dl is installed")
+
+        self.ydl = youtube_dl_class({
+            "format": format_selector,
+            "quiet": True,
+            "no_warnings": log_file is None,
+            "noprogress": True,
+            "continuedl": False,
+            "logger": QuietLogger() if log_file is None else FileLogger(log_file),
+            "merge_output_format": merge_output_format,
+        })
+        self.last_error = None
+
+    def set_output(self, download_path):
+        # the output path is an output template, a literal % has to be escaped
+        template = download_path.replace("%", "%%")
+        if isinstance(self.ydl.params.get("outtmpl"), dict):
+            # yt-dlp keeps one template per output type
+            self.ydl.params["outtmpl"]["default"] = template
+        else:
+            self.ydl.params["outtmpl"] = template
+
+    def download(self, url, download_path):
+        """
+        Download one video.
+        :param url:                 Url of the video.
+        :param download_path:       Where to save the video.
+        :return:                    Bool indicating success.
+        """
+
+        self.set_output(download_path)
+        self.last_error = None
+        try:
+            return self.ydl.download([url]) == 0
+        except Exception as e:
+            self.last_error = str(e)
+            return False
@@ -0,0 +1,220 @@
+import io
+import mmap
+import os
+import socket
+import subprocess
+import tarfile
+
+from lib.transcode import scale_filter
+
+# frames of a shard are uploaded once it is this large
+DEFAULT_SHARD_BYTES = 1 << 30
+
+JPEG_START = b"\xff\xd8"
+JPEG_END = b"\xff\xd9"
+
+
+def split_jpegs(stream, chunk_size=1 << 16):
+    """
+    Split a concatenated mjpeg stream (ffmpeg -f image2pipe -c:v mjpeg) into single JPEG images.
+    Entropy coded JPEG data escapes every 0xff byte, so an end of image marker only appears at the end of an image.
+    :param stream:      Binary file object.
+    :param chunk_size:  Bytes read at once.
+    :return:            Generator of JPEG images as bytes.
+    """
+
+    buffer = b""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        buffer += chunk
+        while True:
+            start = buffer.find(JPEG_START)
+            end = buffer.find(JPEG_END, start + 2) if start >= 0 else -1
+            if end < 0:
+                break
+            yield buffer[start:end + 2]
+            buffer = buffer[end + 2:]
+
+
+class FrameSampler:
+    """
+    Samples frames of a video with ffmpeg at a fixed rate and size, encoded as JPEG.
+    """
+
+    def __init__(self, fps=1.0, short_side=256, quality=3):
+        """
+        :param fps:         Frames per second of video.
+        :param short_side:  Height of landscape (width of portrait) frames in pixels, None for the original size.
+        :param quality:     JPEG quality of ffmpeg, 2 (best) to 31.
+        """
+
+        self.fps = fps
+        self.short_side = short_side
+        self.quality = quality
+
+    def video_filter(self):
+        filters = ["fps={}".format(self.fps)]
+        if self.short_side:
+            filters.append(scale_filter(self.short_side))
+        return ",".join(filters)
+
+    def command(self, video_path):
+        return ["ffmpeg", "-loglevel", "fatal", "-i", video_path, "-vf", self.video_filter(),
+                "-f", "image2pipe", "-c:v", "mjpeg", "-q:v", str(self.quality), "-"]
+
+    def extract(self, video_path):
+        """
+        Sample the frames of a video.
+        :param video_path:  Path to the video.
+        :return:            List of JPEG images as bytes, None if ffmpeg failed.
+        """
+
+        process = subprocess.Popen(self.command(video_path), stdout=subprocess.PIPE)
+        frames = list(split_jpegs(process.stdout))
+        process.stdout.close()
+        if process.wait() != 0 or not frames:
+            return None
+        return frames
+
+
+class FrameShardWriter:
+    """
+    Packs frames of many videos into large uncompressed tar shards (readable by WebDataset)
+    next to an index of the byte range of every frame, so training can memory-map a shard and
+    read frames without copying or opening a file per frame.
+
+    Frames of one video never span two shards. Finished shards are uploaded with their index
+    and deleted locally; the videos of a shard can be tracked until then, so they are only
+    counted as stored once their shard is.
+    """
+
+    def __init__(self, directory, storage=None, blob_prefix="frames/", max_bytes=DEFAULT_SHARD_BYTES, name=None):
+        """
+        :param directory:       Local directory the shards are written to.
+        :param storage:         StorageBackend the finished shards are uploaded to, None to keep them locally.
+        :param blob_prefix:     Blob name prefix of the shards.
+        :param max_bytes:       A shard is finished once it holds this many bytes.
+        :param name:            Name of the shards of this writer, unique among all writers;
+                                defaults to the host name and process id.
+        """
+
+        self.directory = directory
+        self.storage = storage
+        self.blob_prefix = blob_prefix
+        self.max_bytes = max_bytes
+        self.name = name if name is not None else "{}-{}".format(socket.gethostname(), os.getpid())
+        self.sequence = 0
+        self.tar = None
+        self.path = None
+        self.index = []
+        # tracked videos of the open shard, and of the finished shards with whether they were stored
+        self.videos = []
+        self.finished = []
+        os.makedirs(directory, exist_ok=True)
+
+    def open(self):
+        self.path = os.path.join(self.directory, "{}-{:06d}.tar".format(self.name, self.sequence))
+        self.sequence += 1
+        self.tar = tarfile.open(self.path, "w", format=tarfile.USTAR_FORMAT)
+        self.index = []
+
+    def add(self, key, data):
+        info = tarfile.TarInfo(key)
+        info.size = len(data)
+        self.tar.addfile(info, io.BytesIO(data))
+        # the data ends the archive written so far, padded to whole blocks
+        offset = self.tar.offset - -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        self.index.append((key, offset, len(data)))
+
+    def add_video(self, video_id, frames, track=False):
+        """
+        Append the frames of one video, named <video_id>.<frame number>.jpg.
+        :param video_id:    YouTube ID of the video.
+        :param frames:      List of JPEG images as bytes.
+        :param track:       Report the video by take_finished once its shard is finished.
+        :return:            Number of frames written.
+        """
+
+        if self.tar is None:
+            self.open()
+        for number, frame in enumerate(frames):
+            self.add("{}.{:06d}.jpg".format(video_id, number), frame)
+        if track:
+            self.videos.append(video_id)
+        if self.tar.offset >= self.max_bytes:
+            self.finish()
+        return len(frames)
+
+    def finish(self):
+        """
+        Close the current shard, write its index and upload both.
+        :return:    Path of the finished shard, None if no shard was open.
+        """
+
+        if self.tar is None:
+            return None
+        self.tar.close()
+        self.tar = None
+        index_path = os.path.splitext(self.path)[0] + ".idx"
+        with open(index_path, "w") as f:
+            f.writelines("{}\t{}\t{}\n".format(*entry) for entry in self.index)
+
+        stored = True
+        if self.storage is not None:
+            for path in (self.path, index_path):
+                try:
+                    self.storage.upload_file(path, self.blob_prefix + os.path.basename(path))
+                    os.remove(path)
+                except Exception as e:
+                    print(f"Failed to upload {path}: {str(e)}")
+                    stored = False
+        self.finished.extend((video_id, stored) for video_id in self.videos)
+        self.videos = []
+        return self.path
+
+    def take_finished(self):
+        """
+        Tracked videos whose shard was finished since the last call.
+        :return:    List of (video id, bool indicating the shard was stored) tuples.
+        """
+
+        finished, self.finished = self.finished, []
+        return finished
+
+    def close(self):
+        self.finish()
+
+
+class FrameShard:
+    """
+    Memory-mapped frame shard written by FrameShardWriter.
+    """
+
+    def __init__(self, path):
+        """
+        :param path:    Path to the .tar shard, its index is expected next to it with an .idx extension.
+        """
+
+        self.offsets = {}
+        with open(os.path.splitext(path)[0] + ".idx", "r") as f:
+            for line in f:
+                key, offset, size = line.rstrip("\n").split("\t")
+                self.offsets[key] = (int(offset), int(size))
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def keys(self):
+        return self.offsets.keys()
+
+    def __getitem__(self, key):
+        offset, size = self.offsets[key]
+        return memoryview(self.map)[offset:offset + size]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
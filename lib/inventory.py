@@ -0,0 +1,154 @@
+import logging
+import os
+import sqlite3
+import string
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# every YouTube id starts with one of these 64 characters, so listing "<prefix><char>" for each of them
+# covers the whole container and the listings can run in parallel
+SHARD_CHARACTERS = string.ascii_uppercase + string.ascii_lowercase + string.digits + "-_"
+
+
+def video_id_from_blob(blob_name):
+    """
+    Recover the video id from a blob name such as OUTPUT/videos/<video_id>.mp4 or <video_id>.compact.mp4.
+    :param blob_name:   Name of the blob.
+    :return:            Video id.
+    """
+
+    # video ids never contain a dot
+    return os.path.basename(blob_name).split(".", 1)[0]
+
+
+class BlobInventory:
+    """
+    Persistent local index of the videos stored in the blob container.
+
+    The index is kept in SQLite, listed per id-prefix shard and updated with every successful upload,
+    so a restart only has to list the shards that are missing or considered stale.
+    """
+
+    def __init__(self, path):
+        """
+        :param path:    Path to the SQLite file of the index.
+        """
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS videos (video_id TEXT PRIMARY KEY, blob_name TEXT NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS shards (prefix TEXT PRIMARY KEY, listed_at REAL)")
+        self.connection.commit()
+
+    def stale_shards(self, prefix="", max_age=None):
+        """
+        Shards that have to be listed again.
+        :param prefix:      Blob name prefix under which the videos are stored.
+        :param max_age:     Re-list shards listed more than max_age seconds ago. None lists only shards that were never listed.
+        :return:            List of shard prefixes.
+        """
+
+        with self.lock:
+            listed = dict(self.connection.execute("SELECT prefix, listed_at FROM shards"))
+
+        now = time.time()
+        stale = []
+        for character in SHARD_CHARACTERS:
+            shard = prefix + character
+            listed_at = listed.get(shard)
+            if listed_at is None or (max_age is not None and now - listed_at > max_age):
+                stale.append(shard)
+        return stale
+
+    def refresh(self, storage, prefix="", max_age=None, num_threads=16):
+        """
+        List the stale shards in parallel and replace their entries in the index.
+        :param storage:         Object with a list_blob_names(name_starts_with) method, e.g. a StorageBackend.
+        :param prefix:          Blob name prefix under which the videos are stored.
+        :param max_age:         Re-list shards listed more than max_age seconds ago. None lists only shards that were never listed.
+        :param num_threads:     How many shards to list in parallel.
+        :return:                Number of shards listed.
+        """
+
+        shards = self.stale_shards(prefix, max_age)
+        if not shards:
+            return 0
+
+        def list_shard(shard):
+            started = time.time()
+            names = storage.list_blob_names(name_starts_with=shard)
+            self.replace_shard(shard, names, started)
+            return len(names)
+
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            total = sum(executor.map(list_shard, shards))
+
+        logging.info("listed {} shards with {} blobs".format(len(shards), total))
+        return len(shards)
+
+    def replace_shard(self, shard, blob_names, listed_at=None):
+        """
+        Replace all entries of a shard with the result of a listing.
+        :param shard:       Shard prefix.
+        :param blob_names:  Names of all blobs in the shard.
+        :param listed_at:   When the listing started.
+        :return:            None.
+        """
+
+        rows = [(video_id_from_blob(name), name) for name in blob_names]
+        with self.lock:
+            with self.connection:
+                self.connection.execute("DELETE FROM videos WHERE blob_name >= ? AND blob_name < ?", (shard, shard + "\uffff"))
+                self.connection.executemany("INSERT OR REPLACE INTO videos VALUES (?, ?)", rows)
+                self.connection.execute("INSERT OR REPLACE INTO shards VALUES (?, ?)",
+                                        (shard, time.time() if listed_at is None else listed_at))
+
+    def invalidate(self, prefix=""):
+        """
+        Force the shards under the given prefix to be listed again on the next refresh.
+        :param prefix:      Blob name prefix.
+        :return:            None.
+        """
+
+        with self.lock:
+            with self.connection:
+                self.connection.execute("DELETE FROM shards WHERE prefix >= ? AND prefix < ?", (prefix, prefix + "\uffff"))
+
+    def add(self, blob_name):
+        """
+        Record a successful upload.
+        :param blob_name:   Name of the uploaded blob.
+        :return:            None.
+        """
+
+        with self.lock:
+            with self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO videos VALUES (?, ?)", (video_id_from_blob(blob_name), blob_name))
+
+    def remove(self, blob_name):
+        with self.lock:
+            with self.connection:
+                self.connection.execute("DELETE FROM videos WHERE blob_name = ?", (blob_name,))
+
+    def video_ids(self):
+        """
+        All stored video ids.
+        :return:    Set of video ids.
+        """
+
+        with self.lock:
+            return {row[0] for row in self.connection.execute("SELECT video_id FROM videos")}
+
+    def __contains__(self, video_id):
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM videos WHERE video_id = ?", (video_id,)).fetchone() is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM videos").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
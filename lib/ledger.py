@@ -0,0 +1,255 @@
+import queue
+import re
+import sqlite3
+import time
+
+from lib.metrics import PipelineMetrics
+
+# states of a video in the ledger
+PENDING = "pending"
+IN_PROGRESS = "in_progress"
+TRANSCODING = "transcoding"
+UPLOADING = "uploading"
+DONE = "done"
+FAILED = "failed"
+UNAVAILABLE = "unavailable"
+
+# videos in these states are not attempted again
+FINISHED_STATES = (DONE, UNAVAILABLE)
+
+# a video handed to the next stage may be reported by that stage before the handoff itself,
+# the late handoff event must not move it back
+LATER_STATES = {TRANSCODING: (UPLOADING, DONE, FAILED), UPLOADING: (DONE, FAILED)}
+
+# error classes; only unavailable videos are failed for good, everything else is retried
+ERROR_UNAVAILABLE = "unavailable"
+ERROR_THROTTLED = "throttled"
+ERROR_DOWNLOAD = "download"
+ERROR_UPLOAD = "upload"
+ERROR_FFMPEG = "ffmpeg"
+PERMANENT_ERRORS = (ERROR_UNAVAILABLE,)
+
+UNAVAILABLE_PATTERN = re.compile("|".join([
+    r"video unavailable",
+    r"private video",
+    r"video has been removed",
+    r"no longer available",
+    r"account .* (has been )?terminated",
+    r"copyright",
+    r"not available in your country",
+    r"sign in to confirm your age",
+    r"members-only",
+    r"does not exist",
+]), re.IGNORECASE)
+THROTTLED_PATTERN = re.compile(r"HTTP Error 429|Too Many Requests|rate.?limit", re.IGNORECASE)
+
+
+def classify_error(message):
+    """
+    Map a youtube-dl error message to an error class.
+    :param message:     Error output of youtube-dl.
+    :return:            ERROR_UNAVAILABLE, ERROR_THROTTLED or ERROR_DOWNLOAD.
+    """
+
+    if message and UNAVAILABLE_PATTERN.search(message):
+        return ERROR_UNAVAILABLE
+    if message and THROTTLED_PATTERN.search(message):
+        return ERROR_THROTTLED
+    return ERROR_DOWNLOAD
+
+
+def is_permanent(error_class):
+    return error_class in PERMANENT_ERRORS
+
+
+def job_event(video_id, state, error_class=None, error=None, num_bytes=None, duration=None, stages=None,
+              container=None, compression=None):
+    """
+    Event sent by the workers to the ledger writer.
+    :param stages:      Dictionary of stage name to wall time in seconds.
+    :param container:   Container the video was downloaded in, e.g. mp4 or mkv (set once per fetched video).
+    :param compression: Size reduction and encode throughput of the compact version (see TranscodeProfile.encode).
+    :return:            Dictionary.
+    """
+
+    return {"video_id": video_id, "state": state, "error_class": error_class, "error": error,
+            "bytes": num_bytes, "duration": duration, "stages": stages, "container": container,
+            "compression": compression}
+
+
+class JobLedger:
+    """
+    Durable per-video record of the download pipeline: state, attempts, error class, bytes and duration.
+
+    Kept in SQLite in WAL mode so readers are never blocked; it is written by a single process
+    (ledger_worker) while any process may read it.
+    """
+
+    def __init__(self, path):
+        """
+        :param path:    Path to the SQLite file of the ledger.
+        """
+
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                   video_id TEXT PRIMARY KEY,
+                                   state TEXT NOT NULL,
+                                   attempts INTEGER NOT NULL DEFAULT 0,
+                                   error_class TEXT,
+                                   error TEXT,
+                                   bytes INTEGER,
+                                   duration REAL,
+                                   updated_at REAL NOT NULL)""")
+        self.connection.commit()
+
+    def record(self, event, commit=True):
+        """
+        Apply one event. Every transition to IN_PROGRESS counts as an attempt.
+        :param event:       Dictionary made by job_event.
+        :param commit:      Commit right away.
+        :return:            None.
+        """
+
+        if self.state(event["video_id"]) in LATER_STATES.get(event["state"], ()):
+            self.connection.execute("UPDATE jobs SET bytes = COALESCE(bytes, ?), duration = COALESCE(duration, ?) WHERE video_id = ?",
+                                    (event["bytes"], event["duration"], event["video_id"]))
+        else:
+            self.upsert(event)
+        if commit:
+            self.connection.commit()
+
+    def upsert(self, event):
+        attempt = 1 if event["state"] == IN_PROGRESS else 0
+        self.connection.execute("""INSERT INTO jobs (video_id, state, attempts, error_class, error, bytes, duration, updated_at)
+                                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                                   ON CONFLICT(video_id) DO UPDATE SET
+                                   state = excluded.state,
+                                   attempts = attempts + excluded.attempts,
+                                   error_class = excluded.error_class,
+                                   error = excluded.error,
+                                   bytes = COALESCE(excluded.bytes, bytes),
+                                   duration = COALESCE(excluded.duration, duration),
+                                   updated_at = excluded.updated_at""",
+                                (event["video_id"], event["state"], attempt, event["error_class"], event["error"],
+                                 event["bytes"], event["duration"], time.time()))
+
+    def commit(self):
+        self.connection.commit()
+
+    def state(self, video_id):
+        row = self.connection.execute("SELECT state FROM jobs WHERE video_id = ?", (video_id,)).fetchone()
+        return PENDING if row is None else row[0]
+
+    def finished_ids(self):
+        """
+        Videos that must not be attempted again: done or permanently unavailable.
+        :return:    Set of video ids.
+        """
+
+        placeholders = ",".join("?" * len(FINISHED_STATES))
+        return {row[0] for row in self.connection.execute(
+            "SELECT video_id FROM jobs WHERE state IN ({})".format(placeholders), FINISHED_STATES)}
+
+    def jobs(self):
+        """
+        :return:    Iterator of (video_id, state, error_class) tuples of all videos.
+        """
+
+        return self.connection.execute("SELECT video_id, state, error_class FROM jobs")
+
+    def counts(self):
+        """
+        :return:    Dictionary of number of videos per state.
+        """
+
+        return dict(self.connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"))
+
+    def close(self):
+        self.connection.close()
+
+
+def unfinished_ids(video_ids, ledger_file):
+    """
+    Drop the videos a ledger has as finished.
+    :param video_ids:       Iterable of video ids.
+    :param ledger_file:     Path to the ledger, None to keep every video.
+    :return:                Iterable of video ids.
+    """
+
+    if ledger_file is None:
+        return video_ids
+    # read once, every lookup is then a set membership test
+    job_ledger = JobLedger(ledger_file)
+    finished = job_ledger.finished_ids()
+    job_ledger.close()
+    return (video_id for video_id in video_ids if video_id not in finished)
+
+
+def ledger_worker(events_queue, ledger_file, failed_save_file, commit_interval=1.0, metrics_file=None,
+                  metrics_interval=30, progress=False):
+    """
+    Single writer of the ledger. Also appends failed video ids to the failed log and aggregates
+    the metrics of all workers.
+    :param events_queue:        Queue of job and queue events, None ends the worker.
+    :param ledger_file:         Path to the ledger, None to only write the failed log.
+    :param failed_save_file:    Where to save failed video ids, None to skip.
+    :param commit_interval:     Events are committed in batches at most this many seconds apart.
+    :param metrics_file:        Where to dump the metrics as JSON (and Prometheus text next to it), None to skip.
+    :param metrics_interval:    Seconds between two metrics dumps.
+    :param progress:            Show a live progress bar.
+    :return:                    None.
+    """
+
+    ledger = JobLedger(ledger_file) if ledger_file is not None else None
+    failed_file = open(failed_save_file, "a") if failed_save_file is not None else None
+    last_commit = time.time()
+    metrics = PipelineMetrics()
+    last_dump = time.time()
+    progress_bar = None
+    if progress:
+        from tqdm import tqdm
+        progress_bar = tqdm(unit="video", smoothing=0.05)
+
+    while True:
+        try:
+            event = events_queue.get(timeout=commit_interval)
+        except queue.Empty:
+            event = False
+
+        if event is None:
+            break
+
+        if event:
+            metrics.add(event)
+        if event and "video_id" in event:
+            if ledger is not None:
+                ledger.record(event, commit=False)
+            if failed_file is not None and event["state"] in (FAILED, UNAVAILABLE):
+                failed_file.write("{}\n".format(event["video_id"]))
+            if progress_bar is not None and event["state"] in (DONE, FAILED, UNAVAILABLE):
+                progress_bar.update(1)
+                progress_bar.set_postfix(metrics.states, refresh=False)
+
+        if metrics_file is not None and time.time() - last_dump >= metrics_interval:
+            metrics.dump(metrics_file)
+            last_dump = time.time()
+
+        if time.time() - last_commit >= commit_interval:
+            if ledger is not None:
+                ledger.commit()
+            if failed_file is not None:
+                failed_file.flush()
+            last_commit = time.time()
+
+    if ledger is not None:
+        ledger.commit()
+        ledger.close()
+    if failed_file is not None:
+        failed_file.close()
+    if metrics_file is not None:
+        metrics.dump(metrics_file)
+    if progress_bar is not None:
+        progress_bar.close()
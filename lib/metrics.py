@@ -0,0 +1,223 @@
+import bisect
+import json
+import os
+import time
+from contextlib import contextmanager
+
+# stages of one video, in pipeline order
+STAGES = ("download", "stream", "remux", "cut", "compress", "frames", "upload", "delete")
+
+# upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, float("inf"))
+
+
+@contextmanager
+def stage_timer(report, stage):
+    """
+    Add the wall time of a block to report["stages"][stage].
+    :param report:      Report dictionary of process_video, None to not measure.
+    :param stage:       Name of the stage.
+    """
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        if report is not None:
+            stages = report.setdefault("stages", {})
+            stages[stage] = stages.get(stage, 0.0) + time.time() - start
+
+
+def queue_event(depths):
+    """
+    Queue occupancy sample sent to the events writer.
+    :param depths:      Dictionary of queue name to number of waiting items.
+    :return:            Dictionary.
+    """
+
+    return {"queue_depths": depths}
+
+
+def queue_depth(queue):
+    try:
+        return queue.qsize()
+    except NotImplementedError:
+        # qsize is not available on macOS
+        return -1
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets, cheap enough to keep for millions of samples.
+    """
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q-quantile (the maximum for the last bucket).
+        """
+
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {"count": self.count, "sum": self.sum, "mean": self.sum / self.count if self.count else 0.0,
+                "p50": self.quantile(0.5), "p99": self.quantile(0.99), "max": self.max}
+
+
+class PipelineMetrics:
+    """
+    Aggregates the job events of all workers: videos per state, per-stage latency,
+    bytes, downloaded containers, compression and queue occupancy.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.states = {}
+        self.stages = {stage: Histogram() for stage in STAGES}
+        self.video_seconds = Histogram()
+        self.bytes = 0
+        self.containers = {}
+        self.compression = {"videos": 0, "original_bytes": 0, "compact_bytes": 0, "encode_seconds": 0.0,
+                            "media_seconds": 0.0}
+        self.queue_depths = {}
+        self.max_queue_depths = {}
+
+    def add(self, event):
+        """
+        Account one event of the events queue.
+        :param event:   Job event or queue event.
+        :return:        None.
+        """
+
+        if "queue_depths" in event:
+            self.queue_depths = event["queue_depths"]
+            for name, depth in self.queue_depths.items():
+                self.max_queue_depths[name] = max(depth, self.max_queue_depths.get(name, 0))
+            return
+
+        state = event["state"]
+        self.states[state] = self.states.get(state, 0) + 1
+        for stage, seconds in (event.get("stages") or {}).items():
+            self.stages.setdefault(stage, Histogram()).add(seconds)
+        if event.get("duration") is not None:
+            self.video_seconds.add(event["duration"])
+        if event.get("bytes"):
+            self.bytes += event["bytes"]
+        if event.get("container"):
+            self.containers[event["container"]] = self.containers.get(event["container"], 0) + 1
+        if event.get("compression"):
+            self.compression["videos"] += 1
+            for key in ("original_bytes", "compact_bytes", "encode_seconds", "media_seconds"):
+                self.compression[key] += event["compression"][key]
+
+    def completed(self):
+        return self.states.get("done", 0)
+
+    def remux_avoided(self):
+        """
+        Share of fetched videos that came in a final container and skipped the mkv to mp4 remux.
+        """
+
+        fetched = sum(self.containers.values())
+        return 1.0 - self.containers.get("mkv", 0) / fetched if fetched else 0.0
+
+    def compression_summary(self):
+        """
+        Totals of the compressed videos with the overall size ratio (compact / original bytes)
+        and realtime factor (encoded media seconds per encode second).
+        """
+
+        summary = dict(self.compression)
+        summary["size_ratio"] = (summary["compact_bytes"] / summary["original_bytes"]
+                                 if summary["original_bytes"] else 0.0)
+        summary["realtime_factor"] = (summary["media_seconds"] / summary["encode_seconds"]
+                                      if summary["encode_seconds"] else 0.0)
+        return summary
+
+    def snapshot(self):
+        """
+        :return:    JSON serializable dictionary of all metrics.
+        """
+
+        elapsed = time.time() - self.started
+        return {
+            "elapsed_seconds": elapsed,
+            "videos": self.states,
+            "videos_per_second": self.completed() / elapsed if elapsed > 0 else 0.0,
+            "bytes": self.bytes,
+            "mb_per_second": self.bytes / (1024 * 1024) / elapsed if elapsed > 0 else 0.0,
+            "video_seconds": self.video_seconds.summary(),
+            "stages": {stage: histogram.summary() for stage, histogram in self.stages.items()},
+            "containers": self.containers,
+            "remux_avoided": self.remux_avoided(),
+            "compression": self.compression_summary(),
+            "queue_depths": self.queue_depths,
+            "max_queue_depths": self.max_queue_depths,
+        }
+
+    def to_prometheus(self):
+        """
+        :return:    Metrics in the Prometheus text exposition format.
+        """
+
+        lines = ["# TYPE sports1m_videos_total counter"]
+        for state, count in sorted(self.states.items()):
+            lines.append('sports1m_videos_total{{state="{}"}} {}'.format(state, count))
+        lines += ["# TYPE sports1m_bytes_total counter", "sports1m_bytes_total {}".format(self.bytes),
+                  "# TYPE sports1m_stage_seconds histogram"]
+        for stage, histogram in self.stages.items():
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else bound
+                lines.append('sports1m_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(stage, le, cumulative))
+            lines.append('sports1m_stage_seconds_sum{{stage="{}"}} {}'.format(stage, histogram.sum))
+            lines.append('sports1m_stage_seconds_count{{stage="{}"}} {}'.format(stage, histogram.count))
+        lines.append("# TYPE sports1m_fetched_videos_total counter")
+        for container, count in sorted(self.containers.items()):
+            lines.append('sports1m_fetched_videos_total{{container="{}"}} {}'.format(container, count))
+        lines.append("# TYPE sports1m_compression_bytes_total counter")
+        for key in ("original_bytes", "compact_bytes"):
+            lines.append('sports1m_compression_bytes_total{{variant="{}"}} {}'.format(key[:-6], self.compression[key]))
+        lines += ["# TYPE sports1m_encode_seconds_total counter",
+                  "sports1m_encode_seconds_total {}".format(self.compression["encode_seconds"]),
+                  "# TYPE sports1m_encoded_media_seconds_total counter",
+                  "sports1m_encoded_media_seconds_total {}".format(self.compression["media_seconds"])]
+        lines.append("# TYPE sports1m_queue_depth gauge")
+        for name, depth in sorted(self.queue_depths.items()):
+            lines.append('sports1m_queue_depth{{queue="{}"}} {}'.format(name, depth))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        """
+        Write the metrics as JSON to path and in the Prometheus text format to path with a .prom extension.
+        Files are replaced atomically so a scraper never reads a partial file.
+        :param path:    Path of the JSON file.
+        :return:        None.
+        """
+
+        for target, content in ((path, json.dumps(self.snapshot(), indent=2)),
+                                (os.path.splitext(path)[0] + ".prom", self.to_prometheus())):
+            tmp_path = target + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(content)
+            os.replace(tmp_path, target)
@@ -0,0 +1,140 @@
+import os
+import threading
+
+from lib.partition import ID_LENGTH
+
+
+def fan_out_directory(directory, video_id, fan_out=0):
+    """
+    Directory a video is saved to when the output fans out into id-prefix subdirectories.
+    :param directory:   Output directory.
+    :param video_id:    YouTube ID of the video.
+    :param fan_out:     Length of the id prefix naming the subdirectory, 0 for a flat directory.
+    :return:            Path of the directory.
+    """
+
+    if not fan_out:
+        return directory
+    return os.path.join(directory, video_id[:fan_out])
+
+
+def file_kind(file_name):
+    """
+    Split an output file name into video id and kind.
+    :param file_name:   e.g. <video_id>.mp4, <video_id>.mkv or <video_id>_0001.jpg.
+    :return:            Tuple: video id and kind (mp4, mkv, jpg, ...), None for files of no video.
+    """
+
+    if len(file_name) <= ID_LENGTH:
+        return None
+    video_id, rest = file_name[:ID_LENGTH], file_name[ID_LENGTH:]
+    if rest.endswith(".jpg"):
+        return video_id, "jpg"
+    if rest.startswith("."):
+        return video_id, rest[1:]
+    return None
+
+
+class OutputIndex:
+    """
+    In-memory index of the local output directory: which videos have which files.
+
+    Built with a single scan and kept up to date by the workers as they create and delete files,
+    so checking for existing outputs costs a dictionary lookup instead of listing a directory of
+    hundreds of thousands of files for every video.
+
+    Every forked worker updates its own copy, so the index is only a hint about the other processes:
+    hits are confirmed on disk, so a file removed by another process never counts as present, and on a
+    miss the file a video of that kind would have is looked up, so a file created by another process is
+    found as well. Frames (<video_id>_<n>.jpg) have no such single name and are only known from the scan.
+    """
+
+    def __init__(self, directory, fan_out=0):
+        """
+        :param directory:   Output directory.
+        :param fan_out:     Length of the id prefix of the subdirectories, 0 for a flat directory.
+        """
+
+        self.directory = directory
+        self.fan_out = fan_out
+        self.files = {}
+        self.lock = threading.Lock()
+        self.scan()
+
+    def scan(self):
+        """
+        Index all files of the output directory (and of its fan-out subdirectories).
+        :return:    Number of indexed files.
+        """
+
+        files = {}
+        count = 0
+        directories = [self.directory]
+        while directories:
+            directory = directories.pop()
+            if not os.path.isdir(directory):
+                continue
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if self.fan_out and directory == self.directory and len(entry.name) == self.fan_out:
+                            directories.append(entry.path)
+                        continue
+                    kind = file_kind(entry.name)
+                    if kind is not None:
+                        files.setdefault(kind[0], {}).setdefault(kind[1], set()).add(entry.path)
+                        count += 1
+        with self.lock:
+            self.files = files
+        return count
+
+    def directory_of(self, video_id):
+        return fan_out_directory(self.directory, video_id, self.fan_out)
+
+    def add(self, path):
+        kind = file_kind(os.path.basename(path))
+        if kind is not None:
+            with self.lock:
+                self.files.setdefault(kind[0], {}).setdefault(kind[1], set()).add(path)
+
+    def discard(self, path):
+        kind = file_kind(os.path.basename(path))
+        if kind is None:
+            return
+        with self.lock:
+            kinds = self.files.get(kind[0], {})
+            paths = kinds.get(kind[1], set())
+            paths.discard(path)
+            if not paths:
+                kinds.pop(kind[1], None)
+            if not kinds:
+                self.files.pop(kind[0], None)
+
+    def paths(self, video_id, kind):
+        """
+        Existing files of a video.
+        :param video_id:    YouTube ID of the video.
+        :param kind:        mp4, mkv, jpg, ...
+        :return:            List of paths.
+        """
+
+        with self.lock:
+            paths = list(self.files.get(video_id, {}).get(kind, ()))
+        existing = [path for path in paths if os.path.isfile(path)]
+        for path in paths:
+            if path not in existing:
+                self.discard(path)
+
+        if not existing and kind != "jpg":
+            path = os.path.join(self.directory_of(video_id), "{}.{}".format(video_id, kind))
+            if os.path.isfile(path):
+                self.add(path)
+                existing.append(path)
+        return existing
+
+    def has(self, video_id, kind):
+        return bool(self.paths(video_id, kind))
+
+    def __len__(self):
+        with self.lock:
+            return len(self.files)
@@ -1,7 +1,18 @@
+import heapq
+import itertools
 import os
+import queue
+import threading
+import time
 from multiprocessing import Process, Queue
 
+import lib.autoscale as autoscale
 import lib.downloader as downloader
+import lib.ledger as ledger
+import lib.metrics as metrics
+import lib.uploader as uploader
+from lib.transcode import TranscodeProfile
+from lib.work_table import WorkTable
 
 class Pool:
   """
@@ -9,31 +20,111 @@ class Pool:
   """
 
   def __init__(self, classes, videos_list, directory, num_workers, failed_save_file, compress, verbose, skip,
-               log_file=None):
+               log_file=None, upload_workers=0, upload_queue_size=100, min_free_disk=0, in_process=False,
+               clip_mode=False, ledger_file=None, max_retries=2, retry_backoff=30, metrics_file=None,
+               metrics_interval=30, progress=False, min_workers=None, max_workers=None, autoscale_interval=60,
+               rate_limit=None, transcode_workers=None, transcode_queue_size=None, match_container=False, frames=None,
+               keep_videos=True, stream=None, shared_work=False, claim_batch_size=16, section=None):
     """
     :param classes:               List of classes to download.
     :param videos_dict:           Dictionary of all videos.
     :param directory:             Where to download to videos.
     :param num_workers:           How many videos to download in parallel.
     :param failed_save_file:      Where to save the failed videos ids.
-    :param compress:              Whether to compress the videos using gzip.
+    :param compress:              TranscodeProfile of a compact training resolution version of every video
+                                  (True for the default profile), False to store the downloads as they are.
+    :param upload_workers:        How many uploads run in parallel in a separate upload stage
+                                  (0 uploads inside the download workers).
+    :param upload_queue_size:     How many finished videos may wait for the upload stage.
+    :param min_free_disk:         Download workers wait while the disk of directory has less free bytes.
+    :param in_process:            Download through one long-lived youtube-dl instance per worker
+                                  instead of a youtube-dl process per video.
+    :param clip_mode:             Cut requested sections from the remote streams without downloading whole videos.
+    :param ledger_file:           Job ledger recording the state of every video; videos done or unavailable
+                                  according to it are skipped.
+    :param max_retries:           How often a transient failure is retried.
+    :param retry_backoff:         Seconds before the first retry, doubled for every further retry.
+    :param metrics_file:          Where to dump per-stage timings, bytes and queue depths as JSON
+                                  (and Prometheus text next to it).
+    :param metrics_interval:      Seconds between two metrics dumps and queue depth samples.
+    :param progress:              Show a live progress bar.
+    :param min_workers:           Lower bound when autoscaling the download workers.
+    :param max_workers:           Upper bound when autoscaling; autoscaling is off unless it is set.
+    :param autoscale_interval:    Seconds between two autoscaling decisions.
+    :param rate_limit:            Downloads started per second across all workers, None for no limit.
+    :param transcode_workers:     Processes of a separate transcoding stage running remux, cut and compress
+                                  (e.g. os.cpu_count()); None transcodes inside the download workers.
+    :param transcode_queue_size:  How many fetched videos may wait for the transcoding stage,
+                                  defaults to twice the transcoding processes.
+    :param match_container:       Prefer mp4/m4a streams and merge straight into mp4 so videos need no remux.
+    :param frames:                FrameSampler: sample frames of every video into uploaded frame shards.
+    :param keep_videos:           Store the videos besides their frames.
+    :param stream:                Stream videos needing no post-processing straight into storage instead of
+                                  downloading them to disk: single or muxed (see downloader.STREAM_MODES), None not to.
+    :param shared_work:           Put the video ids into a shared-memory WorkTable the workers claim batches
+                                  from, instead of feeding them through the videos queue; needs classes None.
+    :param claim_batch_size:      Videos a worker claims from the work table at once.
+    :param section:               Tuple (start, end) in seconds: only keep this section of every video
+                                  (cut from the remote streams with clip_mode), None for whole videos.
     """
 
+    if shared_work and classes is not None:
+      raise ValueError("shared work tables only support downloading without classes")
+
     self.classes = classes
     self.videos_list = videos_list
     self.directory = directory
     self.num_workers = num_workers
     self.failed_save_file = failed_save_file
+    if compress:
+      # encodes running at the same time share the cores instead of each using all of them
+      profile = compress if isinstance(compress, TranscodeProfile) else TranscodeProfile()
+      compress = profile.for_concurrency(transcode_workers or max_workers or num_workers)
     self.compress = compress
     self.verbose = verbose
     self.skip = skip
     self.log_file = log_file
+    self.upload_workers = upload_workers
+    self.min_free_disk = min_free_disk
+    self.in_process = in_process
+    self.clip_mode = clip_mode
+    self.match_container = match_container
+    self.frames = frames
+    self.keep_videos = keep_videos
+    self.stream = stream
+    self.shared_work = shared_work
+    self.claim_batch_size = claim_batch_size
+    self.section = section
+    self.work_table = None
+    self.ledger_file = ledger_file
+    self.max_retries = max_retries
+    self.retry_backoff = retry_backoff
+    self.metrics_file = metrics_file
+    self.metrics_interval = metrics_interval
+    self.progress = progress
+    self.stats = autoscale.WorkerStats()
+    self.rate_limiter = autoscale.TokenBucket(rate_limit) if rate_limit else None
+    self.autoscaler = None
+    if max_workers is not None:
+      self.autoscaler = autoscale.AutoScaler(self, min_workers or 1, max_workers, interval=autoscale_interval,
+                                             min_free_disk=min_free_disk, rate_limiter=self.rate_limiter)
 
     self.videos_queue = Queue(100)
-    self.failed_queue = Queue(100)
+    self.events_queue = Queue(100)
+    self.upload_queue = Queue(upload_queue_size) if upload_workers > 0 else None
+    self.transcode_workers = transcode_workers or 0
+    self.transcode_queue = None
+    if self.transcode_workers > 0:
+      self.transcode_queue = Queue(transcode_queue_size or 2 * self.transcode_workers)
 
     self.workers = []
-    self.failed_save_worker = None
+    # workers that have not been told to exit
+    self.active_workers = 0
+    self.ledger_worker = None
+    self.upload_worker = None
+    self.transcoders = []
+    self.queue_sampler = None
+    self.stopped = threading.Event()
 
     if verbose:
       print("downloading:")
@@ -42,14 +133,28 @@ class Pool:
           print(cls)
         print()
 
+  def pending_videos(self):
+    """
+    The videos to download without those finished according to the ledger.
+    :return:    Iterable of video ids.
+    """
+
+    return ledger.unfinished_ids(self.videos_list, self.ledger_file)
+
   def feed_videos(self):
     """
-    Feed video ids into the download queue.
+    Feed video ids into the download queue. With a work table the workers claim the videos
+    themselves and there is nothing to feed.
     :return:    None.
     """
 
+    if self.work_table is not None:
+      return
+
+    videos_list = self.pending_videos()
+
     if self.classes is None:
-      downloader.download_class_parallel(None, self.videos_list, self.directory, self.videos_queue)
+      downloader.download_class_parallel(None, videos_list, self.directory, self.videos_queue, section=self.section)
     else:
       for class_name in self.classes:
 
@@ -59,7 +164,8 @@ class Pool:
         class_path = os.path.join(self.directory, class_name.replace(" ", "_"))
 
         if not self.skip or not os.path.isdir(class_path):
-          downloader.download_class_parallel(class_name, self.videos_list, self.directory, self.videos_queue)
+          downloader.download_class_parallel(class_name, videos_list, self.directory, self.videos_queue,
+                                             section=self.section)
 
       if self.verbose:
         print("done")
@@ -70,16 +176,127 @@ class Pool:
     :return:    None.
     """
 
-    # start failed videos saver
-    if self.failed_save_file is not None:
-      self.failed_save_worker = Process(target=write_failed_worker, args=(self.failed_queue, self.failed_save_file))
-      self.failed_save_worker.start()
+    # scan the output directory once, the forked workers inherit the index
+    downloader.get_output_index(self.directory)
+
+    # the table has to exist before the workers are started to be shared with them
+    if self.shared_work:
+      self.work_table = WorkTable(self.pending_videos())
+      os.makedirs(self.directory, exist_ok=True)
+
+    # start the single writer of the ledger and the failed videos log
+    self.ledger_worker = Process(target=ledger.ledger_worker,
+                                 args=(self.events_queue, self.ledger_file, self.failed_save_file),
+                                 kwargs={"metrics_file": self.metrics_file, "metrics_interval": self.metrics_interval,
+                                         "progress": self.progress})
+    self.ledger_worker.start()
+
+    if self.metrics_file is not None or self.progress:
+      self.queue_sampler = threading.Thread(target=self.sample_queues, daemon=True)
+      self.queue_sampler.start()
+
+    # start the upload stage
+    if self.upload_queue is not None:
+      self.upload_worker = Process(target=uploader.upload_worker,
+                                   args=(self.upload_queue, self.events_queue, self.upload_workers))
+      self.upload_worker.start()
+
+    # start the transcoding stage
+    for _ in range(self.transcode_workers):
+      transcoder = Process(target=transcode_worker, args=(self.transcode_queue, self.events_queue, self.compress),
+                           kwargs={"upload_queue": self.upload_queue, "clip_mode": self.clip_mode,
+                                   "frames": self.frames, "keep_videos": self.keep_videos})
+      transcoder.start()
+      self.transcoders.append(transcoder)
 
     # start download workers
-    for _ in range(self.num_workers):
-      worker = Process(target=video_worker, args=(self.videos_queue, self.failed_queue, self.compress, self.log_file))
+    self.resize(self.num_workers)
+
+    if self.autoscaler is not None:
+      self.autoscaler.start()
+
+  def num_active_workers(self):
+    return self.active_workers
+
+  def resize(self, num_workers):
+    """
+    Start or retire download workers. A retired worker finishes the video it is working on first.
+    :param num_workers:   Number of download workers to run.
+    :return:              None.
+    """
+
+    if self.active_workers < num_workers and self.work_table is not None:
+      # workers asked to retire that have not taken their retirement yet keep running instead
+      self.active_workers += self.work_table.cancel_retirements(num_workers - self.active_workers)
+    while self.active_workers < num_workers:
+      worker = Process(target=video_worker, args=(self.videos_queue, self.events_queue, self.compress, self.log_file),
+                       kwargs={"upload_queue": self.upload_queue, "scratch_directory": self.directory,
+                               "min_free_disk": self.min_free_disk, "in_process": self.in_process,
+                               "clip_mode": self.clip_mode, "max_retries": self.max_retries,
+                               "retry_backoff": self.retry_backoff, "stats": self.stats,
+                               "rate_limiter": self.rate_limiter, "transcode_queue": self.transcode_queue,
+                               "match_container": self.match_container, "frames": self.frames,
+                               "keep_videos": self.keep_videos, "stream": self.stream,
+                               "work_table": self.work_table, "claim_batch_size": self.claim_batch_size,
+                               "section": self.section})
       worker.start()
       self.workers.append(worker)
+      self.active_workers += 1
+
+    if self.active_workers > num_workers and self.work_table is not None:
+      self.work_table.retire(self.active_workers - num_workers)
+      self.active_workers = num_workers
+    while self.active_workers > num_workers:
+      self.videos_queue.put(None)
+      self.active_workers -= 1
+
+    self.workers = [worker for worker in self.workers if worker.is_alive()]
+    if self.verbose:
+      print("download workers: {}".format(self.active_workers))
+
+  def recover_claims(self):
+    """
+    Videos a worker claimed from the work table but never finished, because it died, are handed to
+    a new round of workers once. Videos left unfinished after that are failed.
+    :return:    None.
+    """
+
+    stranded = self.work_table.unfinished()
+    if not stranded:
+      return
+
+    if self.verbose:
+      print("{} videos claimed by workers that exited, downloading them again".format(len(stranded)))
+    self.work_table.release(stranded)
+    # a retirement asked for near the end of the run was never taken, it would end a recovery worker
+    self.work_table.cancel_retirements()
+    # claimed one by one, so a video killing its worker again only strands itself
+    self.claim_batch_size = 1
+    self.resize(min(self.num_workers, len(stranded)))
+    for worker in self.workers:
+      worker.join()
+    self.active_workers = 0
+
+    for index in self.work_table.unfinished():
+      self.work_table.set_state(index, ledger.FAILED)
+      self.events_queue.put(ledger.job_event(self.work_table.video_id(index), ledger.FAILED, ledger.ERROR_DOWNLOAD,
+                                             "the worker exited without finishing the video"))
+
+  def sample_queues(self):
+    """
+    Periodically send the occupancy of the pipeline queues to the metrics.
+    :return:    None.
+    """
+
+    while not self.stopped.wait(min(self.metrics_interval, 5)):
+      depths = {"videos": metrics.queue_depth(self.videos_queue), "events": metrics.queue_depth(self.events_queue)}
+      if self.work_table is not None:
+        depths["videos"] = self.work_table.remaining()
+      if self.upload_queue is not None:
+        depths["upload"] = metrics.queue_depth(self.upload_queue)
+      if self.transcode_queue is not None:
+        depths["transcode"] = metrics.queue_depth(self.transcode_queue)
+      self.events_queue.put(metrics.queue_event(depths))
 
   def stop_workers(self):
     """
@@ -87,56 +304,288 @@ class Pool:
     :return:    None.
     """
 
-    # send end signal to all download workers
-    for _ in range(len(self.workers)):
-      self.videos_queue.put(None)
+    if self.autoscaler is not None:
+      self.autoscaler.stop()
+
+    # send end signal to all download workers; with a work table they exit once it is exhausted
+    if self.work_table is None:
+      self.resize(0)
+    else:
+      self.active_workers = 0
 
     # wait for the processes to finish
     for worker in self.workers:
       worker.join()
+    if self.work_table is not None:
+      self.recover_claims()
+
+    # let the transcoding stage drain its queue
+    for _ in self.transcoders:
+      self.transcode_queue.put(None)
+    for transcoder in self.transcoders:
+      transcoder.join()
 
-    # end failed videos saver
-    if self.failed_save_worker is not None:
-      self.failed_queue.put(None)
-      self.failed_save_worker.join()
+    # let the upload stage drain its queue
+    if self.upload_worker is not None:
+      self.upload_queue.put(None)
+      self.upload_worker.join()
 
-def video_worker(videos_queue, failed_queue, compress, log_file):
+    self.stopped.set()
+    if self.queue_sampler is not None:
+      self.queue_sampler.join()
+
+    if self.work_table is not None and self.verbose:
+      print("videos per state: {}".format(self.work_table.counts()))
+
+    # end the ledger writer
+    if self.ledger_worker is not None:
+      self.events_queue.put(None)
+      self.ledger_worker.join()
+
+def video_worker(videos_queue, events_queue, compress, log_file, upload_queue=None, scratch_directory=None,
+                 min_free_disk=0, in_process=False, clip_mode=False, max_retries=2, retry_backoff=30, stats=None,
+                 rate_limiter=None, transcode_queue=None, match_container=False, frames=None, keep_videos=True,
+                 stream=None, work_table=None, claim_batch_size=16, section=None):
   """
   Downloads videos pass in the videos queue.
   :param videos_queue:      Queue for metadata of videos to be download.
-  :param failed_queue:      Queue of failed video ids.
-  :param compress:          Whether to compress the videos using gzip.
+  :param events_queue:      Queue of job events for the ledger writer.
+  :param compress:          TranscodeProfile of the compact version of every video, False for none.
   :param log_file:          Path to a log file for youtube-dl.
+  :param upload_queue:      Queue of the upload stage, None to upload in this worker.
+  :param scratch_directory: Local directory the videos are downloaded to.
+  :param min_free_disk:     Wait before each download while the scratch disk has less free bytes.
+  :param in_process:        Download through one youtube-dl instance kept for the lifetime of the worker.
+  :param clip_mode:         Cut requested sections from the remote streams without downloading whole videos.
+  :param max_retries:       How often a transient failure is retried.
+  :param retry_backoff:     Seconds before the first retry, doubled for every further retry; the worker
+                            goes on with other videos in the meantime.
+  :param stats:             WorkerStats counting attempts, completed and throttled videos for the autoscaler.
+  :param rate_limiter:      TokenBucket shared by all workers, taken before every download.
+  :param transcode_queue:   Queue of the transcoding stage; videos needing ffmpeg work are handed to it
+                            instead of being transcoded in this worker.
+  :param match_container:   Prefer streams youtube-dl can merge straight into mp4.
+  :param frames:            FrameSampler to pack sampled frames into shards, None to skip.
+  :param keep_videos:       Store the videos besides their frames.
+  :param stream:            Stream mode of videos needing no post-processing, None to download them to disk.
+  :param work_table:        WorkTable to claim videos from (saved to scratch_directory) instead of the videos queue;
+                            the state every video ends in is written back to it.
+  :param claim_batch_size:  Videos claimed from the work table at once.
+  :param section:           Tuple (start, end) of the videos claimed from the work table, None for whole videos.
   :return:                  None.
   """
 
-  while True:
-    request = videos_queue.get()
+  # connect once per process, the client is reused for every upload
+  downloader.get_storage_client()
+  extractor = downloader.get_extractor(log_file=log_file, match_container=match_container) if in_process else None
+
+  if work_table is None:
+    requests = queued_videos(videos_queue)
+  else:
+    requests = claimed_videos(work_table, scratch_directory, claim_batch_size, section)
+  # transient failures wait here for their backoff while the worker goes on with other videos
+  retries = RetrySchedule()
 
+  for attempt, index, (video_id, directory, start, end), stored in scheduled_videos(requests, retries):
+    if scratch_directory is not None:
+      uploader.wait_for_disk_space(scratch_directory, min_free_disk)
+
+    if rate_limiter is not None:
+      rate_limiter.acquire()
+    if stats is not None:
+      stats.increment(stats.attempts)
+    events_queue.put(ledger.job_event(video_id, ledger.IN_PROGRESS))
+    report = {}
+    start_time = time.time()
+    if stored:
+      # the video was fetched and transcoded by an earlier attempt whose upload failed
+      success = downloader.store_video(video_id, stored, upload_queue=upload_queue, report=report)
+    elif stream and downloader.can_stream(start, end, compress, frames):
+      success = downloader.stream_video(video_id, directory, log_file=log_file, mode=stream, report=report)
+    elif transcode_queue is None:
+      success = downloader.process_video(video_id, directory, start, end, compress=compress, log_file=log_file,
+                                         upload_queue=upload_queue, extractor=extractor, clip_mode=clip_mode,
+                                         report=report, match_container=match_container, frames=frames,
+                                         keep_videos=keep_videos)
+    else:
+      success, video_path = downloader.fetch_video(video_id, directory, start, end, log_file=log_file,
+                                                   extractor=extractor, clip_mode=clip_mode, report=report,
+                                                   match_container=match_container)
+      if success and video_path is not None:
+        if downloader.needs_transcode(video_path, start, end, compress, clip_mode, frames):
+          # blocks while the transcoding stage is behind
+          transcode_queue.put((video_id, video_path, start, end, time.time() - start_time))
+          report["queued_transcode"] = True
+        else:
+          success = downloader.store_video(video_id, video_path, upload_queue=upload_queue, report=report)
+    duration = time.time() - start_time
+
+    if success:
+      if stats is not None:
+        stats.increment(stats.completed)
+      if report.get("queued_transcode"):
+        state = ledger.TRANSCODING
+      elif report.get("queued_upload") or report.get("queued_frames"):
+        state = ledger.UPLOADING
+      else:
+        state = ledger.DONE
+      events_queue.put(ledger.job_event(video_id, state, num_bytes=report.get("bytes"), duration=duration,
+                                        stages=report.get("stages"), container=report.get("container"),
+                                        compression=report.get("compression")))
+      report_frame_shards(events_queue, downloader.stored_frame_videos())
+    else:
+      error_class = report.get("error_class", ledger.ERROR_DOWNLOAD)
+      if stats is not None and error_class == ledger.ERROR_THROTTLED:
+        stats.increment(stats.throttled)
+      if ledger.is_permanent(error_class):
+        state = ledger.UNAVAILABLE
+      elif attempt < max_retries:
+        # variants that were uploaded are deleted, only the others are stored again
+        stored = [path for path in downloader.as_paths(report.get("video_path") or []) if os.path.isfile(path)]
+        retries.add(time.time() + retry_backoff * 2 ** attempt,
+                    (attempt + 1, index, (video_id, directory, start, end), stored))
+        continue
+      else:
+        state = ledger.FAILED
+      events_queue.put(ledger.job_event(video_id, state, error_class, report.get("error"),
+                                        duration=duration, stages=report.get("stages")))
+
+    if index is not None:
+      work_table.set_state(index, state)
+
+  # upload the last, partly filled frame shard
+  report_frame_shards(events_queue, downloader.close_frame_writer())
+
+
+def report_frame_shards(events_queue, finished):
+  """
+  Finish the videos of the frames-only mode whose frame shard was uploaded, or failed to.
+  :param finished:  List of (video id, bool indicating the shard was stored) tuples.
+  :return:          None.
+  """
+
+  for video_id, stored in finished:
+    if stored:
+      events_queue.put(ledger.job_event(video_id, ledger.DONE))
+    else:
+      events_queue.put(ledger.job_event(video_id, ledger.FAILED, ledger.ERROR_UPLOAD, "could not upload the frame shard"))
+
+
+class RetrySchedule:
+  """
+  Retries of a worker ordered by the time their backoff ends.
+  """
+
+  def __init__(self):
+    self.heap = []
+    self.order = itertools.count()
+
+  def add(self, not_before, retry):
+    heapq.heappush(self.heap, (not_before, next(self.order), retry))
+
+  def due(self):
+    return bool(self.heap) and self.heap[0][0] <= time.time()
+
+  def wait(self):
+    # seconds until the next retry is due
+    return max(self.heap[0][0] - time.time(), 0)
+
+  def pop(self):
+    return heapq.heappop(self.heap)[2]
+
+  def __len__(self):
+    return len(self.heap)
+
+
+def scheduled_videos(requests, retries):
+  """
+  New requests of a worker interleaved with its retries once they are due. When no new request is left,
+  the remaining retries are waited for.
+  :param requests:  Generator of (index, request) tuples; None when no request arrived for a while.
+  :param retries:   RetrySchedule of (attempt, index, request, paths to store) tuples.
+  :return:          Generator of (attempt, index, request, paths to store) tuples.
+  """
+
+  for item in requests:
+    while retries.due():
+      yield retries.pop()
+    if item is not None:
+      index, request = item
+      yield 0, index, request, None
+
+  while retries:
+    time.sleep(retries.wait())
+    yield retries.pop()
+
+
+def queued_videos(videos_queue, timeout=1):
+  """
+  Requests of the videos queue until the end signal.
+  :param timeout:   Seconds after which None is yielded while the queue is empty, so due retries are not held up.
+  :return:          Generator of (None, request) tuples.
+  """
+
+  while True:
+    try:
+      request = videos_queue.get(timeout=timeout)
+    except queue.Empty:
+      yield None
+      continue
     if request is None:
-      break
+      return
+    yield None, request
+
+
+def claimed_videos(work_table, directory, batch_size, section=None):
+  """
+  Requests of the videos claimed from a work table.
+  :return:    Generator of (index in the table, request) tuples.
+  """
 
-    video_id, directory, start, end = request
+  start, end = section or (None, None)
+  for index, video_id in work_table.videos(batch_size):
+    yield index, (video_id, directory, start, end)
 
-    if not downloader.process_video(video_id, directory, start, end, compress=compress, log_file=log_file):
-      failed_queue.put(video_id)
 
-def write_failed_worker(failed_queue, failed_save_file):
+def transcode_worker(transcode_queue, events_queue, compress, upload_queue=None, clip_mode=False, frames=None,
+                     keep_videos=True):
   """
-  Write failed video ids into a file.
-  :param failed_queue:        Queue of failed video ids.
-  :param failed_save_file:    Where to save the videos.
-  :return:                    None.
+  Runs the CPU bound ffmpeg work (remux, cut, compress) of videos fetched by the download workers.
+  :param transcode_queue:   Queue of (video_id, path to the fetched video, start, end, seconds spent fetching) tuples.
+  :param events_queue:      Queue of job events for the ledger writer.
+  :param compress:          TranscodeProfile of the compact version of every video, False for none.
+  :param upload_queue:      Queue of the upload stage, None to upload in this worker.
+  :param clip_mode:         Whether clips were already cut by the download workers.
+  :param frames:            FrameSampler to pack sampled frames into shards, None to skip.
+  :param keep_videos:       Store the videos besides their frames.
+  :return:                  None.
   """
 
-  file = open(failed_save_file, "a")
+  downloader.get_storage_client()
 
   while True:
-    video_id = failed_queue.get()
+    request = transcode_queue.get()
 
-    if video_id is None:
+    if request is None:
       break
 
-    file.write("{}\n".format(video_id))
+    video_id, video_path, start, end, elapsed = request
+    report = {}
+    start_time = time.time()
+    success, video_path = downloader.transcode_video(video_id, video_path, start, end, compress=compress,
+                                                     clip_mode=clip_mode, report=report, frames=frames,
+                                                     keep_videos=keep_videos)
+    if success and video_path is not None:
+      success = downloader.store_video(video_id, video_path, upload_queue=upload_queue, report=report)
+    duration = elapsed + time.time() - start_time
+
+    if success:
+      state = ledger.UPLOADING if report.get("queued_upload") or report.get("queued_frames") else ledger.DONE
+      events_queue.put(ledger.job_event(video_id, state, num_bytes=report.get("bytes"), duration=duration,
+                                        stages=report.get("stages"), compression=report.get("compression")))
+      report_frame_shards(events_queue, downloader.stored_frame_videos())
+    else:
+      events_queue.put(ledger.job_event(video_id, ledger.FAILED, report.get("error_class", ledger.ERROR_FFMPEG),
+                                        report.get("error"), duration=duration, stages=report.get("stages")))
 
-  file.close()
+  report_frame_shards(events_queue, downloader.close_frame_writer())
@@ -0,0 +1,157 @@
+import array
+import gzip
+import os
+import re
+
+# YouTube video ids are always 11 characters from the url-safe base64 alphabet
+ID_LENGTH = 11
+ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{11}$")
+URL_ID_PATTERN = re.compile(r"(?:[?&]v=|/embed/|/v/|/shorts/|youtu\.be/)([A-Za-z0-9_-]{11})(?![A-Za-z0-9_-])")
+
+# cross-validation folds shipped next to download.py
+CROSS_VALIDATION_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cross-validation")
+
+
+def parse_video_id(url):
+    """
+    Extract the YouTube video id from a url.
+    :param url:     Any YouTube url form (watch?v=, youtu.be/, embed/, v/, shorts/) or a bare id.
+    :return:        The 11 character video id or None if the url does not contain one.
+    """
+
+    url = url.strip()
+    if ID_PATTERN.match(url):
+        return url
+
+    match = URL_ID_PATTERN.search(url)
+    if match is None:
+        return None
+
+    return match.group(1)
+
+
+def open_metadata(path):
+    """
+    Open a partition file, transparently decompressing the gzipped files shipped with the dataset.
+    :param path:    Path to the partition file.
+    :return:        Text file object.
+    """
+
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt")
+    return open(path, "r")
+
+
+def iter_partition(path):
+    """
+    Lazily read a partition file in the URL<space><CSV of Label Indices> format.
+    :param path:    Path to the partition file.
+    :return:        Generator of (video_id, list of label indices) tuples.
+    """
+
+    with open_metadata(path) as fread:
+        for line in fread:
+            line = line.strip()
+            if not line:
+                continue
+
+            url, _, label_csv = line.partition(" ")
+            video_id = parse_video_id(url)
+            if video_id is None:
+                continue
+
+            yield video_id, [int(label) for label in label_csv.split(",") if label]
+
+
+def cross_validation_paths(directory, fold):
+    """
+    Paths of one of the 10 cross-validation folds.
+    :param directory:   The cross-validation directory of the dataset.
+    :param fold:        Index of the fold (0 to 9).
+    :return:            Tuple: path to the train and the test file of the fold.
+    """
+
+    return (os.path.join(directory, "sports{}_train.txt".format(fold)),
+            os.path.join(directory, "sports{}_test.txt".format(fold)))
+
+
+class Partition:
+    """
+    Compact in-memory store of video ids and labels.
+
+    Ids are kept as fixed-width 11 byte records in a single bytearray and labels in a CSR layout
+    (a flat array of label indices plus an array of offsets into it), so a million videos cost a
+    few tens of MB instead of a list of Python strings.
+    """
+
+    def __init__(self):
+        self.ids = bytearray()
+        self.label_offsets = array.array("I", [0])
+        self.label_values = array.array("H")
+
+    @classmethod
+    def load(cls, *paths):
+        """
+        Read one or more partition files.
+        :param paths:   Paths to partition files.
+        :return:        Partition.
+        """
+
+        partition = cls()
+        for path in paths:
+            partition.extend(iter_partition(path))
+        return partition
+
+    def append(self, video_id, labels):
+        """
+        Add one video.
+        :param video_id:    YouTube ID of the video.
+        :param labels:      List of label indices.
+        :return:            None.
+        """
+
+        encoded = video_id.encode("ascii")
+        assert len(encoded) == ID_LENGTH, video_id
+        self.ids += encoded
+        self.label_values.extend(labels)
+        self.label_offsets.append(len(self.label_values))
+
+    def extend(self, records):
+        """
+        Add videos from an iterable of (video_id, labels) tuples.
+        :param records:     Iterable of (video_id, labels) tuples.
+        :return:            None.
+        """
+
+        for video_id, labels in records:
+            self.append(video_id, labels)
+
+    def video_id(self, index):
+        start = index * ID_LENGTH
+        return self.ids[start:start + ID_LENGTH].decode("ascii")
+
+    def labels(self, index):
+        return self.label_values[self.label_offsets[index]:self.label_offsets[index + 1]].tolist()
+
+    def items(self):
+        """
+        Iterate over all videos.
+        :return:    Generator of (video_id, list of label indices) tuples.
+        """
+
+        for index in range(len(self)):
+            yield self.video_id(index), self.labels(index)
+
+    def __len__(self):
+        return len(self.ids) // ID_LENGTH
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.video_id(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.video_id(index)
@@ -0,0 +1,275 @@
+import json
+import os
+import queue
+import re
+import sqlite3
+import statistics
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import lib.config as config
+import lib.downloader as downloader
+from lib.ledger import ERROR_UNAVAILABLE, UNAVAILABLE, classify_error, is_permanent, job_event
+
+METADATA_CACHE_PATH = getattr(config, "METADATA_CACHE_PATH", os.path.join(config.OUTPUT_ROOT, "metadata.db"))
+
+# youtube-dl --ignore-errors reports every failed video of a batch on its own line
+ERROR_PATTERN = re.compile(r"ERROR: \[\w+\] ([\w-]{11}): (.*)")
+
+# SQLite limits the number of variables of a statement
+SELECT_BATCH = 500
+
+
+def expected_size(info):
+    """
+    Expected download size of the format youtube-dl selected.
+    :param info:    Info dictionary of youtube-dl --dump-json.
+    :return:        Bytes, None if youtube-dl gives neither sizes nor bitrates.
+    """
+
+    # split formats list the video and audio stream that are merged
+    size = 0
+    for stream in info.get("requested_formats") or [info]:
+        stream_size = stream.get("filesize") or stream.get("filesize_approx")
+        if not stream_size and stream.get("tbr") and info.get("duration"):
+            # tbr is in KBit/s
+            stream_size = stream["tbr"] * 1000 / 8 * info["duration"]
+        if not stream_size:
+            return None
+        size += stream_size
+    return int(size)
+
+
+def metadata_record(info):
+    return {"available": True, "duration": info.get("duration"), "format": info.get("format_id"),
+            "ext": info.get("ext"), "filesize": expected_size(info), "error": None}
+
+
+def youtube_dl_probe(video_format="mp4", match_container=False, log_file=None):
+    """
+    Probe running one youtube-dl --dump-json for a whole batch of videos, with the format selection of the downloads.
+    :param video_format:    Format to download.
+    :param match_container: Select streams that merge straight into video_format.
+    :param log_file:        Path to a log file for youtube-dl.
+    :return:                Probe: callable from a list of video ids to a dictionary of video id to metadata record
+                            (available, duration, format, ext, filesize, error). Videos that failed for a transient
+                            reason are left out, so they are probed again.
+    """
+
+    def probe(video_ids):
+        cmd = [downloader.YOUTUBE_DL_PATH, "--dump-json", "--ignore-errors", "--no-warnings",
+               "-f", downloader.format_selector(video_format, match_container)]
+        result = subprocess.run(cmd + [downloader.video_url(video_id) for video_id in video_ids],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        records = {}
+        for line in result.stdout.decode("utf-8", "replace").splitlines():
+            try:
+                info = json.loads(line)
+            except ValueError:
+                continue
+            records[info.get("id")] = metadata_record(info)
+
+        error = result.stderr.decode("utf-8", "replace")
+        downloader.append_log(log_file, error)
+        for match in ERROR_PATTERN.finditer(error):
+            video_id, message = match.groups()
+            if video_id not in records and is_permanent(classify_error(message)):
+                records[video_id] = {"available": False, "duration": None, "format": None, "ext": None,
+                                     "filesize": None, "error": message.strip()}
+        return records
+
+    return probe
+
+
+def canned_probe(metadata):
+    """
+    Probe answering from canned metadata instead of YouTube, for tests and benchmarks.
+    :param metadata:    Dictionary of video id to metadata record; other videos are unavailable.
+    :return:            Probe.
+    """
+
+    def probe(video_ids):
+        return {video_id: metadata.get(video_id, {"available": False, "error": "not in the canned metadata"})
+                for video_id in video_ids}
+
+    return probe
+
+
+class MetadataCache:
+    """
+    Persistent local store of the probed metadata of every video, so a restart neither probes nor
+    downloads dead videos again.
+    """
+
+    def __init__(self, path):
+        """
+        :param path:    Path to the SQLite file of the cache.
+        """
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS metadata (video_id TEXT PRIMARY KEY, available INTEGER, "
+                                "duration REAL, format TEXT, ext TEXT, filesize INTEGER, error TEXT, probed_at REAL)")
+        self.connection.commit()
+
+    def get(self, video_ids, max_age=None):
+        """
+        Cached metadata of videos.
+        :param video_ids:   List of video ids.
+        :param max_age:     Ignore records probed more than max_age seconds ago, None to keep all.
+        :return:            Dictionary of video id to metadata record, for the cached videos only.
+        """
+
+        oldest = time.time() - max_age if max_age is not None else 0
+        records = {}
+        with self.lock:
+            for start in range(0, len(video_ids), SELECT_BATCH):
+                batch = video_ids[start:start + SELECT_BATCH]
+                rows = self.connection.execute(
+                    "SELECT video_id, available, duration, format, ext, filesize, error FROM metadata "
+                    "WHERE probed_at >= ? AND video_id IN ({})".format(",".join("?" * len(batch))), [oldest] + batch)
+                for video_id, available, duration, video_format, ext, filesize, error in rows:
+                    records[video_id] = {"available": bool(available), "duration": duration, "format": video_format,
+                                         "ext": ext, "filesize": filesize, "error": error}
+        return records
+
+    def put(self, records, probed_at=None):
+        """
+        Store probed metadata.
+        :param records:     Dictionary of video id to metadata record.
+        :param probed_at:   Time of the probe, defaults to now.
+        :return:            None.
+        """
+
+        probed_at = time.time() if probed_at is None else probed_at
+        rows = [(video_id, int(bool(record.get("available"))), record.get("duration"), record.get("format"),
+                 record.get("ext"), record.get("filesize"), record.get("error"), probed_at)
+                for video_id, record in records.items()]
+        with self.lock:
+            with self.connection:
+                self.connection.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def counts(self):
+        """
+        :return:    Dictionary: number of available and unavailable videos.
+        """
+
+        with self.lock:
+            counts = dict(self.connection.execute("SELECT available, COUNT(*) FROM metadata GROUP BY available"))
+        return {"available": counts.get(1, 0), "unavailable": counts.get(0, 0)}
+
+    def close(self):
+        self.connection.close()
+
+
+class MetadataProbe:
+    """
+    Probe stage in front of the downloads: videos are probed in batches well ahead of the download workers,
+    dead videos are dropped and every window of videos is handed on largest first, so long downloads start
+    early instead of straggling at the end of a run.
+    """
+
+    def __init__(self, cache, probe=None, batch_size=50, num_threads=4, max_age=None):
+        """
+        :param cache:           MetadataCache.
+        :param probe:           Callable from a list of video ids to a dictionary of metadata records
+                                (see youtube_dl_probe); defaults to youtube_dl_probe().
+        :param batch_size:      Videos per probe call.
+        :param num_threads:     Probe calls running in parallel.
+        :param max_age:         Probe videos again whose metadata is older than this many seconds, None never to.
+        """
+
+        self.cache = cache
+        self.probe = probe if probe is not None else youtube_dl_probe()
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.max_age = max_age
+        self.stats = {"probed": 0, "unavailable": 0, "unknown": 0}
+
+    def metadata(self, video_ids):
+        """
+        Metadata of videos, probing those that are not cached.
+        :param video_ids:   List of video ids.
+        :return:            Dictionary of video id to metadata record; videos whose probe failed for a
+                            transient reason are missing.
+        """
+
+        records = self.cache.get(video_ids, self.max_age)
+        missing = [video_id for video_id in video_ids if video_id not in records]
+        batches = [missing[start:start + self.batch_size] for start in range(0, len(missing), self.batch_size)]
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            for batch, probed in zip(batches, executor.map(self.probe, batches)):
+                probed = {video_id: record for video_id, record in probed.items() if video_id in batch}
+                self.cache.put(probed)
+                records.update(probed)
+                self.stats["probed"] += len(probed)
+                self.stats["unknown"] += len(batch) - len(probed)
+        return records
+
+    def order(self, video_ids, events_queue=None):
+        """
+        Drop the unavailable videos and sort the others by expected size, largest first.
+        :param video_ids:       List of video ids.
+        :param events_queue:    Queue of the ledger writer the dropped videos are reported to as unavailable,
+                                None not to report them.
+        :return:                List of video ids.
+        """
+
+        records = self.metadata(video_ids)
+        available = [video_id for video_id in video_ids if records.get(video_id, {"available": True})["available"]]
+        self.stats["unavailable"] += len(video_ids) - len(available)
+        if events_queue is not None:
+            for video_id in video_ids:
+                if not records.get(video_id, {"available": True})["available"]:
+                    events_queue.put(job_event(video_id, UNAVAILABLE, ERROR_UNAVAILABLE,
+                                               records[video_id].get("error")))
+
+        # videos of unknown size are assumed to be of median size
+        sizes = [records[video_id]["filesize"] for video_id in available
+                 if video_id in records and records[video_id]["filesize"]]
+        default = statistics.median(sizes) if sizes else 0
+        return sorted(available, key=lambda video_id: (records.get(video_id) or {}).get("filesize") or default,
+                      reverse=True)
+
+    def videos(self, video_ids, window=1000, ahead=2, events_queue=None):
+        """
+        Probe and order videos window by window in a background thread, while the previous windows are downloaded.
+        :param video_ids:       Iterable of video ids.
+        :param window:          Videos ordered together; larger windows order better but delay the first download.
+        :param ahead:           Windows probed ahead of the consumer.
+        :param events_queue:    Queue of the ledger writer the dropped videos are reported to, see order.
+        :return:                Generator of video ids.
+        """
+
+        windows = queue.Queue(ahead)
+
+        def produce():
+            try:
+                batch = []
+                for video_id in video_ids:
+                    batch.append(video_id)
+                    if len(batch) == window:
+                        windows.put(self.order(batch, events_queue))
+                        batch = []
+                if batch:
+                    windows.put(self.order(batch, events_queue))
+                windows.put(None)
+            except Exception as e:
+                # raised again in the consumer
+                windows.put(e)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        while True:
+            ordered = windows.get()
+            if ordered is None:
+                break
+            if isinstance(ordered, Exception):
+                raise ordered
+            yield from ordered
+        producer.join()
@@ -0,0 +1,154 @@
+import array
+import os
+
+# label files shipped next to download.py
+LABELS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "labels.txt")
+MIDS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sports_mids.txt")
+
+
+def load_labels(path=LABELS_PATH):
+    """
+    Read the human-readable label names.
+    :param path:    Path to labels.txt, line i holds the name of label index i.
+    :return:        List of label names.
+    """
+
+    with open(path, "r") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def load_mids(path=MIDS_PATH):
+    """
+    Read the YouTube topic ids of the classes.
+    :param path:    Path to sports_mids.txt in the /m/<mid>,<name> format.
+    :return:        Dictionary of label name to topic id.
+    """
+
+    mids = {}
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            mid, _, name = line.partition(",")
+            mids[name] = mid
+    return mids
+
+
+class ClassScheduler:
+    """
+    Orders the videos of a Partition by class.
+
+    Classes can be selected by label index, name or topic id. Videos are interleaved round-robin over
+    the selected classes and capped per class, so a run stopped early still holds a balanced subset.
+    The order only depends on the partition, hence resuming a run (skipping finished videos after
+    scheduling) keeps the same subset and the per-class caps count the videos of earlier runs.
+    """
+
+    def __init__(self, partition, labels=None, mids=None):
+        """
+        :param partition:   Partition with the label indices of every video.
+        :param labels:      List of label names, defaults to load_labels().
+        :param mids:        Dictionary of label name to topic id, defaults to load_mids().
+        """
+
+        self.partition = partition
+        self.labels = load_labels() if labels is None else labels
+        self.mids = load_mids() if mids is None else mids
+        self.indices = {name: index for index, name in enumerate(self.labels)}
+        self.mid_indices = {mid: self.indices[name] for name, mid in self.mids.items() if name in self.indices}
+        # videos scheduled per label index by the last schedule()
+        self.scheduled = {}
+
+    def class_name(self, label):
+        return self.labels[label]
+
+    def mid(self, label):
+        return self.mids.get(self.labels[label])
+
+    def resolve(self, classes):
+        """
+        Map class selections to label indices.
+        :param classes:     Iterable of label indices, label names or topic ids (/m/...).
+        :return:            List of label indices in the given order, without duplicates.
+        """
+
+        resolved = []
+        for item in classes:
+            if isinstance(item, int) or (isinstance(item, str) and item.isdigit()):
+                label = int(item)
+                if not 0 <= label < len(self.labels):
+                    raise ValueError("label index out of range: {}".format(item))
+            elif item in self.mid_indices:
+                label = self.mid_indices[item]
+            elif item in self.indices:
+                label = self.indices[item]
+            elif item.replace("_", " ") in self.indices:
+                # class directory names use underscores
+                label = self.indices[item.replace("_", " ")]
+            else:
+                raise ValueError("unknown class: {}".format(item))
+            if label not in resolved:
+                resolved.append(label)
+        return resolved
+
+    def members(self, labels):
+        """
+        Positions of the videos of each class in the partition, in file order.
+        :param labels:      List of label indices.
+        :return:            Dictionary of label index to array of positions.
+        """
+
+        members = {label: array.array("I") for label in labels}
+        offsets = self.partition.label_offsets
+        values = self.partition.label_values
+        for index in range(len(self.partition)):
+            for label in values[offsets[index]:offsets[index + 1]]:
+                if label in members:
+                    members[label].append(index)
+        return members
+
+    def schedule(self, classes=None, per_class=None, interleave=True):
+        """
+        Video ids in download order. A video with several selected labels is scheduled once,
+        under the first of its classes that reaches it.
+        :param classes:     Class selections accepted by resolve(), None for all 487 classes.
+        :param per_class:   Maximum number of videos per class, None for no limit.
+        :param interleave:  Take one video of each class in turn; otherwise class after class.
+        :return:            Generator of video ids.
+        """
+
+        labels = list(range(len(self.labels))) if classes is None else self.resolve(classes)
+        members = self.members(labels)
+        positions = {label: 0 for label in labels}
+        scheduled = bytearray(len(self.partition))
+        self.scheduled = {label: 0 for label in labels}
+
+        def next_video(label):
+            # next position of the class not scheduled under another class yet
+            label_members = members[label]
+            position = positions[label]
+            while position < len(label_members) and scheduled[label_members[position]]:
+                position += 1
+            positions[label] = position + 1
+            if position == len(label_members):
+                return None
+            return label_members[position]
+
+        active = [label for label in labels if per_class is None or per_class > 0]
+        while active:
+            remaining = []
+            for label in active:
+                while True:
+                    index = next_video(label)
+                    if index is None:
+                        break
+                    scheduled[index] = 1
+                    self.scheduled[label] += 1
+                    yield self.partition.video_id(index)
+                    if per_class is not None and self.scheduled[label] >= per_class:
+                        break
+                    if interleave:
+                        remaining.append(label)
+                        break
+            active = remaining
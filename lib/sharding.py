@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+
+from lib.ledger import DONE, FAILED, FINISHED_STATES, PENDING, UNAVAILABLE, JobLedger
+
+# when a video shows up in several ledgers (e.g. after changing the number of shards),
+# the most final state wins
+STATE_RANK = {DONE: 4, UNAVAILABLE: 3, FAILED: 2}
+
+
+def parse_shard(text):
+    """
+    Parse a shard given as i/N.
+    :param text:    Shard index and number of shards, e.g. 0/4.
+    :return:        Tuple: shard index and number of shards.
+    """
+
+    index, _, count = text.partition("/")
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise ValueError("shard must be given as i/N, got {}".format(text))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError("shard index must be in [0, N), got {}".format(text))
+    return index, count
+
+
+def shard_of(video_id, num_shards):
+    """
+    Shard owning a video. A stable hash (unlike hash(), which is salted per process) so every
+    node computes the same split without talking to the others.
+    :param video_id:    YouTube ID of the video.
+    :param num_shards:  Number of shards.
+    :return:            Shard index.
+    """
+
+    digest = hashlib.md5(video_id.encode("ascii")).digest()
+    return int.from_bytes(digest[:8], "big") % num_shards
+
+
+def in_shard(video_id, shard):
+    return shard is None or shard_of(video_id, shard[1]) == shard[0]
+
+
+def shard_path(path, shard):
+    """
+    Per-shard variant of a file path, e.g. OUTPUT/failed.txt -> OUTPUT/failed.shard-0-of-4.txt.
+    :param path:    Path shared by all shards.
+    :param shard:   Tuple: shard index and number of shards, None to keep the path.
+    :return:        Path.
+    """
+
+    if shard is None or path is None:
+        return path
+    root, extension = os.path.splitext(path)
+    return "{}.shard-{}-of-{}{}".format(root, shard[0], shard[1], extension)
+
+
+def merge_shards(video_ids, num_shards, ledger_file, stored_ids=(), report_file=None, failed_file=None):
+    """
+    Reconcile the ledgers of all shards and the blob inventory into one completion report.
+    Videos found in the inventory count as done whatever their ledgers say.
+    :param video_ids:       Iterable of all video ids of the run.
+    :param num_shards:      Number of shards.
+    :param ledger_file:     Ledger path shared by all shards, the shard files are found with shard_path.
+                            Missing ledgers (shards that never ran) are reported as pending.
+    :param stored_ids:      Set of video ids in the blob inventory.
+    :param report_file:     Where to write the report as JSON, None to skip.
+    :param failed_file:     Where to write the ids of all failed videos, None to skip.
+    :return:                Dictionary with totals, per-shard counts and inconsistencies.
+    """
+
+    states = {}
+    error_classes = {}
+    missing_ledgers = []
+    for index in range(num_shards):
+        path = shard_path(ledger_file, (index, num_shards))
+        if not os.path.isfile(path):
+            missing_ledgers.append(path)
+            continue
+        ledger = JobLedger(path)
+        for video_id, state, error_class in ledger.jobs():
+            if STATE_RANK.get(state, 0) >= STATE_RANK.get(states.get(video_id), 0):
+                states[video_id] = state
+                error_classes[video_id] = error_class
+        ledger.close()
+
+    totals = {}
+    shards = [{} for _ in range(num_shards)]
+    error_counts = {}
+    # done according to a ledger but not in the inventory: the blob went missing or the inventory is stale
+    not_stored = []
+    failed = []
+    for video_id in video_ids:
+        state = states.get(video_id, PENDING)
+        if video_id in stored_ids:
+            state = DONE
+        elif state == DONE:
+            not_stored.append(video_id)
+        elif state == FAILED:
+            failed.append(video_id)
+            error_class = error_classes.get(video_id)
+            error_counts[error_class] = error_counts.get(error_class, 0) + 1
+        elif state not in FINISHED_STATES:
+            # interrupted videos (in progress, transcoding, uploading) are not finished either
+            state = PENDING
+
+        totals[state] = totals.get(state, 0) + 1
+        shard = shards[shard_of(video_id, num_shards)]
+        shard[state] = shard.get(state, 0) + 1
+
+    total = sum(totals.values())
+    report = {
+        "videos": total,
+        "states": totals,
+        "completed": totals.get(DONE, 0) / total if total else 0.0,
+        "shards": shards,
+        "failed_error_classes": {str(key): value for key, value in error_counts.items()},
+        "done_not_stored": len(not_stored),
+        "missing_ledgers": missing_ledgers,
+    }
+
+    if report_file is not None:
+        with open(report_file, "w") as f:
+            json.dump(report, f, indent=2)
+    if failed_file is not None:
+        with open(failed_file, "w") as f:
+            f.writelines("{}\n".format(video_id) for video_id in failed + not_stored)
+    return report
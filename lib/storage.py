@@ -0,0 +1,369 @@
+import asyncio
+import os
+import os.path as op
+import hashlib
+import logging
+import shutil
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+import lib.config as config
+
+# well-known development account of the Azurite storage emulator
+AZURITE_CONNECTION_STRING = ("DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;"
+                             "AccountKey=Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw==;"
+                             "BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;")
+
+
+def file_md5(path, chunk_size=8 * 1024 * 1024):
+    """
+    MD5 digest of a local file.
+    :param path:          Path to the file.
+    :param chunk_size:    Bytes read at once.
+    :return:              Digest as bytes.
+    """
+
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.digest()
+
+
+def read_block(stream, size):
+    """
+    Read up to size bytes; unlike a single read on a pipe, only returns less at the end of the stream.
+    :param stream:      Binary file object.
+    :param size:        Bytes to read.
+    :return:            Bytes, empty at the end of the stream.
+    """
+
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+def transfer_stats(size, sent, seconds):
+    """
+    Throughput metrics of one transfer.
+    :param size:        Size of the file.
+    :param sent:        Bytes actually transferred (less than size when a transfer was resumed).
+    :param seconds:     Duration of the transfer.
+    :return:            Dictionary.
+    """
+
+    return {'bytes': size, 'sent_bytes': sent, 'seconds': seconds,
+            'mb_per_s': sent / (1024 * 1024) / seconds if seconds > 0 else 0.0}
+
+
+def leaf_names(names):
+    """
+    Blob names that are not a directory of another blob name (a/b and a/b/c: only a/b/c).
+    :param names:       Iterable of blob names.
+    :return:            Sorted list of blob names.
+    """
+
+    names = set(names)
+    directories = {name[:i] for name in names for i, c in enumerate(name) if c == '/'}
+    return sorted(names - directories)
+
+
+def transfer_summary(results, seconds):
+    """
+    Summary of a bulk transfer.
+    :param results:     List of (path, status, stats or error) tuples, status is 'transferred', 'skipped' or 'failed'.
+    :param seconds:     Wall time of the bulk transfer.
+    :return:            Dictionary: counts per status, failed paths with their errors and the overall transfer_stats.
+    """
+
+    summary = transfer_stats(sum(r[2]['bytes'] for r in results if r[1] == 'transferred'),
+                             sum(r[2]['sent_bytes'] for r in results if r[1] == 'transferred'), seconds)
+    summary['files'] = len(results)
+    for status in ('transferred', 'skipped', 'failed'):
+        summary[status] = sum(1 for r in results if r[1] == status)
+    summary['errors'] = {r[0]: r[2] for r in results if r[1] == 'failed'}
+    return summary
+
+
+class StorageBackend(ABC):
+    """
+    Interface of the blob storage the download pipeline writes to.
+    Blob names are '/' separated paths relative to the container. Backends implement the abstract
+    methods; the bulk transfers and the async variants build on them.
+    """
+
+    @abstractmethod
+    def list_blob_names(self, name_starts_with=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def upload_file(self, src_file, target_file, overwrite=False):
+        """Upload a local file and return its transfer_stats."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def download_file(self, blob_name, local_path):
+        raise NotImplementedError
+
+    @abstractmethod
+    def upload_stream(self, stream, target_file, overwrite=False, complete=None):
+        """
+        Upload everything read from a binary stream (e.g. the stdout of a downloader) without a local file.
+        :param stream:          Binary file object, read until its end.
+        :param target_file:     Blob name.
+        :param overwrite:       Replace an existing blob instead of failing.
+        :param complete:        Called at the end of the stream; when it returns False the blob is not
+                                committed and IOError is raised, e.g. because the writer of the stream failed.
+        :return:                transfer_stats of the upload.
+        """
+        raise NotImplementedError
+
+    async def upload_file_async(self, src_file, target_file, overwrite=False):
+        """
+        upload_file for asyncio callers; backends without an async client upload in a thread of the default executor.
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self.upload_file, src_file, target_file,
+                                                                overwrite)
+
+    async def get_size_async(self, blob_name):
+        return await asyncio.get_running_loop().run_in_executor(None, self.get_size, blob_name)
+
+    async def close_async(self):
+        """
+        Release the async client, before its event loop is closed.
+        """
+        pass
+
+    @abstractmethod
+    def exists(self, blob_name):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_size(self, blob_name):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, blob_name):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_md5(self, blob_name):
+        """MD5 digest of a blob as bytes, None if the service does not know it."""
+        raise NotImplementedError
+
+    def is_identical(self, local_path, blob_name):
+        """Whether a blob has the size and MD5 of a local file; sizes are compared first since they are cheap."""
+        if not self.exists(blob_name) or self.get_size(blob_name) != op.getsize(local_path):
+            return False
+        md5 = self.get_md5(blob_name)
+        return md5 is not None and md5 == file_md5(local_path)
+
+    def upload_files(self, files, num_threads=8, skip_identical=True):
+        """
+        Upload many files with a bounded pool of threads.
+        :param files:           Iterable of (local path, blob name) tuples; duplicates are uploaded once.
+        :param num_threads:     Parallel uploads.
+        :param skip_identical:  Skip files whose blob already has the same size and MD5; other blobs are replaced.
+        :return:                transfer_summary of the upload.
+        """
+
+        def upload(item):
+            src_file, target_file = item
+            try:
+                if skip_identical and self.is_identical(src_file, target_file):
+                    return src_file, 'skipped', None
+                return src_file, 'transferred', self.upload_file(src_file, target_file, overwrite=True)
+            except Exception as e:
+                return src_file, 'failed', str(e)
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            results = list(executor.map(upload, dict(files).items()))
+        return transfer_summary(results, time.time() - start)
+
+    def download_files(self, blobs, num_threads=8, skip_identical=True):
+        """
+        Download many blobs with a bounded pool of threads. A blob is written next to its local path
+        and renamed once complete, so an interrupted download never leaves a partial file behind.
+        :param blobs:           Iterable of (blob name, local path) tuples; duplicates are downloaded once.
+        :param num_threads:     Parallel downloads.
+        :param skip_identical:  Skip blobs whose local file already has the same size and MD5.
+        :return:                transfer_summary of the download.
+        """
+
+        def download(item):
+            blob_name, local_path = item
+            try:
+                if skip_identical and op.isfile(local_path) and self.is_identical(local_path, blob_name):
+                    return blob_name, 'skipped', None
+                start = time.time()
+                tmp_path = '{}.{}.tmp'.format(local_path, os.getpid())
+                self.download_file(blob_name, tmp_path)
+                os.replace(tmp_path, local_path)
+                size = op.getsize(local_path)
+                return blob_name, 'transferred', transfer_stats(size, size, time.time() - start)
+            except Exception as e:
+                return blob_name, 'failed', str(e)
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            results = list(executor.map(download, dict(blobs).items()))
+        return transfer_summary(results, time.time() - start)
+
+    def upload_folder(self, folder, target_prefix, num_threads=8, skip_identical=True):
+        """
+        Upload all files below a local folder in one parallel pass.
+        :param folder:          Local folder.
+        :param target_prefix:   Blob name prefix replacing the folder in the blob names.
+        :param num_threads:     Parallel uploads.
+        :param skip_identical:  Skip files whose blob already has the same size and MD5.
+        :return:                transfer_summary of the upload.
+        """
+
+        folder = folder.rstrip('/\\')
+        target_prefix = target_prefix.rstrip('/\\')
+        files = []
+        for root, _, names in os.walk(folder):
+            for name in names:
+                src_file = op.join(root, name)
+                relative = op.relpath(src_file, folder).replace(os.sep, '/')
+                files.append((src_file, '/'.join([target_prefix, relative]) if target_prefix else relative))
+        return self.upload_files(files, num_threads=num_threads, skip_identical=skip_identical)
+
+    def download_prefix(self, prefix, local_dir, num_threads=8, skip_identical=True):
+        """
+        Download all blobs below a prefix in one parallel pass.
+        :param prefix:          Blob name prefix, '' for the whole container.
+        :param local_dir:       Local folder; blob names keep their path below it.
+        :param num_threads:     Parallel downloads.
+        :param skip_identical:  Skip blobs whose local file already has the same size and MD5.
+        :return:                transfer_summary of the download.
+        """
+
+        names = leaf_names(self.list_blob_names(name_starts_with=prefix or None))
+        return self.download_files([(name, op.join(local_dir, *name.split('/'))) for name in names],
+                                   num_threads=num_threads, skip_identical=skip_identical)
+
+
+class LocalStorage(StorageBackend):
+    """
+    Storage backend keeping blobs as files in a local directory, one sub-directory per container.
+    Used to benchmark and test the pipeline without a storage account.
+    """
+
+    def __init__(self, root, container_name):
+        self.container_name = container_name
+        self.directory = op.join(root, container_name)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, blob_name):
+        return op.join(self.directory, *blob_name.lstrip('/').split('/'))
+
+    def list_blob_names(self, name_starts_with=None):
+        # only the directory of the prefix is listed, and only its entries matching the rest of the prefix are walked
+        directory, _, start = (name_starts_with or '').rpartition('/')
+        top = self.path(directory) if directory else self.directory
+        if not op.isdir(top):
+            return []
+
+        names = []
+        for entry in os.scandir(top):
+            if not entry.name.startswith(start):
+                continue
+            if entry.is_dir():
+                for root, _, files in os.walk(entry.path):
+                    names.extend(self.blob_name(op.join(root, f)) for f in files if not f.endswith('.tmp'))
+            elif not entry.name.endswith('.tmp'):
+                names.append(self.blob_name(entry.path))
+        return sorted(names)
+
+    def blob_name(self, path):
+        return op.relpath(path, self.directory).replace(os.sep, '/')
+
+    def upload_file(self, src_file, target_file, overwrite=False):
+        logging.info('uploading {} to {}'.format(src_file, target_file))
+        target_path = self.path(target_file)
+        if not overwrite and op.isfile(target_path):
+            raise FileExistsError(target_path)
+        os.makedirs(op.dirname(target_path), exist_ok=True)
+        start = time.time()
+        # copy next to the target and rename so readers never see a partial blob
+        tmp_path = '{}.{}.tmp'.format(target_path, os.getpid())
+        shutil.copyfile(src_file, tmp_path)
+        os.replace(tmp_path, target_path)
+        size = op.getsize(target_path)
+        return transfer_stats(size, size, time.time() - start)
+
+    def upload_stream(self, stream, target_file, overwrite=False, complete=None):
+        target_path = self.path(target_file)
+        if not overwrite and op.isfile(target_path):
+            raise FileExistsError(target_path)
+        os.makedirs(op.dirname(target_path), exist_ok=True)
+        start = time.time()
+        tmp_path = '{}.{}.tmp'.format(target_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                shutil.copyfileobj(stream, f, 1024 * 1024)
+            if complete is not None and not complete():
+                raise IOError('incomplete stream for {}'.format(target_file))
+            if op.getsize(tmp_path) == 0:
+                raise IOError('empty stream for {}'.format(target_file))
+            os.replace(tmp_path, target_path)
+        finally:
+            if op.isfile(tmp_path):
+                os.remove(tmp_path)
+        size = op.getsize(target_path)
+        return transfer_stats(size, size, time.time() - start)
+
+    def download_file(self, blob_name, local_path):
+        if op.dirname(local_path):
+            os.makedirs(op.dirname(local_path), exist_ok=True)
+        shutil.copyfile(self.path(blob_name), local_path)
+
+    def exists(self, blob_name):
+        return op.isfile(self.path(blob_name))
+
+    def get_size(self, blob_name):
+        return op.getsize(self.path(blob_name))
+
+    def delete(self, blob_name):
+        os.remove(self.path(blob_name))
+
+    def get_md5(self, blob_name):
+        return file_md5(self.path(blob_name))
+
+
+def get_storage(container_name):
+    """
+    Create the storage backend selected by config.STORAGE_BACKEND.
+    :param container_name:    Name of the container.
+    :return:                  'azure' (default): CloudStorage on the configured account,
+                              'azurite': CloudStorage on a local Azurite emulator,
+                              'local': LocalStorage under config.LOCAL_STORAGE_ROOT.
+    """
+
+    backend = getattr(config, "STORAGE_BACKEND", "azure")
+
+    if backend == "local":
+        return LocalStorage(config.LOCAL_STORAGE_ROOT, container_name)
+
+    from lib.cloud_storage import CloudStorage, DEFAULT_BLOCK_SIZE, DEFAULT_MAX_CONCURRENCY
+
+    if backend == "azurite":
+        return CloudStorage.from_azurite(container_name,
+                                         getattr(config, "AZURITE_CONNECTION_STRING", AZURITE_CONNECTION_STRING))
+    if backend == "azure":
+        return CloudStorage(config.STORAGE_ACCOUNT_NAME, container_name, config.CONNECTION_STRING, config.SAS_TOKEN,
+                            max_connections=getattr(config, "STORAGE_MAX_CONNECTIONS", None),
+                            block_size=getattr(config, "UPLOAD_BLOCK_SIZE", DEFAULT_BLOCK_SIZE),
+                            max_concurrency=getattr(config, "UPLOAD_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY),
+                            validate_content=getattr(config, "UPLOAD_VALIDATE_CONTENT", False))
+
+    raise ValueError("unknown storage backend {}".format(backend))
@@ -0,0 +1,151 @@
+import copy
+import os
+import subprocess
+import time
+
+# which videos are stored when compressing: the original download, the compact transcode or both
+UPLOAD_VARIANTS = ("original", "compact", "both")
+
+
+def scale_filter(short_side, upscale=True):
+    """
+    ffmpeg scale filter resizing the short side of a video and keeping its aspect ratio.
+    :param short_side:  Height of landscape (width of portrait) videos in pixels.
+    :param upscale:     Also enlarge videos smaller than short_side.
+    :return:            Filter string.
+    """
+
+    side = str(short_side) if upscale else "min({},{{}})".format(short_side)
+    # -2 keeps the other side even, as required by most encoders
+    return "scale='if(gt(iw,ih),-2,{})':'if(gt(iw,ih),{},-2)'".format(side.format("iw"), side.format("ih"))
+
+
+def encode_threads(concurrent_encodes):
+    """
+    ffmpeg threads per encode sharing the cores between the encodes running at the same time.
+    :param concurrent_encodes:  Number of encodes running at the same time.
+    :return:                    Threads per encode, at least 1.
+    """
+
+    return max(1, (os.cpu_count() or 1) // max(1, concurrent_encodes))
+
+
+def parse_progress(output):
+    """
+    Last values of ffmpeg -progress key=value output.
+    :param output:  Output of ffmpeg as str.
+    :return:        Dictionary.
+    """
+
+    values = {}
+    for line in output.splitlines():
+        key, _, value = line.partition("=")
+        values[key.strip()] = value.strip()
+    return values
+
+
+class TranscodeProfile:
+    """
+    Training resolution transcode of a video: smaller short side, optionally lower fps, x264 at a
+    given CRF and preset and an optional fixed keyframe interval so clips can be seeked cheaply.
+    """
+
+    def __init__(self, short_side=256, fps=None, crf=28, preset="veryfast", gop=None, audio=True, threads=None,
+                 upload="compact"):
+        """
+        :param short_side:  Target short side in pixels, smaller videos are not enlarged; None keeps the size.
+        :param fps:         Target frame rate, None keeps the frame rate.
+        :param crf:         x264 constant rate factor, higher is smaller.
+        :param preset:      x264 preset, faster presets encode faster into larger files.
+        :param gop:         Keyframe interval in frames, None for the encoder default.
+        :param audio:       Keep the audio track (as AAC).
+        :param threads:     ffmpeg threads per encode, None for ffmpeg's default (all cores), the
+                            pools replace it by a share of the cores, see for_concurrency.
+        :param upload:      Stored variant: original, compact or both.
+        """
+
+        if upload not in UPLOAD_VARIANTS:
+            raise ValueError("upload must be one of {}, got {}".format(", ".join(UPLOAD_VARIANTS), upload))
+
+        self.short_side = short_side
+        self.fps = fps
+        self.crf = crf
+        self.preset = preset
+        self.gop = gop
+        self.audio = audio
+        self.threads = threads
+        self.upload = upload
+
+    def for_concurrency(self, concurrent_encodes):
+        """
+        This profile with the cores shared between the encodes running at the same time, unless
+        its threads are set.
+        :param concurrent_encodes:  Number of encodes running at the same time.
+        :return:                    TranscodeProfile.
+        """
+
+        if self.threads is not None:
+            return self
+        profile = copy.copy(self)
+        profile.threads = encode_threads(concurrent_encodes)
+        return profile
+
+    def video_filter(self):
+        filters = []
+        if self.fps:
+            filters.append("fps={}".format(self.fps))
+        if self.short_side:
+            filters.append(scale_filter(self.short_side, upscale=False))
+        return ",".join(filters)
+
+    def command(self, src_path, dst_path):
+        cmd = ["ffmpeg", "-y", "-loglevel", "error", "-nostats", "-progress", "pipe:1", "-i", src_path]
+        if self.video_filter():
+            cmd += ["-vf", self.video_filter()]
+        cmd += ["-c:v", "libx264", "-preset", self.preset, "-crf", str(self.crf), "-pix_fmt", "yuv420p"]
+        if self.gop:
+            cmd += ["-g", str(self.gop), "-keyint_min", str(self.gop), "-sc_threshold", "0"]
+        cmd += ["-c:a", "aac", "-b:a", "96k"] if self.audio else ["-an"]
+        if self.threads:
+            cmd += ["-threads", str(self.threads)]
+        # the index at the front lets readers start decoding before the whole file is read
+        cmd += ["-movflags", "+faststart", dst_path]
+        return cmd
+
+    def encode(self, src_path, dst_path):
+        """
+        Transcode a video.
+        :param src_path:    Path to the video.
+        :param dst_path:    Path to the transcoded video.
+        :return:            Dictionary: original and compact bytes, encode seconds, encoded media seconds,
+                            frames and the realtime factor; None if ffmpeg failed.
+        """
+
+        start = time.time()
+        result = subprocess.run(self.command(src_path, dst_path), stdout=subprocess.PIPE)
+        seconds = time.time() - start
+        if result.returncode != 0:
+            return None
+        return self.summarize(src_path, dst_path, result.stdout, seconds)
+
+    def summarize(self, src_path, dst_path, output, seconds):
+        """
+        Statistics of a finished encode run with command().
+        :param output:      stdout of ffmpeg as bytes.
+        :param seconds:     Wall time of the encode.
+        :return:            Dictionary as returned by encode, None if there is no transcoded video.
+        """
+
+        if not os.path.isfile(dst_path):
+            return None
+
+        progress = parse_progress(output.decode("utf-8", "replace"))
+        # out_time_ms holds microseconds as well in most ffmpeg versions
+        media_seconds = int(progress.get("out_time_us") or progress.get("out_time_ms") or 0) / 1e6
+        original_bytes = os.path.getsize(src_path)
+        compact_bytes = os.path.getsize(dst_path)
+        return {"original_bytes": original_bytes, "compact_bytes": compact_bytes,
+                "size_ratio": compact_bytes / original_bytes if original_bytes else 0.0,
+                "encode_seconds": seconds, "media_seconds": media_seconds,
+                "frames": int(progress.get("frame") or 0),
+                "realtime_factor": media_seconds / seconds if seconds > 0 else 0.0}
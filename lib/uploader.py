@@ -0,0 +1,69 @@
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import lib.downloader as downloader
+import lib.ledger as ledger
+
+
+def free_disk_bytes(directory):
+    """
+    Free space on the disk holding a directory.
+    :param directory:     Local directory.
+    :return:              Free bytes.
+    """
+
+    return shutil.disk_usage(directory).free
+
+
+def wait_for_disk_space(directory, min_free_bytes, poll_interval=1.0):
+    """
+    Block until the disk holding a directory has enough free space, so downloads
+    cannot fill the local scratch while uploads are catching up.
+    :param directory:         Local directory.
+    :param min_free_bytes:    Required free bytes.
+    :param poll_interval:     Seconds between two checks.
+    :return:                  None.
+    """
+
+    while min_free_bytes and free_disk_bytes(directory) < min_free_bytes:
+        time.sleep(poll_interval)
+
+
+def upload_worker(upload_queue, events_queue, concurrency):
+    """
+    Upload finished videos passed in the upload queue with a pool of threads.
+    :param upload_queue:      Queue of (video_id, path to the local video or list of paths of its variants) tuples.
+    :param events_queue:      Queue of job events for the ledger writer.
+    :param concurrency:       How many uploads run at the same time.
+    :return:                  None.
+    """
+
+    # all threads share the connection pool of one client
+    downloader.get_storage_client()
+    # do not take more videos off the queue than there are free upload slots,
+    # so a full queue pushes back on the download workers
+    slots = threading.BoundedSemaphore(concurrency)
+
+    def upload(video_id, video_file):
+        try:
+            report = {}
+            uploads = [downloader.upload2blob(path, report=report) for path in downloader.as_paths(video_file)]
+            if all(uploads):
+                events_queue.put(ledger.job_event(video_id, ledger.DONE, stages=report.get("stages")))
+            else:
+                events_queue.put(ledger.job_event(video_id, ledger.FAILED, ledger.ERROR_UPLOAD,
+                                                  stages=report.get("stages")))
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            request = upload_queue.get()
+
+            if request is None:
+                break
+
+            slots.acquire()
+            executor.submit(upload, *request)
@@ -0,0 +1,168 @@
+import ctypes
+from multiprocessing import RawArray, RawValue, Value
+
+import lib.ledger as ledger
+
+# YouTube ids are 11 characters long
+ID_WIDTH = 11
+
+PENDING = 0
+CLAIMED = 1
+# compact codes of the states a job ends an attempt in, see lib.ledger
+STATE_CODES = {ledger.DONE: 2, ledger.TRANSCODING: 3, ledger.UPLOADING: 4, ledger.UNAVAILABLE: 5, ledger.FAILED: 6}
+CODE_STATES = {PENDING: ledger.PENDING, CLAIMED: ledger.IN_PROGRESS}
+CODE_STATES.update((code, state) for state, code in STATE_CODES.items())
+
+
+class WorkTable:
+    """
+    Video ids in shared memory that download workers claim in batches, instead of one pickled
+    request per video sent through a queue by a single feeder.
+
+    The ids are packed into a fixed-width byte array, a shared cursor hands out batches of indices and
+    every worker writes the outcome of its videos as one byte into a shared status array. Nothing is
+    copied per video, so dispatch costs the same at millions of videos and forked workers share the pages.
+    """
+
+    def __init__(self, video_ids, width=ID_WIDTH):
+        """
+        :param video_ids:   Iterable of video ids, at most width ASCII characters each.
+        :param width:       Bytes per id.
+        """
+
+        data = bytearray()
+        for video_id in video_ids:
+            encoded = video_id.encode("ascii")
+            if len(encoded) > width:
+                raise ValueError("video id {} is longer than {} characters".format(video_id, width))
+            data += encoded.ljust(width, b"\0")
+
+        self.width = width
+        self.size = len(data) // width
+        # shared arrays can not be empty
+        self.ids = RawArray(ctypes.c_char, max(len(data), 1))
+        self.ids[:len(data)] = bytes(data)
+        self.status = RawArray(ctypes.c_uint8, max(self.size, 1))
+        # the lock of the cursor also guards the retirement count and releasing claimed videos
+        self.cursor = Value(ctypes.c_long, 0)
+        self.retiring = RawValue(ctypes.c_long, 0)
+
+    def video_id(self, index):
+        return self.ids[index * self.width:(index + 1) * self.width].rstrip(b"\0").decode("ascii")
+
+    def claim(self, batch_size=16):
+        """
+        Claim the next batch of videos. Once the cursor reached the end, videos released by retired
+        workers are handed out again.
+        :param batch_size:  Maximum number of videos.
+        :return:            List of indices, empty when no video is left.
+        """
+
+        with self.cursor.get_lock():
+            start = self.cursor.value
+            if start < self.size:
+                stop = min(start + batch_size, self.size)
+                self.cursor.value = stop
+                indices = range(start, stop)
+            else:
+                status = bytes(self.status)[:self.size]
+                indices = []
+                index = status.find(PENDING)
+                while index >= 0 and len(indices) < batch_size:
+                    indices.append(index)
+                    index = status.find(PENDING, index + 1)
+            for index in indices:
+                self.status[index] = CLAIMED
+        return list(indices)
+
+    def release(self, indices):
+        """
+        Hand claimed but unprocessed videos back.
+        """
+
+        with self.cursor.get_lock():
+            for index in indices:
+                self.status[index] = PENDING
+
+    def set_state(self, index, state):
+        """
+        Record the ledger state a video ended in.
+        """
+
+        self.status[index] = STATE_CODES[state]
+
+    def state(self, index):
+        return CODE_STATES[self.status[index]]
+
+    def retire(self, num_workers):
+        """
+        Ask num_workers workers to exit after their current video.
+        """
+
+        with self.cursor.get_lock():
+            self.retiring.value += num_workers
+
+    def cancel_retirements(self, num_workers=None):
+        """
+        Take back retirements no worker has taken yet.
+        :param num_workers:     Maximum number of retirements to take back, None for all.
+        :return:                Number of retirements taken back.
+        """
+
+        with self.cursor.get_lock():
+            cancelled = self.retiring.value if num_workers is None else min(num_workers, self.retiring.value)
+            self.retiring.value -= cancelled
+        return cancelled
+
+    def take_retirement(self):
+        with self.cursor.get_lock():
+            if self.retiring.value > 0:
+                self.retiring.value -= 1
+                return True
+        return False
+
+    def remaining(self):
+        """
+        Number of videos not claimed yet.
+        """
+
+        return self.size - min(self.cursor.value, self.size)
+
+    def unfinished(self):
+        """
+        Videos not claimed yet, or claimed but without an outcome, e.g. because their worker died.
+        :return:    List of indices.
+        """
+
+        status = bytes(self.status)[:self.size]
+        return [index for index, code in enumerate(status) if code in (PENDING, CLAIMED)]
+
+    def counts(self):
+        """
+        Number of videos per state.
+        :return:    Dictionary of ledger state to count.
+        """
+
+        status = bytes(self.status)[:self.size]
+        counts = {CODE_STATES[code]: status.count(code) for code in CODE_STATES}
+        return {state: count for state, count in counts.items() if count}
+
+    def videos(self, batch_size=16):
+        """
+        Claim and iterate videos until none is left or this worker is retired.
+        :param batch_size:  Videos claimed at once.
+        :return:            Generator of (index, video id) tuples.
+        """
+
+        while True:
+            indices = self.claim(batch_size)
+            if not indices:
+                return
+            for position, index in enumerate(indices):
+                if self.take_retirement():
+                    self.release(indices[position:])
+                    return
+                yield index, self.video_id(index)
+
+    def __len__(self):
+        return self.size
@@ -0,0 +1,74 @@
+import os
+import sys
+import tempfile
+import types
+
+import pytest
+
+# lib.config holds the credentials of a deployment and is not part of the repository, the tests run against
+# a scratch directory and the local storage backend instead
+SCRATCH = tempfile.mkdtemp(prefix="sports1m-tests-")
+
+config = types.ModuleType("lib.config")
+config.OUTPUT_ROOT = os.path.join(SCRATCH, "sports", "OUTPUT")
+config.STORAGE_BACKEND = "local"
+config.LOCAL_STORAGE_ROOT = os.path.join(SCRATCH, "blobs")
+config.INVENTORY_PATH = os.path.join(SCRATCH, "inventory.db")
+sys.modules["lib.config"] = config
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def local_storage(tmp_path):
+    from lib.storage import LocalStorage
+    return LocalStorage(str(tmp_path / "blobs"), "sports-1m")
+
+
+def write_script(path, source):
+    """
+    Write an executable Python script, used as a stand-in for youtube-dl and azcopy.
+    :param path:      Path of the script.
+    :param source:    Python source, without the interpreter line.
+    :return:          Path as str.
+    """
+
+    with open(str(path), "w") as f:
+        f.write("#!{}\n{}".format(sys.executable, source))
+    os.chmod(str(path), 0o755)
+    return str(path)
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    """
+    Point download.py and the workers at a fresh scratch directory with the local storage backend and the
+    fake youtube-dl of the benchmarks. The workers are forked and inherit it.
+    :return:    Function writing a partition file of video ids and returning its path.
+    """
+
+    import lib.downloader as downloader
+
+    output_root = tmp_path / "sports" / "OUTPUT"
+    output_root.mkdir(parents=True)
+    monkeypatch.setattr(config, "OUTPUT_ROOT", str(output_root))
+    monkeypatch.setattr(config, "LOCAL_STORAGE_ROOT", str(tmp_path / "blobs"))
+    monkeypatch.setattr(downloader, "INVENTORY_PATH", str(tmp_path / "inventory.db"))
+    monkeypatch.setattr(downloader, "YOUTUBE_DL_PATH", write_script(tmp_path / "youtube-dl", (
+        "import sys\nsys.path.insert(0, {!r})\nfrom benchmarks.fake_youtube_dl import main\n"
+        "sys.exit(main(sys.argv[1:]))\n").format(ROOT)))
+    monkeypatch.setenv("FAKE_YOUTUBE_DL_SIZE", "1024")
+    # clients and indexes cached by earlier tests belong to other directories
+    monkeypatch.setattr(downloader, "storage", None)
+    monkeypatch.setattr(downloader, "inventory", None)
+    monkeypatch.setattr(downloader, "output_indexes", {})
+
+    def partition(video_ids):
+        path = tmp_path / "partition.txt"
+        path.write_text("".join("https://www.youtube.com/watch?v={} 0\n".format(video_id) for video_id in video_ids))
+        monkeypatch.setattr(config, "TRAIN_METADATA_PATH", str(path), raising=False)
+        monkeypatch.setattr(config, "TEST_METADATA_PATH", str(path), raising=False)
+        return str(path)
+
+    return partition
@@ -0,0 +1,25 @@
+import lib.downloader as downloader
+from lib.async_download import AsyncPool
+from lib.ledger import DONE, JobLedger
+
+
+def test_async_pool_stores_every_video(pipeline, tmp_path):
+    videos = ["video{:06d}".format(number) for number in range(12)]
+    ledger_file = str(tmp_path / "ledger.db")
+    # the rate limit makes tasks wait for tokens next to the uploads in flight
+    pool = AsyncPool(None, videos, str(tmp_path / "videos"), 4, None, False, False, False, upload_workers=2,
+                     ledger_file=ledger_file, rate_limit=20)
+    pool.start_workers()
+    pool.feed_videos()
+    pool.stop_workers()
+
+    ledger = JobLedger(ledger_file)
+    states = {video_id: state for video_id, state, _ in ledger.jobs()}
+    ledger.close()
+    assert states == {video_id: DONE for video_id in videos}
+
+    storage = downloader.get_storage_client()
+    assert sorted(storage.list_blob_names()) == sorted(
+        downloader.blob_name(str(tmp_path / "videos" / "{}.mp4".format(video_id))) for video_id in videos)
+    assert len(downloader.get_inventory()) == len(videos)
+    assert not any((tmp_path / "videos").iterdir())
@@ -0,0 +1,38 @@
+from lib.autoscale import AutoScaler, TokenBucket
+
+
+def scaler(**kwargs):
+    # no pool is needed to decide, and the load of the test machine must not count
+    return AutoScaler(None, 1, 32, max_load=float("inf"), **kwargs)
+
+
+def test_grows_while_throughput_improves():
+    autoscaler = scaler()
+    assert autoscaler.decide(4, 1.0, 0) == 6
+    assert autoscaler.decide(6, 1.5, 0) == 8
+    assert autoscaler.decide(8, 1.52, 0) == 8
+    # the last increase made things worse
+    assert autoscaler.decide(8, 1.0, 0) == 7
+
+
+def test_does_not_grow_without_completed_videos():
+    autoscaler = scaler()
+    for _ in range(5):
+        assert autoscaler.decide(4, 0.0, 0) == 4
+
+
+def test_shrinks_and_slows_down_when_throttled():
+    limiter = TokenBucket(8)
+    autoscaler = scaler(rate_limiter=limiter)
+    assert autoscaler.decide(8, 2.0, 3) == 6
+    assert limiter.rate.value == 4
+    autoscaler.decide(6, 2.0, 0)
+    assert limiter.rate.value == 5
+
+
+def test_token_bucket_tells_the_wait_instead_of_sleeping():
+    limiter = TokenBucket(2)
+    assert limiter.try_acquire() == 0
+    assert limiter.try_acquire() == 0
+    wait = limiter.try_acquire()
+    assert 0 < wait <= 0.5
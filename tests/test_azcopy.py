@@ -0,0 +1,71 @@
+import json
+
+import lib.azcopy as azcopy
+import lib.config as config
+from conftest import write_script
+
+# stand-in for azcopy copy between local directories: copies the listed files, skips existing ones with
+# --overwrite=false, fails paths containing "bad" and reports the job as JSON messages like azcopy does
+STUB_AZCOPY = """
+import json, os, shutil, sys
+
+args = sys.argv[1:]
+source, destination = args[1], args[2]
+options = dict(arg[2:].split("=", 1) for arg in args[3:] if "=" in arg)
+paths = [line.strip() for line in open(options["list-of-files"]) if line.strip()]
+with open(os.path.join(destination, ".azcopy-calls"), "a") as f:
+    f.write(json.dumps({"args": args, "concurrency": os.environ.get("AZCOPY_CONCURRENCY_VALUE")}) + "\\n")
+
+failed, skipped, total = [], [], 0
+for path in paths:
+    src, dst = os.path.join(source, path), os.path.join(destination, path)
+    if "bad" in path:
+        failed.append({"Src": src, "Dst": dst, "ErrorCode": 403})
+    elif os.path.exists(dst) and options["overwrite"] == "false":
+        skipped.append({"Src": src, "Dst": dst})
+    else:
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.copyfile(src, dst)
+        total += os.path.getsize(src)
+
+print("INFO: not a JSON message")
+print(json.dumps({"MessageType": "Init", "MessageContent": "{}"}))
+end = {"JobStatus": "CompletedWithErrors" if failed else "Completed", "TotalBytesTransferred": str(total),
+       "FailedTransfers": failed, "SkippedTransfers": skipped or None}
+print(json.dumps({"MessageType": "EndOfJob", "MessageContent": json.dumps(end)}))
+sys.exit(1 if failed else 0)
+"""
+
+
+def test_copy_batch_runs_one_job_for_all_files(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "AZCOPY_PATH", write_script(tmp_path / "azcopy", STUB_AZCOPY), raising=False)
+    source, destination = tmp_path / "source", tmp_path / "destination"
+    for path in ("a/Aaaaaaaaaaa.mp4", "b/Bbbbbbbbbbb.mp4", "bad/Ccccccccccc.mp4", "Ddddddddddd.mp4"):
+        (source / path).parent.mkdir(parents=True, exist_ok=True)
+        (source / path).write_bytes(b"x" * 10)
+    destination.mkdir()
+    (destination / "Ddddddddddd.mp4").write_bytes(b"old")
+
+    paths = ["a/Aaaaaaaaaaa.mp4", "b/Bbbbbbbbbbb.mp4", "bad/Ccccccccccc.mp4", "Ddddddddddd.mp4", "a/Aaaaaaaaaaa.mp4"]
+    summary = azcopy.copy_batch(str(source), str(destination), paths, concurrency=32, overwrite="false")
+
+    calls = [json.loads(line) for line in (destination / ".azcopy-calls").read_text().splitlines()]
+    assert len(calls) == 1
+    assert calls[0]["concurrency"] == "32"
+    assert "--output-type=json" in calls[0]["args"]
+
+    assert summary["files"] == 4
+    assert summary["status"] == {"a/Aaaaaaaaaaa.mp4": "transferred", "b/Bbbbbbbbbbb.mp4": "transferred",
+                                 "bad/Ccccccccccc.mp4": "failed", "Ddddddddddd.mp4": "skipped"}
+    assert summary["errors"] == {"bad/Ccccccccccc.mp4": 403}
+    assert (summary["transferred"], summary["skipped"], summary["failed"]) == (2, 1, 1)
+    assert summary["bytes"] == 20
+    assert summary["job_status"] == "CompletedWithErrors"
+    assert (destination / "b" / "Bbbbbbbbbbb.mp4").read_bytes() == b"x" * 10
+    assert (destination / "Ddddddddddd.mp4").read_bytes() == b"old"
+
+
+def test_relative_paths_of_urls_and_local_paths():
+    assert azcopy.relative_path("https://account.blob.core.windows.net/c/OUTPUT/a.mp4?sig=1",
+                                "https://account.blob.core.windows.net/c/?sv=2") == "OUTPUT/a.mp4"
+    assert azcopy.relative_path("/data/videos/a/b.mp4", "/data/videos") == "a/b.mp4"
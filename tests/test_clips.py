@@ -0,0 +1,41 @@
+import queue
+
+import pytest
+
+import lib.downloader as downloader
+
+
+@pytest.fixture
+def ffmpeg_calls(monkeypatch):
+    calls = []
+
+    def call(cmd):
+        calls.append(cmd)
+        with open(cmd[-1], "wb") as f:
+            f.write(b"clip")
+        return 0
+
+    monkeypatch.setattr(downloader.subprocess, "call", call)
+    return calls
+
+
+@pytest.mark.parametrize("keyframe, copy", [(10.0, True), (10.02, True), (12.0, False), (None, False)])
+def test_clips_are_copied_only_from_a_keyframe(monkeypatch, ffmpeg_calls, tmp_path, keyframe, copy):
+    monkeypatch.setattr(downloader, "probe_keyframe", lambda media_url, start, window: keyframe)
+
+    assert downloader.cut_clip_stream(["video_url", "audio_url"], str(tmp_path / "clip.mp4"), 10, 20)
+    # one ffmpeg pass, never a join of separately encoded parts
+    assert len(ffmpeg_calls) == 1
+    assert ("copy" in ffmpeg_calls[0]) == copy
+    assert ("libx264" in ffmpeg_calls[0]) != copy
+
+
+def test_sections_reach_the_workers(tmp_path):
+    videos_queue = queue.Queue()
+    downloader.download_class_parallel(None, ["Aaaaaaaaaaa"], str(tmp_path), videos_queue, section=(0, 5))
+    assert videos_queue.get() == ("Aaaaaaaaaaa", str(tmp_path), 0, 5)
+
+    # a section starting at 0 is cut as well
+    assert downloader.needs_transcode("Aaaaaaaaaaa.mp4", 0, 5)
+    assert not downloader.needs_transcode("Aaaaaaaaaaa.mp4", 0, 5, clip_mode=True)
+    assert not downloader.can_stream(0, 5)
@@ -0,0 +1,82 @@
+import hashlib
+import io
+import threading
+import time
+
+import pytest
+
+# the Azure SDK is an optional dependency of the local backend
+pytest.importorskip("azure.storage.blob")
+
+from lib.cloud_storage import CloudStorage
+
+
+class FakeBlobClient:
+    """
+    Blob client recording the staged blocks, how many were in flight at once and the committed block list.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.blocks = {}
+        self.committed = None
+        self.content_settings = None
+
+    def exists(self):
+        return False
+
+    def stage_block(self, block_id, data, validate_content=False):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.01)
+        with self.lock:
+            self.in_flight -= 1
+            self.blocks[block_id] = data
+
+    def commit_block_list(self, blocks, content_settings=None):
+        self.committed = b"".join(self.blocks[block.id] for block in blocks)
+        self.content_settings = content_settings
+
+
+class FakeServiceClient:
+
+    def __init__(self, blob_client):
+        self.blob_client = blob_client
+
+    def get_blob_client(self, container_name, blob_name):
+        return self.blob_client
+
+
+def cloud_storage(blob_client, block_size=16, max_concurrency=2):
+    # no connection string is needed with a fake service client
+    storage = CloudStorage.__new__(CloudStorage)
+    storage.container_name = "sports-1m"
+    storage.block_size = block_size
+    storage.max_concurrency = max_concurrency
+    storage.validate_content = False
+    storage.upload_retries = 0
+    storage.blob_service_client = FakeServiceClient(blob_client)
+    return storage
+
+
+def test_stream_is_staged_in_bounded_blocks():
+    data = bytes(range(256)) * 4
+    blob_client = FakeBlobClient()
+
+    stats = cloud_storage(blob_client).upload_stream(io.BytesIO(data), "videos/Aaaaaaaaaaa.mp4")
+    assert stats["bytes"] == len(data)
+    assert len(blob_client.blocks) == len(data) // 16
+    assert blob_client.max_in_flight <= 2
+    assert blob_client.committed == data
+    assert blob_client.content_settings.content_md5 == hashlib.md5(data).digest()
+
+
+def test_incomplete_streams_are_not_committed():
+    blob_client = FakeBlobClient()
+    with pytest.raises(IOError):
+        cloud_storage(blob_client).upload_stream(io.BytesIO(b"0" * 100), "videos/Aaaaaaaaaaa.mp4",
+                                                 complete=lambda: False)
+    assert blob_client.committed is None
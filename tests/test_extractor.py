@@ -0,0 +1,70 @@
+import lib.downloader as downloader
+from lib.extractor import InProcessDownloader
+from lib.ledger import ERROR_UNAVAILABLE
+
+
+class FakeYoutubeDL:
+    """
+    Stand-in for YoutubeDL copying a local file instead of fetching the video.
+    """
+
+    instances = []
+
+    def __init__(self, params):
+        self.params = dict(params)
+        self.urls = []
+        FakeYoutubeDL.instances.append(self)
+
+    def download(self, urls):
+        for url in urls:
+            self.urls.append(url)
+            if url.endswith("BADBADBADBA"):
+                raise Exception("ERROR: [youtube] BADBADBADBA: Video unavailable")
+            with open(self.params["outtmpl"].replace("%%", "%"), "wb") as f:
+                f.write(url.encode("utf-8"))
+        return 0
+
+
+def test_in_process_downloads_reuse_one_extractor(tmp_path):
+    FakeYoutubeDL.instances = []
+    extractor = InProcessDownloader(downloader.format_selector("mp4"), youtube_dl_class=FakeYoutubeDL)
+
+    for video_id in ("Aaaaaaaaaaa", "Bbbbbbbbbbb"):
+        download_path = str(tmp_path / "{}.mp4".format(video_id))
+        assert downloader.download_video(video_id, download_path, extractor=extractor)
+        assert open(download_path, "rb").read() == downloader.video_url(video_id).encode("utf-8")
+
+    assert len(FakeYoutubeDL.instances) == 1
+    assert len(extractor.ydl.urls) == 2
+    assert extractor.ydl.params["format"] == downloader.format_selector("mp4")
+
+
+def test_in_process_failures_are_classified(tmp_path):
+    extractor = InProcessDownloader(downloader.format_selector("mp4"), youtube_dl_class=FakeYoutubeDL)
+    report = {}
+
+    assert not downloader.download_video("BADBADBADBA", str(tmp_path / "BADBADBADBA.mp4"), extractor=extractor,
+                                         report=report)
+    assert report["error_class"] == ERROR_UNAVAILABLE
+    assert "Video unavailable" in report["error"]
+    assert not (tmp_path / "BADBADBADBA.mp4").exists()
+
+
+def test_output_template_escapes_percent(tmp_path):
+    extractor = InProcessDownloader(downloader.format_selector("mp4"), youtube_dl_class=FakeYoutubeDL)
+    extractor.set_output(str(tmp_path / "100%.mp4"))
+    assert extractor.ydl.params["outtmpl"] == str(tmp_path / "100%%.mp4")
+
+
+def test_match_container_does_not_force_the_merge_container():
+    # a fallback to vp9 and opus streams has to be merged into mkv instead of failing
+    cmd = downloader.download_command("Aaaaaaaaaaa", "Aaaaaaaaaaa.mp4", match_container=True)
+    assert "--merge-output-format" not in cmd
+    assert cmd[cmd.index("-f") + 1].startswith("bestvideo[ext=mp4]+bestaudio[ext=m4a]/")
+
+    downloader.extractor = None
+    try:
+        extractor = downloader.get_extractor(youtube_dl_class=FakeYoutubeDL, match_container=True)
+        assert extractor.ydl.params["merge_output_format"] is None
+    finally:
+        downloader.extractor = None
@@ -0,0 +1,78 @@
+import io
+import queue
+
+import lib.downloader as downloader
+import lib.ledger as ledger
+import lib.parallel_download as parallel
+from lib.frames import FrameShard, FrameShardWriter, split_jpegs
+
+
+def jpeg(number):
+    return b"\xff\xd8" + bytes([number]) * 100 + b"\xff\xd9"
+
+
+def test_split_jpegs():
+    frames = [jpeg(number) for number in range(5)]
+    assert list(split_jpegs(io.BytesIO(b"".join(frames)), chunk_size=7)) == frames
+
+
+def test_shards_are_memory_mappable(tmp_path):
+    writer = FrameShardWriter(str(tmp_path), name="test")
+    writer.add_video("Aaaaaaaaaaa", [jpeg(0), jpeg(1)])
+    path = writer.finish()
+
+    shard = FrameShard(path)
+    assert sorted(shard.keys()) == ["Aaaaaaaaaaa.000000.jpg", "Aaaaaaaaaaa.000001.jpg"]
+    assert bytes(shard["Aaaaaaaaaaa.000001.jpg"]) == jpeg(1)
+    shard.close()
+
+
+class FailingStorage:
+
+    def upload_file(self, src_file, target_file, overwrite=False):
+        raise IOError("no connection")
+
+
+def test_tracked_videos_finish_with_their_shard(tmp_path, local_storage):
+    writer = FrameShardWriter(str(tmp_path / "frames"), storage=local_storage, name="test", max_bytes=4096)
+    writer.add_video("Aaaaaaaaaaa", [jpeg(0)], track=True)
+    writer.add_video("Bbbbbbbbbbb", [jpeg(1)])
+    assert writer.take_finished() == []
+
+    # the shard is full after this video and uploaded
+    writer.add_video("Ccccccccccc", [jpeg(2)] * 40, track=True)
+    assert writer.take_finished() == [("Aaaaaaaaaaa", True), ("Ccccccccccc", True)]
+    assert local_storage.list_blob_names("frames/") == ["frames/test-000000.idx", "frames/test-000000.tar"]
+
+    failing = FrameShardWriter(str(tmp_path / "failing"), storage=FailingStorage(), name="test")
+    failing.add_video("Ddddddddddd", [jpeg(3)], track=True)
+    failing.close()
+    assert failing.take_finished() == [("Ddddddddddd", False)]
+    # the shard stays on disk
+    assert sorted(path.name for path in (tmp_path / "failing").iterdir()) == ["test-000000.idx", "test-000000.tar"]
+
+
+def test_frames_only_videos_are_done_once_their_shard_is_stored(monkeypatch, tmp_path, local_storage):
+    monkeypatch.setattr(downloader, "FRAMES_ROOT", str(tmp_path / "frames"))
+    monkeypatch.setattr(downloader, "get_storage_client", lambda: local_storage)
+    monkeypatch.setattr(downloader, "frame_writer", None)
+
+    def process_video(video_id, directory, start, end, report=None, **kwargs):
+        downloader.get_frame_writer().add_video(video_id, [jpeg(0)], track=True)
+        report["queued_frames"] = True
+        return True
+
+    monkeypatch.setattr(downloader, "process_video", process_video)
+    videos_queue, events_queue = queue.Queue(), queue.Queue()
+    for video_id in ("Aaaaaaaaaaa", "Bbbbbbbbbbb", None):
+        videos_queue.put(video_id and (video_id, str(tmp_path), None, None))
+    parallel.video_worker(videos_queue, events_queue, False, None, keep_videos=False)
+
+    events = []
+    while not events_queue.empty():
+        event = events_queue.get()
+        events.append((event["video_id"], event["state"]))
+    # nothing was done before the partly filled shard was uploaded when the worker exited
+    assert [event for event in events if event[1] != ledger.IN_PROGRESS] == [
+        ("Aaaaaaaaaaa", ledger.UPLOADING), ("Bbbbbbbbbbb", ledger.UPLOADING),
+        ("Aaaaaaaaaaa", ledger.DONE), ("Bbbbbbbbbbb", ledger.DONE)]
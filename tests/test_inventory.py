@@ -0,0 +1,44 @@
+from lib.inventory import BlobInventory, SHARD_CHARACTERS
+
+
+def store(storage, tmp_path, *names):
+    source = tmp_path / "source.mp4"
+    source.write_bytes(b"video")
+    for name in names:
+        storage.upload_file(str(source), name)
+
+
+def test_list_blob_names_by_prefix(local_storage, tmp_path):
+    store(local_storage, tmp_path, "OUTPUT/videos/Aaaaaaaaaaa.mp4", "OUTPUT/videos/Abbbbbbbbbb.compact.mp4",
+          "OUTPUT/videos/Bbbbbbbbbbb.mp4", "OUTPUT/frames/Aaaaaaaaaaa/000.jpg", "OUTPUT/Avideos/Cccccccccc.mp4")
+
+    assert local_storage.list_blob_names("OUTPUT/videos/A") == ["OUTPUT/videos/Aaaaaaaaaaa.mp4",
+                                                                "OUTPUT/videos/Abbbbbbbbbb.compact.mp4"]
+    assert local_storage.list_blob_names("OUTPUT/A") == ["OUTPUT/Avideos/Cccccccccc.mp4"]
+    assert local_storage.list_blob_names("OUTPUT/videos/") == ["OUTPUT/videos/Aaaaaaaaaaa.mp4",
+                                                               "OUTPUT/videos/Abbbbbbbbbb.compact.mp4",
+                                                               "OUTPUT/videos/Bbbbbbbbbbb.mp4"]
+    assert local_storage.list_blob_names("OUTPUT/missing/A") == []
+    assert len(local_storage.list_blob_names()) == 5
+
+
+def test_refresh_lists_only_stale_shards(local_storage, tmp_path):
+    store(local_storage, tmp_path, "OUTPUT/videos/Aaaaaaaaaaa.mp4", "OUTPUT/videos/-bbbbbbbbbb.mp4")
+    inventory = BlobInventory(str(tmp_path / "inventory.db"))
+
+    assert inventory.refresh(local_storage, prefix="OUTPUT/videos/") == len(SHARD_CHARACTERS)
+    assert inventory.video_ids() == {"Aaaaaaaaaaa", "-bbbbbbbbbb"}
+
+    # a second run lists nothing, uploads are recorded as they happen
+    store(local_storage, tmp_path, "OUTPUT/videos/Ccccccccccc.mp4")
+    assert inventory.refresh(local_storage, prefix="OUTPUT/videos/") == 0
+    assert "Ccccccccccc" not in inventory
+    inventory.add("OUTPUT/videos/Ccccccccccc.mp4")
+    assert "Ccccccccccc" in inventory
+
+    # a re-listed shard drops the blobs that are gone
+    local_storage.delete("OUTPUT/videos/Aaaaaaaaaaa.mp4")
+    inventory.invalidate("OUTPUT/videos/A")
+    assert inventory.refresh(local_storage, prefix="OUTPUT/videos/") == 1
+    assert inventory.video_ids() == {"-bbbbbbbbbb", "Ccccccccccc"}
+    inventory.close()
@@ -0,0 +1,28 @@
+from lib.output_index import OutputIndex
+
+
+def test_index_is_checked_against_the_disk(tmp_path):
+    (tmp_path / "Aaaaaaaaaaa.mp4").write_bytes(b"video")
+    (tmp_path / "Bbbbbbbbbbb_0001.jpg").write_bytes(b"frame")
+    index = OutputIndex(str(tmp_path))
+    assert index.has("Aaaaaaaaaaa", "mp4")
+    assert index.has("Bbbbbbbbbbb", "jpg")
+
+    # another process removed one file and created another one
+    (tmp_path / "Aaaaaaaaaaa.mp4").unlink()
+    (tmp_path / "Ccccccccccc.mkv").write_bytes(b"video")
+    assert not index.has("Aaaaaaaaaaa", "mp4")
+    assert index.paths("Ccccccccccc", "mkv") == [str(tmp_path / "Ccccccccccc.mkv")]
+    assert not index.has("Ccccccccccc", "mp4")
+
+
+def test_fan_out_directories(tmp_path):
+    (tmp_path / "Aa").mkdir()
+    (tmp_path / "Aa" / "Aaaaaaaaaaa.mp4").write_bytes(b"video")
+    index = OutputIndex(str(tmp_path), fan_out=2)
+    assert index.directory_of("Bbbbbbbbbbb") == str(tmp_path / "Bb")
+    assert index.has("Aaaaaaaaaaa", "mp4")
+
+    (tmp_path / "Bb").mkdir()
+    (tmp_path / "Bb" / "Bbbbbbbbbbb.mp4").write_bytes(b"video")
+    assert index.has("Bbbbbbbbbbb", "mp4")
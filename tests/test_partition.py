@@ -0,0 +1,63 @@
+import gzip
+import os
+
+import download
+import lib.config as config
+from lib.partition import CROSS_VALIDATION_DIR, Partition, cross_validation_paths, parse_video_id
+
+import pytest
+
+
+@pytest.mark.parametrize("url", [
+    "UDqivjS-lpI",
+    "https://www.youtube.com/watch?v=UDqivjS-lpI",
+    "http://www.youtube.com/watch?feature=player&v=UDqivjS-lpI&t=10",
+    "https://youtu.be/UDqivjS-lpI",
+    "https://www.youtube.com/embed/UDqivjS-lpI?autoplay=1",
+    "https://www.youtube.com/v/UDqivjS-lpI",
+    "https://www.youtube.com/shorts/UDqivjS-lpI",
+    "  https://www.youtube.com/watch?v=UDqivjS-lpI\n",
+])
+def test_url_forms(url):
+    assert parse_video_id(url) == "UDqivjS-lpI"
+
+
+@pytest.mark.parametrize("url", [
+    "https://www.youtube.com/watch?v=UDqivjS",
+    "https://www.youtube.com/watch?v=UDqivjS-lpIx",
+    "https://example.com/",
+    "",
+])
+def test_urls_without_an_id(url):
+    assert parse_video_id(url) is None
+
+
+def test_labels_are_stored_per_video(tmp_path):
+    (tmp_path / "train.txt").write_text("https://www.youtube.com/watch?v=UDqivjS-lpI 168,169\n\n"
+                                        "https://example.com/broken 3\n"
+                                        "https://www.youtube.com/watch?v=ABPsSSS2uY0 49\n")
+    with gzip.open(str(tmp_path / "test.txt.gz"), "wt") as f:
+        f.write("https://youtu.be/oHg5SJYRHA0 0\n")
+
+    partition = Partition.load(str(tmp_path / "train.txt"), str(tmp_path / "test.txt.gz"))
+    assert len(partition) == 3
+    assert list(partition) == ["UDqivjS-lpI", "ABPsSSS2uY0", "oHg5SJYRHA0"]
+    assert partition.labels(0) == [168, 169]
+    assert partition.labels(2) == [0]
+    assert list(partition.items())[1] == ("ABPsSSS2uY0", [49])
+    assert list(partition.label_offsets) == [0, 2, 3, 4]
+    assert partition[-1] == "oHg5SJYRHA0"
+    with pytest.raises(IndexError):
+        partition[3]
+
+
+def test_cross_validation_folds(tmp_path, monkeypatch):
+    assert cross_validation_paths("cv", 3) == (os.path.join("cv", "sports3_train.txt"),
+                                               os.path.join("cv", "sports3_test.txt"))
+    assert os.path.basename(CROSS_VALIDATION_DIR) == "cross-validation"
+
+    (tmp_path / "sports3_train.txt").write_text("https://www.youtube.com/watch?v=UDqivjS-lpI 168\n")
+    (tmp_path / "sports3_test.txt").write_text("https://www.youtube.com/watch?v=ABPsSSS2uY0 26\n")
+    monkeypatch.setattr(config, "CROSS_VALIDATION_DIR", str(tmp_path), raising=False)
+    assert list(download.load_videos("train", fold=3)) == ["UDqivjS-lpI"]
+    assert list(download.load_videos("all", fold=3)) == ["UDqivjS-lpI", "ABPsSSS2uY0"]
@@ -0,0 +1,121 @@
+import time
+
+import download
+import lib.downloader as downloader
+from lib.ledger import DONE, UNAVAILABLE, JobLedger
+from lib.probe import MetadataCache, MetadataProbe, canned_probe, youtube_dl_probe
+
+from conftest import write_script
+
+import pytest
+
+# prints metadata for good ids and youtube-dl errors for the others, like youtube-dl --ignore-errors
+FAKE_PROBE = """import json, sys
+for url in sys.argv[1:]:
+    video_id = url.rpartition("=")[2]
+    if not url.startswith("https://"):
+        continue
+    if video_id.startswith("dead"):
+        sys.stderr.write("ERROR: [youtube] {}: Video unavailable\\n".format(video_id))
+    elif video_id.startswith("slow"):
+        sys.stderr.write("ERROR: [youtube] {}: HTTP Error 429: Too Many Requests\\n".format(video_id))
+    else:
+        print(json.dumps({"id": video_id, "duration": 60, "format_id": "22", "ext": "mp4", "filesize": 1000}))
+"""
+
+
+def record(filesize):
+    return {"available": True, "duration": 60, "format": "22", "ext": "mp4", "filesize": filesize, "error": None}
+
+
+def test_order_drops_unavailable_videos_and_starts_large_ones_first(tmp_path):
+    metadata = {"small": record(10), "large": record(1000), "medium": record(100), "unknown": record(None)}
+    probe = MetadataProbe(MetadataCache(str(tmp_path / "metadata.db")), canned_probe(metadata), batch_size=2)
+
+    # videos of unknown size are placed as if of median size
+    assert probe.order(["small", "dead", "unknown", "large", "medium"]) == ["large", "unknown", "medium", "small"]
+    assert probe.stats == {"probed": 5, "unavailable": 1, "unknown": 0}
+    assert probe.cache.counts() == {"available": 4, "unavailable": 1}
+
+
+def test_videos_are_ordered_window_by_window(tmp_path):
+    metadata = {"video{}".format(number): record(number + 1) for number in range(10)}
+    probe = MetadataProbe(MetadataCache(str(tmp_path / "metadata.db")), canned_probe(metadata))
+
+    videos = list(probe.videos(("video{}".format(number) for number in range(10)), window=4))
+    assert videos == ["video3", "video2", "video1", "video0", "video7", "video6", "video5", "video4",
+                      "video9", "video8"]
+
+
+def test_cached_metadata_expires(tmp_path):
+    cache = MetadataCache(str(tmp_path / "metadata.db"))
+    cache.put({"old": record(10)}, probed_at=time.time() - 3600)
+    cache.put({"new": record(20)})
+
+    assert set(cache.get(["old", "new", "missing"])) == {"old", "new"}
+    assert set(cache.get(["old", "new"], max_age=60)) == {"new"}
+
+    # expired videos are probed again
+    probe = MetadataProbe(cache, canned_probe({"old": record(30), "new": record(40)}), max_age=60)
+    assert probe.metadata(["old", "new"])["old"]["filesize"] == 30
+    assert probe.stats["probed"] == 1
+
+
+def test_youtube_dl_probe_only_records_permanent_errors(monkeypatch, tmp_path):
+    monkeypatch.setattr(downloader, "YOUTUBE_DL_PATH", write_script(tmp_path / "youtube-dl", FAKE_PROBE))
+    records = youtube_dl_probe()(["goodvideo01", "deadvideo01", "slowvideo01"])
+
+    assert records["goodvideo01"]["available"]
+    assert records["goodvideo01"]["filesize"] == 1000
+    assert not records["deadvideo01"]["available"]
+    assert records["deadvideo01"]["error"] == "Video unavailable"
+    # a throttled probe is retried later instead of marking the video dead
+    assert "slowvideo01" not in records
+
+
+def test_videos_finished_in_the_ledger_are_not_probed(pipeline, monkeypatch, tmp_path):
+    video_ids = ["video{:06d}".format(number) for number in range(6)]
+    pipeline(video_ids)
+    failed_log = str(tmp_path / "failed.txt")
+    # every video ends unavailable in the ledger, so none of them is stored
+    monkeypatch.setenv("FAKE_YOUTUBE_DL_UNAVAILABLE", "1")
+    download.download_set(2, failed_log, False, False, False, None, usage="train")
+
+    probed = []
+
+    def probe(batch):
+        probed.extend(batch)
+        return {}
+
+    metadata_probe = MetadataProbe(MetadataCache(str(tmp_path / "metadata.db")), probe)
+    download.download_set(2, failed_log, False, False, False, None, usage="train", metadata_probe=metadata_probe)
+    metadata_probe.cache.close()
+    assert probed == []
+
+
+def test_dead_videos_found_by_the_probe_are_recorded(pipeline, tmp_path):
+    video_ids = ["video{:06d}".format(number) for number in range(6)]
+    pipeline(video_ids)
+    failed_log = str(tmp_path / "failed.txt")
+    metadata = {video_id: record(1000) for video_id in video_ids[:4]}
+    metadata_probe = MetadataProbe(MetadataCache(str(tmp_path / "metadata.db")), canned_probe(metadata))
+
+    download.download_set(2, failed_log, False, False, False, None, usage="train", metadata_probe=metadata_probe)
+    metadata_probe.cache.close()
+
+    job_ledger = JobLedger(str(tmp_path / "ledger.db"))
+    states = {video_id: state for video_id, state, _ in job_ledger.jobs()}
+    job_ledger.close()
+    assert states == dict({video_id: DONE for video_id in video_ids[:4]},
+                          **{video_id: UNAVAILABLE for video_id in video_ids[4:]})
+    with open(failed_log) as f:
+        assert sorted(f.read().split()) == video_ids[4:]
+
+
+def test_the_probe_does_not_fill_shared_work_tables(pipeline, tmp_path):
+    pipeline(["video000000"])
+    metadata_probe = MetadataProbe(MetadataCache(str(tmp_path / "metadata.db")), canned_probe({}))
+    with pytest.raises(ValueError):
+        download.download_set(2, str(tmp_path / "failed.txt"), False, False, False, None, usage="train",
+                              shared_work=True, metadata_probe=metadata_probe)
+    metadata_probe.cache.close()
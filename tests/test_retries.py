@@ -0,0 +1,88 @@
+import queue
+import time
+
+import lib.downloader as downloader
+import lib.ledger as ledger
+import lib.parallel_download as parallel
+
+
+def run_worker(requests, **kwargs):
+    videos_queue = queue.Queue()
+    for request in requests + [None]:
+        videos_queue.put(request)
+    events_queue = queue.Queue()
+    parallel.video_worker(videos_queue, events_queue, False, None, **kwargs)
+    events = []
+    while not events_queue.empty():
+        events.append(events_queue.get())
+    return [(event["video_id"], event["state"]) for event in events]
+
+
+def test_retries_do_not_hold_up_other_videos(monkeypatch, tmp_path):
+    attempts = []
+
+    def process_video(video_id, directory, start, end, report=None, **kwargs):
+        attempts.append(video_id)
+        if video_id == "Aaaaaaaaaaa" and attempts.count(video_id) == 1:
+            return downloader.fail(report, ledger.ERROR_THROTTLED, "HTTP Error 429")
+        return True
+
+    monkeypatch.setattr(downloader, "process_video", process_video)
+    start = time.time()
+    events = run_worker([("Aaaaaaaaaaa", str(tmp_path), None, None), ("Bbbbbbbbbbb", str(tmp_path), None, None)],
+                        retry_backoff=0.5)
+
+    # the worker went on with the next video while the first one waited for its retry
+    assert attempts == ["Aaaaaaaaaaa", "Bbbbbbbbbbb", "Aaaaaaaaaaa"]
+    assert time.time() - start >= 0.5
+    assert [event for event in events if event[1] != ledger.IN_PROGRESS] == [("Bbbbbbbbbbb", ledger.DONE),
+                                                                            ("Aaaaaaaaaaa", ledger.DONE)]
+
+
+def test_failed_uploads_are_retried_without_fetching_again(monkeypatch, tmp_path):
+    video_path = tmp_path / "Aaaaaaaaaaa.mp4"
+    video_path.write_bytes(b"video")
+    fetched, stored = [], []
+
+    def process_video(video_id, directory, start, end, report=None, **kwargs):
+        fetched.append(video_id)
+        report["video_path"] = str(video_path)
+        return downloader.fail(report, ledger.ERROR_UPLOAD)
+
+    def store_video(video_id, video_path, upload_queue=None, report=None):
+        stored.append(video_path)
+        return True
+
+    monkeypatch.setattr(downloader, "process_video", process_video)
+    monkeypatch.setattr(downloader, "store_video", store_video)
+    events = run_worker([("Aaaaaaaaaaa", str(tmp_path), None, None)], retry_backoff=0)
+
+    assert fetched == ["Aaaaaaaaaaa"]
+    assert stored == [[str(video_path)]]
+    assert events[-1] == ("Aaaaaaaaaaa", ledger.DONE)
+
+
+def test_permanent_and_exhausted_failures(monkeypatch, tmp_path):
+    def process_video(video_id, directory, start, end, report=None, **kwargs):
+        if video_id == "Aaaaaaaaaaa":
+            return downloader.fail(report, ledger.ERROR_UNAVAILABLE, "Video unavailable")
+        return downloader.fail(report, ledger.ERROR_DOWNLOAD, "connection reset")
+
+    monkeypatch.setattr(downloader, "process_video", process_video)
+    events = run_worker([("Aaaaaaaaaaa", str(tmp_path), None, None), ("Bbbbbbbbbbb", str(tmp_path), None, None)],
+                        max_retries=2, retry_backoff=0)
+
+    assert events.count(("Aaaaaaaaaaa", ledger.IN_PROGRESS)) == 1
+    assert events.count(("Bbbbbbbbbbb", ledger.IN_PROGRESS)) == 3
+    assert ("Aaaaaaaaaaa", ledger.UNAVAILABLE) in events
+    assert events[-1] == ("Bbbbbbbbbbb", ledger.FAILED)
+
+
+def test_existing_blob_of_the_same_size_counts_as_uploaded(monkeypatch, local_storage, tmp_path):
+    monkeypatch.setattr(downloader, "get_storage_client", lambda: local_storage)
+    video_path = tmp_path / "Aaaaaaaaaaa.mp4"
+    video_path.write_bytes(b"video")
+    local_storage.upload_file(str(video_path), downloader.blob_name(str(video_path)))
+
+    assert downloader.upload2blob(str(video_path))
+    assert not video_path.exists()
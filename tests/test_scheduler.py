@@ -0,0 +1,59 @@
+from lib.partition import Partition
+from lib.scheduler import ClassScheduler, load_labels, load_mids
+
+import pytest
+
+LABELS = ["archery", "bowling", "cycling", "table tennis"]
+MIDS = {"archery": "/m/01", "bowling": "/m/02", "cycling": "/m/03", "table tennis": "/m/04"}
+# in file order; "ab" belongs to archery and bowling
+VIDEOS = [("a0", [0]), ("b0", [1]), ("ab", [0, 1]), ("a1", [0]), ("c0", [2]), ("b1", [1]), ("a2", [0])]
+
+
+def video_id(name):
+    return name.ljust(11, "x")
+
+
+@pytest.fixture
+def scheduler():
+    partition = Partition()
+    partition.extend((video_id(name), labels) for name, labels in VIDEOS)
+    return ClassScheduler(partition, labels=LABELS, mids=MIDS)
+
+
+def schedule(scheduler, *args, **kwargs):
+    return [name.rstrip("x") for name in scheduler.schedule(*args, **kwargs)]
+
+
+def test_load_labels_and_mids(tmp_path):
+    (tmp_path / "labels.txt").write_text("archery\nbowling\n\n")
+    (tmp_path / "mids.txt").write_text("/m/01,archery\n/m/02,bowling\n")
+    assert load_labels(str(tmp_path / "labels.txt")) == ["archery", "bowling"]
+    assert load_mids(str(tmp_path / "mids.txt")) == {"archery": "/m/01", "bowling": "/m/02"}
+
+
+def test_classes_resolve_by_index_name_or_topic_id(scheduler):
+    assert scheduler.resolve([2, "1", "archery", "/m/04"]) == [2, 1, 0, 3]
+    # class directory names use underscores, duplicates are dropped
+    assert scheduler.resolve(["table_tennis", 3, "/m/04"]) == [3]
+    assert scheduler.class_name(3) == "table tennis"
+    assert scheduler.mid(1) == "/m/02"
+    with pytest.raises(ValueError):
+        scheduler.resolve([4])
+    with pytest.raises(ValueError):
+        scheduler.resolve(["curling"])
+
+
+def test_classes_are_interleaved_round_robin(scheduler):
+    assert schedule(scheduler, interleave=True) == ["a0", "b0", "c0", "ab", "b1", "a1", "a2"]
+
+
+def test_per_class_caps(scheduler):
+    # a video of several classes counts for the class it was scheduled under
+    assert schedule(scheduler, per_class=2) == ["a0", "b0", "c0", "ab", "b1"]
+    assert scheduler.scheduled == {0: 2, 1: 2, 2: 1, 3: 0}
+    assert schedule(scheduler, per_class=0) == []
+
+
+def test_selected_classes_one_after_the_other(scheduler):
+    assert schedule(scheduler, ["bowling", "/m/01"], interleave=False) == ["b0", "ab", "b1", "a0", "a1", "a2"]
+    assert schedule(scheduler, ["cycling"], interleave=False) == ["c0"]
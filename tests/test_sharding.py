@@ -0,0 +1,47 @@
+import json
+import os
+
+import download
+from lib.ledger import DONE, UNAVAILABLE, JobLedger
+from lib.sharding import parse_shard, shard_of, shard_path
+
+import pytest
+
+
+def test_shards_are_disjoint_and_stable():
+    video_ids = ["{:011d}".format(number) for number in range(1000)]
+    shards = [shard_of(video_id, 3) for video_id in video_ids]
+    assert shards == [shard_of(video_id, 3) for video_id in video_ids]
+    assert all(shards.count(index) > 250 for index in range(3))
+    assert parse_shard("2/3") == (2, 3)
+    with pytest.raises(ValueError):
+        parse_shard("3/3")
+
+
+def test_three_local_shards_merge_into_one_report(pipeline, monkeypatch, tmp_path):
+    video_ids = ["video{:06d}".format(number) for number in range(30)]
+    pipeline(video_ids)
+    monkeypatch.setenv("FAKE_YOUTUBE_DL_UNAVAILABLE", "0.2")
+    failed_log = str(tmp_path / "failed.txt")
+
+    for index in range(3):
+        download.download_set(2, failed_log, False, False, False, None, usage="train", shard=(index, 3))
+
+    # every shard kept its own ledger with only its own videos
+    shard_videos = []
+    for index in range(3):
+        ledger = JobLedger(shard_path(str(tmp_path / "ledger.db"), (index, 3)))
+        jobs = list(ledger.jobs())
+        ledger.close()
+        assert {shard_of(video_id, 3) for video_id, _, _ in jobs} == {index}
+        shard_videos += [video_id for video_id, _, _ in jobs]
+    assert sorted(shard_videos) == video_ids
+
+    report = download.merge_report(3, failed_log, str(tmp_path / "report.json"), usage="train")
+    assert report["videos"] == 30
+    assert set(report["states"]) == {DONE, UNAVAILABLE}
+    assert report["states"][DONE] == len(os.listdir(tmp_path / "blobs" / "sports-1m" / "sports" / "OUTPUT"))
+    assert report["states"][UNAVAILABLE] > 0
+    assert report["done_not_stored"] == 0 and report["missing_ledgers"] == []
+    assert sum(sum(shard.values()) for shard in report["shards"]) == 30
+    assert json.load(open(str(tmp_path / "report.json")))["states"] == report["states"]
@@ -0,0 +1,74 @@
+import io
+import os
+
+import pytest
+
+import lib.config as config
+from lib.storage import LocalStorage, StorageBackend, get_storage
+
+
+def test_get_storage_selects_local_backend():
+    storage = get_storage("sports-1m")
+    assert isinstance(storage, LocalStorage)
+    assert storage.directory == os.path.join(config.LOCAL_STORAGE_ROOT, "sports-1m")
+
+
+def test_local_round_trip(local_storage, tmp_path):
+    source = tmp_path / "Aaaaaaaaaaa.mp4"
+    source.write_bytes(b"0123456789")
+
+    stats = local_storage.upload_file(str(source), "OUTPUT/videos/Aaaaaaaaaaa.mp4")
+    assert stats["bytes"] == 10
+    assert local_storage.exists("OUTPUT/videos/Aaaaaaaaaaa.mp4")
+    assert local_storage.get_size("OUTPUT/videos/Aaaaaaaaaaa.mp4") == 10
+    assert local_storage.is_identical(str(source), "OUTPUT/videos/Aaaaaaaaaaa.mp4")
+    with pytest.raises(FileExistsError):
+        local_storage.upload_file(str(source), "OUTPUT/videos/Aaaaaaaaaaa.mp4")
+
+    copy = tmp_path / "copy" / "Aaaaaaaaaaa.mp4"
+    local_storage.download_file("OUTPUT/videos/Aaaaaaaaaaa.mp4", str(copy))
+    assert copy.read_bytes() == b"0123456789"
+
+    local_storage.delete("OUTPUT/videos/Aaaaaaaaaaa.mp4")
+    assert not local_storage.exists("OUTPUT/videos/Aaaaaaaaaaa.mp4")
+
+
+def test_upload_stream_commits_only_complete_streams(local_storage):
+    local_storage.upload_stream(io.BytesIO(b"x" * 100), "OUTPUT/videos/Aaaaaaaaaaa.mp4")
+    assert local_storage.get_size("OUTPUT/videos/Aaaaaaaaaaa.mp4") == 100
+
+    with pytest.raises(IOError):
+        local_storage.upload_stream(io.BytesIO(b"x" * 100), "OUTPUT/videos/Bbbbbbbbbbb.mp4", complete=lambda: False)
+    with pytest.raises(IOError):
+        local_storage.upload_stream(io.BytesIO(b""), "OUTPUT/videos/Ccccccccccc.mp4")
+    # no partial blob or temporary file is left behind
+    assert local_storage.list_blob_names() == ["OUTPUT/videos/Aaaaaaaaaaa.mp4"]
+    assert os.listdir(os.path.join(local_storage.directory, "OUTPUT", "videos")) == ["Aaaaaaaaaaa.mp4"]
+
+
+def test_bulk_transfers_skip_identical_files(local_storage, tmp_path):
+    folder = tmp_path / "frames"
+    (folder / "a").mkdir(parents=True)
+    (folder / "a" / "000.jpg").write_bytes(b"frame 0")
+    (folder / "001.jpg").write_bytes(b"frame 1")
+
+    summary = local_storage.upload_folder(str(folder), "OUTPUT/frames")
+    assert summary["transferred"] == 2
+    assert local_storage.upload_folder(str(folder), "OUTPUT/frames")["skipped"] == 2
+
+    (folder / "001.jpg").write_bytes(b"frame 1, changed")
+    assert local_storage.upload_folder(str(folder), "OUTPUT/frames")["transferred"] == 1
+
+    local = tmp_path / "download"
+    assert local_storage.download_prefix("OUTPUT/frames/", str(local))["transferred"] == 2
+    assert (local / "OUTPUT" / "frames" / "a" / "000.jpg").read_bytes() == b"frame 0"
+    assert local_storage.download_prefix("OUTPUT/frames/", str(local))["skipped"] == 2
+
+
+def test_incomplete_backends_fail_on_construction():
+    class ListingOnly(StorageBackend):
+        def list_blob_names(self, name_starts_with=None):
+            return []
+
+    with pytest.raises(TypeError):
+        ListingOnly()
@@ -0,0 +1,35 @@
+import lib.downloader as downloader
+
+
+def test_single_stream_stays_in_the_container_of_the_blob():
+    cmd = downloader.stream_command("Aaaaaaaaaaa", "mp4", mode="single")
+    assert cmd[cmd.index("-f") + 1] == "best[ext=mp4]"
+    assert cmd[cmd.index("--output") + 1] == "-"
+
+
+def test_streamed_videos_leave_no_local_files(pipeline, tmp_path):
+    import lib.config as config
+
+    pipeline([])
+    report = {}
+    assert downloader.stream_video("Aaaaaaaaaaa", config.OUTPUT_ROOT, report=report)
+    assert report["bytes"] == 1024 and report["container"] == "mp4"
+    assert list((tmp_path / "sports" / "OUTPUT").iterdir()) == []
+    assert downloader.get_storage_client().list_blob_names() == ["sports/OUTPUT/Aaaaaaaaaaa.mp4"]
+    assert "Aaaaaaaaaaa" in downloader.get_inventory()
+
+
+def test_blobs_missing_from_the_inventory_count_as_stored(pipeline, tmp_path):
+    import lib.config as config
+
+    pipeline([])
+    source = tmp_path / "stored.mp4"
+    source.write_bytes(b"0" * 512)
+    storage = downloader.get_storage_client()
+    storage.upload_file(str(source), "sports/OUTPUT/Aaaaaaaaaaa.mp4")
+
+    report = {}
+    assert downloader.stream_video("Aaaaaaaaaaa", config.OUTPUT_ROOT, report=report)
+    assert report["bytes"] == 512
+    assert storage.get_size("sports/OUTPUT/Aaaaaaaaaaa.mp4") == 512
+    assert "Aaaaaaaaaaa" in downloader.get_inventory()
@@ -0,0 +1,102 @@
+import os
+
+import lib.downloader as downloader
+import lib.parallel_download as parallel
+from lib.inventory import video_id_from_blob
+from lib.transcode import TranscodeProfile, encode_threads, parse_progress, scale_filter
+
+import pytest
+
+PROGRESS = b"""frame=120
+fps=240.0
+out_time_us=2000000
+progress=continue
+frame=300
+fps=250.0
+out_time_us=10000000
+out_time_ms=10000000
+progress=end
+"""
+
+
+def test_scale_filter():
+    assert scale_filter(256) == "scale='if(gt(iw,ih),-2,256)':'if(gt(iw,ih),256,-2)'"
+    # smaller videos keep their size
+    assert scale_filter(256, upscale=False) == "scale='if(gt(iw,ih),-2,min(256,iw))':'if(gt(iw,ih),min(256,ih),-2)'"
+
+
+def test_command():
+    cmd = TranscodeProfile(short_side=None, fps=15, crf=30, gop=30, audio=False, threads=2).command("in.mp4",
+                                                                                                   "out.mp4")
+    assert cmd[cmd.index("-vf") + 1] == "fps=15"
+    assert cmd[cmd.index("-crf") + 1] == "30"
+    assert cmd[cmd.index("-g") + 1] == "30"
+    assert cmd[cmd.index("-keyint_min") + 1] == "30"
+    assert cmd[cmd.index("-threads") + 1] == "2"
+    assert "-an" in cmd and "-c:a" not in cmd
+    assert cmd[-1] == "out.mp4"
+
+    cmd = TranscodeProfile().command("in.mp4", "out.mp4")
+    assert "min(256,iw)" in cmd[cmd.index("-vf") + 1]
+    assert cmd[cmd.index("-c:a") + 1] == "aac"
+    assert "-g" not in cmd and "-threads" not in cmd
+
+
+def test_unknown_upload_variant():
+    with pytest.raises(ValueError):
+        TranscodeProfile(upload="smallest")
+
+
+def test_parse_progress_keeps_the_last_values():
+    progress = parse_progress(PROGRESS.decode())
+    assert progress["frame"] == "300"
+    assert progress["progress"] == "end"
+
+
+def test_summarize(tmp_path):
+    src_path, dst_path = tmp_path / "video.mp4", tmp_path / "video.compact.mp4"
+    src_path.write_bytes(b"0" * 1000)
+    dst_path.write_bytes(b"0" * 250)
+    profile = TranscodeProfile()
+
+    summary = profile.summarize(str(src_path), str(dst_path), PROGRESS, 5.0)
+    assert summary == {"original_bytes": 1000, "compact_bytes": 250, "size_ratio": 0.25, "encode_seconds": 5.0,
+                       "media_seconds": 10.0, "frames": 300, "realtime_factor": 2.0}
+    assert profile.summarize(str(src_path), str(tmp_path / "missing.mp4"), PROGRESS, 5.0) is None
+
+
+@pytest.mark.parametrize("upload, kept, contents", [
+    ("original", ["video.mp4"], {"video.mp4": b"original"}),
+    ("compact", ["video.mp4"], {"video.mp4": b"compact"}),
+    ("both", ["video.mp4", "video.compact.mp4"], {"video.mp4": b"original", "video.compact.mp4": b"compact"}),
+])
+def test_keep_variants(tmp_path, upload, kept, contents):
+    video_path, compact_path = tmp_path / "video.mp4", tmp_path / "video.compact.mp4"
+    video_path.write_bytes(b"original")
+    compact_path.write_bytes(b"compact")
+
+    assert downloader.keep_variants(str(video_path), str(compact_path), upload) == [str(tmp_path / name)
+                                                                                     for name in kept]
+    assert {path.name: path.read_bytes() for path in tmp_path.iterdir()} == contents
+
+
+def test_video_id_from_blob():
+    assert video_id_from_blob("x/dQw4w9WgXcQ.compact.mp4") == "dQw4w9WgXcQ"
+    assert video_id_from_blob("OUTPUT/videos/dQw4w9WgXcQ.mp4") == "dQw4w9WgXcQ"
+
+
+def test_encodes_share_the_cores(monkeypatch):
+    monkeypatch.setattr(os, "cpu_count", lambda: 8)
+    assert encode_threads(3) == 2
+    assert encode_threads(16) == 1
+
+    profile = TranscodeProfile()
+    assert profile.for_concurrency(4).threads == 2
+    assert profile.threads is None
+    # threads set explicitly are kept
+    assert TranscodeProfile(threads=6).for_concurrency(4).threads == 6
+
+    pool = parallel.Pool(None, [], "videos", 4, None, True, False, False)
+    assert pool.compress.threads == 2
+    pool = parallel.Pool(None, [], "videos", 4, None, profile, False, False, transcode_workers=8)
+    assert pool.compress.threads == 1
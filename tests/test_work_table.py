@@ -0,0 +1,122 @@
+import os
+import time
+
+import lib.downloader as downloader
+import lib.ledger as ledger
+import lib.parallel_download as parallel
+from lib.work_table import CLAIMED, WorkTable
+
+
+def test_claims_and_releases():
+    table = WorkTable(["video{:06d}".format(number) for number in range(10)])
+    assert table.claim(4) == [0, 1, 2, 3]
+    assert table.remaining() == 6
+    table.set_state(0, ledger.DONE)
+    table.release([2, 3])
+    assert table.unfinished() == [1, 2, 3, 4, 5, 6, 7, 8, 9]
+
+    assert table.claim(100) == list(range(4, 10))
+    # released videos are handed out again once the cursor reached the end
+    assert table.claim(100) == [2, 3]
+    assert table.claim(100) == []
+    assert table.counts() == {ledger.DONE: 1, ledger.IN_PROGRESS: 9}
+
+
+def test_retired_workers_release_their_claims():
+    table = WorkTable(["video{:06d}".format(number) for number in range(10)])
+    videos = table.videos(batch_size=4)
+    assert next(videos) == (0, "video000000")
+    table.retire(1)
+    assert list(videos) == []
+    assert table.status[0] == CLAIMED
+    assert table.unfinished() == list(range(10))
+    assert table.claim(100) == list(range(4, 10))
+
+
+def test_pending_retirements_are_cancelled():
+    table = WorkTable(["video{:06d}".format(number) for number in range(10)])
+    table.retire(3)
+    assert table.cancel_retirements(1) == 1
+    assert table.cancel_retirements() == 2
+    assert next(table.videos(batch_size=4)) == (0, "video000000")
+
+
+def test_growing_takes_back_pending_retirements(tmp_path):
+    pool = parallel.Pool(None, [], str(tmp_path / "videos"), 2, None, False, False, False, shared_work=True)
+    pool.work_table = WorkTable(["video{:06d}".format(number) for number in range(10)])
+    pool.active_workers = 2
+    pool.resize(1)
+    assert pool.work_table.retiring.value == 1
+    # the worker asked to retire keeps running, no process is forked for it
+    pool.resize(2)
+    assert pool.work_table.retiring.value == 0
+    assert pool.active_workers == 2
+    assert pool.workers == []
+
+
+def run_pool(tmp_path, videos):
+    pool = parallel.Pool(None, videos, str(tmp_path / "videos"), 2, None, False, False, False,
+                         ledger_file=str(tmp_path / "ledger.db"), shared_work=True, claim_batch_size=4)
+    pool.start_workers()
+    pool.feed_videos()
+    pool.stop_workers()
+    # the ledger events a worker had not sent yet when it died are lost, the table has every outcome
+    table = pool.work_table
+    return {table.video_id(index): table.state(index) for index in range(len(table))}
+
+
+def dying_process_video(marker):
+    # the worker getting video000005 dies, every time or only the first time
+    def process_video(video_id, directory, start, end, report=None, **kwargs):
+        if video_id == "video000005" and (marker is None or not os.path.exists(marker)):
+            if marker is not None:
+                open(marker, "w").close()
+            os._exit(1)
+        return True
+    return process_video
+
+
+def test_claims_of_a_dead_worker_are_downloaded_again(pipeline, monkeypatch, tmp_path):
+    monkeypatch.setattr(downloader, "process_video", dying_process_video(str(tmp_path / "died")))
+    videos = ["video{:06d}".format(number) for number in range(20)]
+
+    states = run_pool(tmp_path, videos)
+    assert states == {video_id: ledger.DONE for video_id in videos}
+
+
+def test_videos_stranded_twice_are_failed(pipeline, monkeypatch, tmp_path):
+    monkeypatch.setattr(downloader, "process_video", dying_process_video(None))
+    videos = ["video{:06d}".format(number) for number in range(20)]
+
+    states = run_pool(tmp_path, videos)
+    assert states.pop("video000005") == ledger.FAILED
+    assert set(states.values()) == {ledger.DONE}
+    assert len(states) == 19
+
+
+def test_pending_retirements_do_not_end_the_recovery(pipeline, monkeypatch, tmp_path):
+    marker = str(tmp_path / "died")
+    dying = dying_process_video(marker)
+    pools = []
+
+    def process_video(video_id, directory, start, end, report=None, **kwargs):
+        if video_id == "video000019":
+            # once the other worker died, retire more workers than are left, as the autoscaler might near the end
+            while not os.path.exists(marker):
+                time.sleep(0.01)
+            pools[0].work_table.retire(4)
+        return dying(video_id, directory, start, end, report=report, **kwargs)
+
+    monkeypatch.setattr(downloader, "process_video", process_video)
+    monkeypatch.setattr(parallel.Pool, "start_workers", record_pool(pools, parallel.Pool.start_workers))
+    videos = ["video{:06d}".format(number) for number in range(20)]
+
+    states = run_pool(tmp_path, videos)
+    assert states == {video_id: ledger.DONE for video_id in videos}
+
+
+def record_pool(pools, start_workers):
+    def start(pool):
+        pools.append(pool)
+        start_workers(pool)
+    return start